@@ -17,6 +17,7 @@ class CNNClassifier(nn.Module):
     """
     A CNN-based classifier that is capable of performing dropout-regularization.
     """
+    return_logits = False  # forward returns the logits instead of probabilities, see tools.logits_output
 
     def __init__(self, conv_ch1, conv_ch2, linear_size, kernel_size, pooling_size, linear_input_size=None):
         """
@@ -60,26 +61,24 @@ class CNNClassifier(nn.Module):
         x = self.pool(x)
         return x
 
-    def scalars_after_conv(self, x):
+    def forward(self, x):
         """
-        Calculates how many scalars, i.e. tensors of rank 0 are in the output of the convolutional component.
+        performs the forward pass.
 
-        :param torch.Tensor x: one batch of input/observations
-        :return: the number of rank 0 tensors in the output of the convolutional component
+        :param  torch.Tensor x: the input/observations per batch
+        :return: the prediction of the whole batch
         """
-        x = self.conv_part(x)
-        size = x.size()  # batch_size x channel_size x width x height
-        n_channels = size[1]
-        width = size[2]
-        height = size[3]
-        return n_channels * width * height
+        x = self.logits(x=x)
+        if self.return_logits:
+            return x
+        return self.sigmoid(x)
 
-    def forward(self, x):
+    def logits(self, x):
         """
-        performs the forward pass.
+        Performs the forward pass without the final sigmoid, e.g. to soften the outputs by a temperature.
 
         :param  torch.Tensor x: the input/observations per batch
-        :return: the prediction of the whole batch
+        :return: the logits of the whole batch
         """
         x = self.conv_part(x)
 
@@ -88,7 +87,7 @@ class CNNClassifier(nn.Module):
             x = self.dropout(x)
             x = self.linear1(x)
             x = self.linear2(x)
-        return self.sigmoid(x)
+        return x
 
 
 class CNNWrapper:
@@ -112,73 +111,189 @@ class CNNWrapper:
         loader = DataLoader(dataset=custom_dataset, batch_size=batch_size, sampler=sampler)
         return {"loader": loader}
 
-    def find_linear_input_size(self, data, parameters):
+    @staticmethod
+    def find_linear_input_size(parameters):
         """
         Finds the number of parameters the first hidden layer that is attached to the convolutional
-        component of the model has to have given some data.
+        component of the model has to have. The size is inferred analytically from the output resolution of the
+        transformation pipeline, so no image has to be read and no forward pass has to be performed.
 
-        :param pd.DataFrame data: data on which the model has to be trained
         :param dict parameters: a dictionary containing the parameters defined in tools.parameters_cnn
         :return: The number of neurons that the first linear layer of the model needs to have
         """
-        linear_size = parameters["linear_size"]
-        conv_ch1 = parameters["conv_ch1"]
         conv_ch2 = parameters["conv_ch2"]
         kernel_size = parameters["kernel_size"]
         pooling_size = parameters["pooling_size"]
-        device = parameters["device"]
-
-        loader = self.preprocess(data=data, parameters=parameters)["loader"]
-
-        model = CNNClassifier(linear_size=linear_size,
-                              conv_ch1=conv_ch1,
-                              conv_ch2=conv_ch2,
-                              kernel_size=kernel_size,
-                              pooling_size=pooling_size).to(device)
-        example_batch = next(iter(loader))
-        example_x = example_batch[0]
-        return model.scalars_after_conv(x=example_x)
+        img_size = tools.transform_output_size(transform_pipe=parameters["transform_pipe"])
+
+        def side_after_conv(side):
+            """
+            Calculates the width or height of the representation after the convolutional part.
+            Each block consists of an unpadded convolution with stride 1 followed by a maximum pooling.
+
+            :param int side: width or height of the input images
+            :return: width or height of the output of the convolutional part
+            """
+            for _ in range(2):  # two conv-relu-pool blocks
+                side = (side - kernel_size + 1) // pooling_size
+            return side
+
+        height = side_after_conv(img_size[0])
+        width = side_after_conv(img_size[1])
+        if height < 1 or width < 1:
+            raise ValueError("images of size " + str(img_size) + " are too small for the convolutional part")
+        return conv_ch2 * height * width
+
+    def build_model(self, parameters):
+        """
+        Creates a CNNClassifier on the device given in >parameters<.
 
-    def fit(self, train_data, best_parameters):
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_cnn
+        :return: an untrained CNNClassifier
+        """
+        model = CNNClassifier(linear_size=parameters["linear_size"],
+                              conv_ch1=parameters["conv_ch1"],
+                              conv_ch2=parameters["conv_ch2"],
+                              linear_input_size=self.find_linear_input_size(parameters=parameters),
+                              kernel_size=parameters["kernel_size"],
+                              pooling_size=parameters["pooling_size"]).to(parameters["device"])
+        return tools.prepare_model(model=model, parameters=parameters)
+
+    def fit(self, train_data, best_parameters, val_data=None):
         """
         Trains a CNNClassifier on train_data using a set of parameters.
 
         :param pd.DataFrame train_data: data on which the model has to be trained
         :param dict best_parameters: a dictionary containing the parameters defined in tools.parameters_cnn
+        :param pd.DataFrame val_data: validation data evaluated after every epoch. Required for early stopping
         :return: The trained model
         """
         # extract the parameters
         accumulation = best_parameters["accumulation"]
-        linear_size = best_parameters["linear_size"]
-        conv_ch1 = best_parameters["conv_ch1"]
-        conv_ch2 = best_parameters["conv_ch2"]
-        kernel_size = best_parameters["kernel_size"]
-        pooling_size = best_parameters["pooling_size"]
+        train_eval_every = best_parameters["train_eval_every"]
         n_epochs = best_parameters["n_epochs"]
         lr = best_parameters["lr"]
-        device = best_parameters["device"]
 
         train_loader = self.preprocess(data=train_data, parameters=best_parameters)["loader"]
-
-        linear_input_size = self.find_linear_input_size(data=train_data, parameters=best_parameters)
-        model = CNNClassifier(linear_size=linear_size,
-                              conv_ch1=conv_ch1,
-                              conv_ch2=conv_ch2,
-                              linear_input_size=linear_input_size,
-                              kernel_size=kernel_size,
-                              pooling_size=pooling_size).to(device)
+        model = self.build_model(parameters=best_parameters)
         optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
         loss_func = nn.BCELoss()
 
+        checkpointer = tools.Checkpointer(parameters=best_parameters)
+        checkpoint = checkpointer.restore(name="fit", model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=best_parameters)
+        if early_stopping.enabled and val_data is None:
+            raise ValueError("early stopping (patience) requires val_data")
+        start_epoch = 0
+        if checkpoint is not None:
+            start_epoch = checkpoint["epoch"]
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
         # train loop
-        for epoch in range(n_epochs):
+        for epoch in range(start_epoch, n_epochs):
+            if early_stopping.stopped:
+                break
             print("=== Epoch", epoch + 1, "/", n_epochs, "===")
             model.train()
+            running_metrics = tools.RunningMetrics()
             for i, batch in enumerate(train_loader):
                 x_batch, y_batch = batch
                 # model(x) = model.__call__(x) performs forward (+ more)
-                probas = torch.flatten(model(x=x_batch))
+                with tools.autocast(parameters=best_parameters):  # bfloat16 forward if enabled
+                    probas = torch.flatten(model(x=x_batch)).float()
                 batch_loss = loss_func(probas, y_batch)  # calculate loss
+                running_metrics.update(y_true=y_batch, y_probas=probas)
+                batch_loss /= accumulation
+                batch_loss.backward()  # calculate gradients
+
+                if ((i + 1) % accumulation == 0) or ((i + 1) == len(train_loader)):
+                    optimizer.step()  # update parameters
+                    optimizer.zero_grad()  # clear the gradient
+
+            print("Metrics on training data after epoch", epoch + 1, ":")
+            if train_eval_every is not None and (epoch + 1) % train_eval_every == 0:
+                self.predict(model=model, data=train_data, parameters=best_parameters)
+            else:
+                running_metrics.compute()
+            if val_data is not None:
+                print("Metrics on validation data after epoch", epoch + 1, ":")
+                metrics = self.predict(model=model, data=val_data, parameters=best_parameters)
+                early_stopping.step(epoch=epoch + 1, metrics=metrics, model=model)
+            checkpointer.save(name="fit", epoch=epoch + 1, model=model, optimizer=optimizer,
+                              n_epochs=epoch + 1 if early_stopping.stopped else n_epochs,
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.restore_best(model=model)
+        return {"model": model}
+
+    def distill(self, train_data, best_parameters, teacher, teacher_parameters, val_data=None):
+        """
+        Trains a CNNClassifier on train_data by knowledge distillation from a trained teacher, e.g. a
+        PretrainedClassifier. The loss mixes the binary cross entropy with the true labels (weighted by
+        "distill_alpha") and with the teacher's probabilities softened by "distill_temperature".
+        The teacher's outputs are computed once per image and cached in "teacher_cache_dir", so the teacher does not
+        run during training.
+
+        :param pd.DataFrame train_data: data on which the model has to be trained
+        :param dict best_parameters: a dictionary containing the parameters defined in tools.parameters_cnn
+        :param nn.Module teacher: a trained model that returns logits within tools.logits_output, e.g. a
+        PretrainedClassifier
+        :param dict teacher_parameters: the parameters the teacher was trained with. Its transformation pipeline has
+        to be deterministic
+        :param pd.DataFrame val_data: validation data evaluated after every epoch. Required for early stopping
+        :return: The trained model
+        """
+        accumulation = best_parameters["accumulation"]
+        n_epochs = best_parameters["n_epochs"]
+        lr = best_parameters["lr"]
+        alpha = best_parameters["distill_alpha"]
+        temperature = best_parameters["distill_temperature"]
+        device = best_parameters["device"]
+
+        train_data = train_data.reset_index(drop=True)  # row i <-> cached teacher output i
+        teacher_logits = tools.cache_outputs(module=teacher, data=train_data, parameters=teacher_parameters,
+                                             cache_dir=best_parameters["teacher_cache_dir"],
+                                             target_sizes=tools.bucket_target_sizes(data=train_data,
+                                                                                    parameters=teacher_parameters),
+                                             logits=True)
+        teacher_logits = torch.from_numpy(np.array(teacher_logits)).flatten()
+        soft_targets = torch.sigmoid(teacher_logits / temperature).to(device)
+
+        custom_dataset = tools.CustomDataset(data=train_data, transform_pipe=best_parameters["transform_pipe"],
+                                             device=device, return_index=True)
+        train_loader = DataLoader(dataset=custom_dataset, batch_size=best_parameters["batch_size"],
+                                  sampler=RandomSampler(data_source=custom_dataset))
+        model = self.build_model(parameters=best_parameters)
+        optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
+        loss_func = nn.BCEWithLogitsLoss()  # the temperature is applied to the logits, not to clamped probabilities
+
+        checkpointer = tools.Checkpointer(parameters=best_parameters)
+        checkpoint = checkpointer.restore(name="distill", model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=best_parameters)
+        if early_stopping.enabled and val_data is None:
+            raise ValueError("early stopping (patience) requires val_data")
+        start_epoch = 0
+        if checkpoint is not None:
+            start_epoch = checkpoint["epoch"]
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
+        for epoch in range(start_epoch, n_epochs):
+            if early_stopping.stopped:
+                break
+            print("=== Epoch", epoch + 1, "/", n_epochs, "===")
+            model.train()
+            running_metrics = tools.RunningMetrics()
+            for i, batch in enumerate(train_loader):
+                x_batch, y_batch, index_batch = batch
+                # the prepared forward (channels last, compiled) returns logits within the context
+                with tools.autocast(parameters=best_parameters), tools.logits_output(model=model):
+                    logits = torch.flatten(model(x=x_batch)).float()
+                probas = torch.sigmoid(logits)
+                hard_loss = loss_func(logits, y_batch)
+                soft_loss = loss_func(logits / temperature, soft_targets[index_batch.to(device)])
+                # the soft loss is scaled by temperature^2 to keep its gradients comparable to the hard loss
+                batch_loss = alpha * hard_loss + (1 - alpha) * temperature ** 2 * soft_loss
+                running_metrics.update(y_true=y_batch, y_probas=probas)
                 batch_loss /= accumulation
                 batch_loss.backward()  # calculate gradients
 
@@ -187,7 +302,16 @@ class CNNWrapper:
                     optimizer.zero_grad()  # clear the gradient
 
             print("Metrics on training data after epoch", epoch + 1, ":")
-            self.predict(model=model, data=train_data, parameters=best_parameters)
+            running_metrics.compute()
+            if val_data is not None:
+                print("Metrics on validation data after epoch", epoch + 1, ":")
+                metrics = self.predict(model=model, data=val_data, parameters=best_parameters)
+                early_stopping.step(epoch=epoch + 1, metrics=metrics, model=model)
+            checkpointer.save(name="distill", epoch=epoch + 1, model=model, optimizer=optimizer,
+                              n_epochs=epoch + 1 if early_stopping.stopped else n_epochs,
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.restore_best(model=model)
         return {"model": model}
 
     def demo_one_batch(self, train_data, best_parameters):
@@ -200,26 +324,14 @@ class CNNWrapper:
         :param pd.DataFrame train_data: data on which the model has to be trained
         :param dict best_parameters: a dictionary containing the parameters defined in tools.parameters_cnn
         """
-        linear_size = best_parameters["linear_size"]
-        conv_ch1 = best_parameters["conv_ch1"]
-        conv_ch2 = best_parameters["conv_ch2"]
-        kernel_size = best_parameters["kernel_size"]
-        pooling_size = best_parameters["pooling_size"]
         n_epochs = best_parameters["n_epochs"]
         lr = best_parameters["lr"]
-        device = best_parameters["device"]
         accumulation = best_parameters["accumulation"]
 
         train_loader = self.preprocess(data=train_data, parameters=best_parameters)["loader"]
         batch = next(iter(train_loader))
 
-        linear_input_size = self.find_linear_input_size(data=train_data, parameters=best_parameters)
-        model = CNNClassifier(linear_size=linear_size,
-                              conv_ch1=conv_ch1,
-                              conv_ch2=conv_ch2,
-                              linear_input_size=linear_input_size,
-                              kernel_size=kernel_size,
-                              pooling_size=pooling_size).to(device)
+        model = self.build_model(parameters=best_parameters)
         optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
         loss_func = nn.BCELoss()
 
@@ -276,15 +388,23 @@ class CNNWrapper:
         :param dict parameters: a dictionary containing the parameters defined in tools.parameters_cnn
         :return: a dictionary containing the accuracy and roc-auc scores on both training and validation data
         """
+        return tools.run_folds(evaluate_fold=self.evaluate_fold, folds=folds, parameters=parameters)
+
+    def evaluate_fold(self, folds, fold_id, parameters):
+        """
+        Trains an isolated model on all but one fold and evaluates it on the remaining fold after every epoch.
+
+        :param list folds: a list of pd.DataFrames. Each of the DataFrames contains one fold of the data available
+        during the training time.
+        :param int fold_id: index of the validation fold in >folds<
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_cnn
+        :return: a dictionary containing the per-epoch accuracy and roc-auc scores of this fold on both training and
+        validation data
+        """
         n_epochs = parameters["n_epochs"]
         lr = parameters["lr"]
-        linear_size = parameters["linear_size"]
-        conv_ch1 = parameters["conv_ch1"]
-        conv_ch2 = parameters["conv_ch2"]
-        kernel_size = parameters["kernel_size"]
-        pooling_size = parameters["pooling_size"]
-        device = parameters["device"]
         accumulation = parameters["accumulation"]
+        train_eval_every = parameters["train_eval_every"]
 
         acc_scores_train = np.zeros(n_epochs)
         roc_auc_scores_train = np.zeros(n_epochs)
@@ -293,53 +413,63 @@ class CNNWrapper:
         roc_auc_scores = np.zeros(n_epochs)
 
         loss_func = nn.BCELoss()
-        for fold_id in range(len(folds)):
-            print("=== Fold", fold_id + 1, "/", len(folds), "===")
-            sets = tools.train_val_split(data_folds=folds, val_fold_id=fold_id)
-            train = sets["train"]
-            val = sets["val"]
-            preprocessed = self.preprocess(data=train, parameters=parameters)
-            train_loader = preprocessed["loader"]
-            linear_input_size = self.find_linear_input_size(data=folds[0], parameters=parameters)
-            model = CNNClassifier(linear_input_size=linear_input_size,
-                                  linear_size=linear_size,
-                                  conv_ch1=conv_ch1,
-                                  conv_ch2=conv_ch2,
-                                  kernel_size=kernel_size,
-                                  pooling_size=pooling_size).to(device)  # isolated model per fold
-            optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)  # depends on model
-
-            for epoch in range(1, n_epochs + 1):
-                model.train()
-                print("=== Epoch", epoch, "/", n_epochs, "===")
-                for i, batch in enumerate(train_loader):
-                    x_batch, y_batch = batch
-                    probas = torch.flatten(model(x=x_batch))  # forward
-                    batch_loss = loss_func(probas, y_batch)  # calculate loss
-                    batch_loss /= accumulation
-                    batch_loss.backward()  # calculate gradients
-
-                    if ((i + 1) % accumulation == 0) or ((i + 1) == len(train_loader)):
-                        optimizer.step()  # update parameters
-                        optimizer.zero_grad()  # clear the gradient
-
-                print("Metrics on training data after epoch", epoch, ":")
-                metrics = self.predict(model=model, data=train, parameters=parameters)
-                acc_scores_train[epoch - 1] += metrics["acc"]
-                roc_auc_scores_train[epoch - 1] += metrics["roc_auc"]
-
-                print("Metrics on validation data after epoch", epoch, ":")
-                metrics = self.predict(model=model, data=val, parameters=parameters)
-                acc_scores[epoch - 1] += metrics["acc"]
-                roc_auc_scores[epoch - 1] += metrics["roc_auc"]
-                print("\n")
+        print("=== Fold", fold_id + 1, "/", len(folds), "===")
+        sets = tools.train_val_split(data_folds=folds, val_fold_id=fold_id)
+        train = sets["train"]
+        val = sets["val"]
+        preprocessed = self.preprocess(data=train, parameters=parameters)
+        train_loader = preprocessed["loader"]
+        model = self.build_model(parameters=parameters)  # isolated model per fold
+        optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)  # depends on model
+
+        checkpointer = tools.Checkpointer(parameters=parameters)
+        checkpoint = checkpointer.restore(name="fold" + str(fold_id), model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=parameters, keep_weights=False)
+        start_epoch = 1
+        if checkpoint is not None:  # continue the interrupted fold
+            start_epoch = checkpoint["epoch"] + 1
+            acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores = checkpoint["scores"]
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:  # also when resuming a stopped fold
+                break
+            model.train()
+            print("=== Epoch", epoch, "/", n_epochs, "===")
+            running_metrics = tools.RunningMetrics()
+            for i, batch in enumerate(train_loader):
+                x_batch, y_batch = batch
+                with tools.autocast(parameters=parameters):  # bfloat16 forward if enabled
+                    probas = torch.flatten(model(x=x_batch)).float()  # forward
+                batch_loss = loss_func(probas, y_batch)  # calculate loss
+                running_metrics.update(y_true=y_batch, y_probas=probas)
+                batch_loss /= accumulation
+                batch_loss.backward()  # calculate gradients
 
-        for i in range(n_epochs):
-            acc_scores_train[i] /= len(folds)
-            roc_auc_scores_train[i] /= len(folds)
+                if ((i + 1) % accumulation == 0) or ((i + 1) == len(train_loader)):
+                    optimizer.step()  # update parameters
+                    optimizer.zero_grad()  # clear the gradient
 
-            acc_scores[i] /= len(folds)
-            roc_auc_scores[i] /= len(folds)
+            print("Metrics on training data after epoch", epoch, ":")
+            if train_eval_every is not None and epoch % train_eval_every == 0:
+                metrics = self.predict(model=model, data=train, parameters=parameters)
+            else:
+                metrics = running_metrics.compute()  # collected during the training pass
+            acc_scores_train[epoch - 1] = metrics["acc"]
+            roc_auc_scores_train[epoch - 1] = metrics["roc_auc"]
+
+            print("Metrics on validation data after epoch", epoch, ":")
+            metrics = self.predict(model=model, data=val, parameters=parameters)
+            acc_scores[epoch - 1] = metrics["acc"]
+            roc_auc_scores[epoch - 1] = metrics["roc_auc"]
+            print("\n")
+            early_stopping.step(epoch=epoch, metrics=metrics, model=model)
+            checkpointer.save(name="fold" + str(fold_id), epoch=epoch, model=model, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs,
+                              scores=(acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores),
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.carry_forward(acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores)
 
         return {"acc_scores_train": acc_scores_train, "acc_scores": acc_scores,
                 "roc_auc_scores_train": roc_auc_scores_train, "roc_auc_scores": roc_auc_scores}
@@ -359,8 +489,8 @@ class CNNWrapper:
         loader = self.preprocess(data=data, parameters=parameters)["loader"]
         for batch in loader:
             x_batch, y_batch = batch
-            with torch.no_grad():
-                probas = torch.flatten(model(x=x_batch))
+            with torch.no_grad(), tools.autocast(parameters=parameters):
+                probas = torch.flatten(model(x=x_batch)).float()
             metrics = tools.evaluate(y_true=y_batch, y_probas=probas)
             acc += metrics["acc"]
             roc_auc += metrics["roc_auc"]
@@ -372,6 +502,19 @@ class CNNWrapper:
         print("ROCAUC:", roc_auc)
         return {"acc": acc, "roc_auc": roc_auc}
 
+    def export(self, model, parameters, path):
+        """
+        Exports a trained CNNClassifier as TorchScript and ONNX for the standalone inference_runner.py.
+
+        :param CNNClassifier model: a trained CNNClassifier
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_cnn
+        :param str path: path of the exported files without file extension
+        :return: a dictionary containing the paths of the exported files
+        """
+        height, width = tools.transform_output_size(transform_pipe=parameters["transform_pipe"])
+        return tools.export_model(model=model, example_inputs={"x": torch.rand(1, 3, height, width)}, path=path,
+                                  metadata={"image_size": [height, width], "output": "probabilities"})
+
 
 # read the datasets
 folds = tools.read_folds(prefix="undersampled_img",
@@ -422,6 +565,13 @@ cnn_wrapper = CNNWrapper()
                              wrapper=cnn_wrapper,
                              folds=train_folds,
                              model_name="CNN full")'''
+# knowledge distillation from a trained PretrainedClassifier (see pretrained.py) into the small CNN
+# teacher_transform_pipe = transforms.Compose([transforms.Resize(size=[512, 512]), transforms.ToTensor()])
+# teacher_parameters = tools.parameters_pretrained(..., transform_pipe=teacher_transform_pipe)
+# teacher = torch.load("best_pretrained.pt")
+# best_cnn = cnn_wrapper.distill(train_data=train_data, best_parameters=parameters1, teacher=teacher,
+#                                teacher_parameters=teacher_parameters)["model"]
+# tools.benchmark_inference(model=best_cnn, micro_batch_size=16, image_size=(512, 512), parameters=parameters1)
 best_cnn = cnn_wrapper.fit(train_data=train_data, best_parameters=parameters1)["model"]
 print("\nPERFORMANCE ON TEST")
 cnn_wrapper.predict(model=best_cnn, data=test_fold, parameters=parameters1)
\ No newline at end of file
@@ -1,8 +1,11 @@
+import copy
+import time
+
 import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, RandomSampler
+from torch.utils.data import DataLoader, RandomSampler, TensorDataset
 from torchvision import models
 from torchvision import transforms
 from transformers import AdamW
@@ -15,14 +18,17 @@ class PretrainedClassifier(nn.Module):
     A binary classifier based on a pretrained component.
     A variety of pretrained models can be used.
     """
+    return_logits = False  # forward returns the logits instead of probabilities, see tools.logits_output
 
-    def __init__(self, linear_size, pretrained_component):
+    def __init__(self, linear_size, pretrained_component, activation_checkpoint_segments=None):
         """
         Constructor.
 
         :param int linear_size: size of the second linear layer
         :param pretrained_component: a pretrained model for image classification. All pretrained models provided by
         PyTorch provide an output tensor of size 1_000.
+        :param int activation_checkpoint_segments: number of activation checkpointing segments per stage of the
+        pretrained component. None disables activation checkpointing
         """
         super(PretrainedClassifier, self).__init__()
         if pretrained_component == "resnet":
@@ -31,14 +37,40 @@ class PretrainedClassifier(nn.Module):
             self.pretrained_component = models.densenet121(pretrained=True)
         if pretrained_component == "vgg":
             self.pretrained_component = models.vgg11(pretrained=True)
+        if activation_checkpoint_segments is not None:
+            tools.enable_activation_checkpointing(pretrained_component=self.pretrained_component,
+                                                  n_segments=activation_checkpoint_segments)
 
         self.linear1 = nn.Linear(in_features=1_000, out_features=linear_size)
         self.linear2 = nn.Linear(in_features=linear_size, out_features=1)  # binary classification -> 1 out feature
         self.sigmoid = nn.Sigmoid()
+        self.frozen = False
 
     def forward(self, x):
+        x = self.logits(x=x)
+        if self.return_logits:
+            return x
+        return self.sigmoid(x)
+
+    def logits(self, x):
+        """
+        Performs the forward pass without the final sigmoid, e.g. to soften the outputs by a temperature.
+
+        :param torch.Tensor x: the input/observations per batch
+        :return: the logits of the whole batch
+        """
         x = self.pretrained_component(x)
         x = self.linear1(x)
+        return self.linear2(x)
+
+    def head(self, x):
+        """
+        Performs the forward pass of the layers following the pretrained component.
+
+        :param torch.Tensor x: outputs of the pretrained component
+        :return: the prediction of the whole batch
+        """
+        x = self.linear1(x)
         x = self.linear2(x)
         return self.sigmoid(x)
 
@@ -49,6 +81,7 @@ class PretrainedClassifier(nn.Module):
         """
         for param in self.pretrained_component.parameters():
             param.requires_grad = False
+        self.frozen = True
 
     def unfreeze_pretrained(self):
         """
@@ -56,7 +89,8 @@ class PretrainedClassifier(nn.Module):
         Parameters are unfrozen by default and can be frozen by the function >freeze_pretrained<
         """
         for param in self.pretrained_component.parameters():
-            param.requires_grad = False
+            param.requires_grad = True
+        self.frozen = False
 
 
 class PretrainedWrapper:
@@ -74,35 +108,108 @@ class PretrainedWrapper:
         transform_pipe = parameters["transform_pipe"]
         batch_size = parameters["batch_size"]
         device = parameters["device"]
+        pixel_budget = parameters["pixel_budget"]
+
+        if pixel_budget is not None:  # batches of similar aspect ratios instead of squared images
+            batch_sampler = tools.AspectRatioBatchSampler(data=data,
+                                                          batch_size=batch_size,
+                                                          pixel_budget=pixel_budget,
+                                                          n_buckets=parameters["n_buckets"])
+            custom_dataset = tools.CustomDataset(data=data,
+                                                 transform_pipe=transform_pipe,
+                                                 device=device,
+                                                 target_sizes=batch_sampler.target_sizes)
+            return {"loader": DataLoader(dataset=custom_dataset, batch_sampler=batch_sampler)}
+
         custom_dataset = tools.CustomDataset(data=data, transform_pipe=transform_pipe, device=device)
         sampler = RandomSampler(data_source=custom_dataset)
         loader = DataLoader(dataset=custom_dataset, batch_size=batch_size, sampler=sampler)
         return {"loader": loader}
 
-    def fit(self, train_data, best_parameters):
+    def cached_feature_loader(self, model, data, parameters):
+        """
+        Creates a DataLoader that yields the (cached) outputs of the frozen pretrained component instead of images.
+        The outputs are computed once per image and stored in a memory-mapped array in
+        parameters["feature_cache_dir"], so that frozen epochs only have to train the head of the model.
+        The outputs are computed in evaluation mode, i.e. with the running statistics of the batch norms and without
+        dropout, unlike the pretrained component during uncached training epochs.
+
+        :param PretrainedClassifier model: a model having a frozen pretrained component
+        :param pd.DataFrame data: a DataFrame containing the paths to image files and the labels of the
+        respective image.
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_pretrained
+        :return: A DataLoader that loads the outputs of the pretrained component and the respective targets.
+        """
+        features = tools.cache_outputs(module=model.pretrained_component,
+                                       data=data,
+                                       parameters=parameters,
+                                       cache_dir=parameters["feature_cache_dir"],
+                                       target_sizes=tools.bucket_target_sizes(data=data, parameters=parameters))
+        x = torch.from_numpy(np.array(features)).to(parameters["device"])
+        y = torch.tensor(data["label"].values, dtype=torch.float).to(parameters["device"])
+        dataset = TensorDataset(x, y)
+        sampler = RandomSampler(data_source=dataset)
+        return DataLoader(dataset=dataset, batch_size=parameters["batch_size"], sampler=sampler)
+
+    def build_model(self, parameters):
+        """
+        Creates a PretrainedClassifier on the device given in >parameters<.
+
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_pretrained
+        :return: an untrained PretrainedClassifier
+        """
+        model = PretrainedClassifier(pretrained_component=parameters["pretrained_component"],
+                                     linear_size=parameters["linear_size"],
+                                     activation_checkpoint_segments=parameters["activation_checkpoint_segments"])
+        return tools.prepare_model(model=model.to(parameters["device"]), parameters=parameters)
+
+    def fit(self, train_data, best_parameters, val_data=None, model=None):
         """
         Trains a PretrainedClassifier on train_data using a set of parameters.
 
         :param pd.DataFrame train_data: data on which the model has to be trained
         :param dict best_parameters: a dictionary containing the parameters defined in tools.parameters_pretrained
+        :param pd.DataFrame val_data: validation data evaluated after every epoch. Required for early stopping
+        :param PretrainedClassifier model: a (e.g. pruned) model whose training is continued. None creates a new model
         :return: The trained model
         """
         n_epochs = best_parameters["n_epochs"]
         lr = best_parameters["lr"]
-        device = best_parameters["device"]
-        pretrained_component = best_parameters["pretrained_component"]
-        linear_size = best_parameters["linear_size"]
         freeze_epochs = best_parameters["freeze_epochs"]
         unfreeze_epochs = best_parameters["unfreeze_epochs"]
         accumulation = best_parameters["accumulation"]
+        train_eval_every = best_parameters["train_eval_every"]
+        feature_cache_dir = best_parameters["feature_cache_dir"]
+        resolution_schedule = best_parameters["resolution_schedule"]
 
         train_loader = self.preprocess(data=train_data, parameters=best_parameters)["loader"]
-        model = PretrainedClassifier(pretrained_component=pretrained_component, linear_size=linear_size).to(device)
+        cached_loader = None  # outputs of the frozen pretrained component, created when needed
+        current_resolution = None  # full resolution
+        epoch_parameters = best_parameters
+        if resolution_schedule is not None:
+            print("Relative training cost of the resolution schedule:",
+                  tools.resolution_schedule_cost(parameters=best_parameters))
+        if model is None:
+            model = self.build_model(parameters=best_parameters)
         optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
         loss_func = nn.BCELoss()
 
+        checkpointer = tools.Checkpointer(parameters=best_parameters)
+        checkpoint = checkpointer.restore(name="fit", model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=best_parameters)
+        if early_stopping.enabled and val_data is None:
+            raise ValueError("early stopping (patience) requires val_data")
+        start_epoch = 1
+        if checkpoint is not None:
+            start_epoch = checkpoint["epoch"] + 1
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+            if checkpoint["frozen"]:
+                model.freeze_pretrained()
+
         # train loop
-        for epoch in range(1, n_epochs + 1):
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:
+                break
             print("=== Epoch", epoch, "/", n_epochs, "===")
             if epoch in freeze_epochs:
                 print("Freeze")
@@ -110,24 +217,109 @@ class PretrainedWrapper:
             elif epoch in unfreeze_epochs:
                 print("Unfreeze")
                 model.unfreeze_pretrained()
+                cached_loader = None  # the pretrained component changes, cached outputs become invalid
+
+            resolution = tools.scheduled_resolution(resolution_schedule=resolution_schedule, epoch=epoch)
+            if resolution != current_resolution:  # progressive resizing, the training images change
+                current_resolution = resolution
+                epoch_parameters = tools.resolution_parameters(parameters=best_parameters, resolution=resolution)
+                train_loader = self.preprocess(data=train_data, parameters=epoch_parameters)["loader"]
+                accumulation = epoch_parameters["accumulation"]
+                cached_loader = None  # cached outputs belong to the previous resolution
+                print("Resolution:", "full" if resolution is None else resolution,
+                      "- batch size:", epoch_parameters["batch_size"], "- accumulation:", accumulation)
+
+            loader = train_loader
+            forward = model
+            if model.frozen and feature_cache_dir is not None:  # train the head on cached outputs
+                if cached_loader is None:
+                    cached_loader = self.cached_feature_loader(model=model, data=train_data,
+                                                               parameters=epoch_parameters)
+                loader = cached_loader
+                forward = model.head
 
             model.train()
-            for i, batch in enumerate(train_loader):
+            running_metrics = tools.RunningMetrics()
+            for i, batch in enumerate(loader):
                 x_batch, y_batch = batch
                 # model(x) = model.__call__(x) performs forward (+ more)
-                probas = torch.flatten(model(x=x_batch))
+                with tools.autocast(parameters=best_parameters):  # bfloat16 forward if enabled
+                    probas = torch.flatten(forward(x=x_batch)).float()
                 batch_loss = loss_func(probas, y_batch)  # calculate loss
+                running_metrics.update(y_true=y_batch, y_probas=probas)
                 batch_loss /= accumulation
                 batch_loss.backward()  # calculate gradients
 
-                if ((i + 1) % accumulation == 0) or ((i + 1) == len(train_loader)):
+                if ((i + 1) % accumulation == 0) or ((i + 1) == len(loader)):
                     optimizer.step()  # update parameters
                     optimizer.zero_grad()  # clear the gradient
 
             print("Metrics on training data after epoch", epoch, ":")
-            self.predict(model=model, data=train_data, parameters=best_parameters)
+            if train_eval_every is not None and epoch % train_eval_every == 0:
+                self.predict(model=model, data=train_data, parameters=best_parameters)
+            else:
+                running_metrics.compute()
+            if val_data is not None:
+                print("Metrics on validation data after epoch", epoch, ":")
+                metrics = self.predict(model=model, data=val_data, parameters=best_parameters)
+                early_stopping.step(epoch=epoch, metrics=metrics, model=model)
+            checkpointer.save(name="fit", epoch=epoch, model=model, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs, frozen=model.frozen,
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.restore_best(model=model)
         return {"model": model}
 
+    def prune(self, model, train_data, val_data, parameters, amount=0.2, n_steps=5, finetune_epochs=1,
+              batch_size=16, model_name=None):
+        """
+        Iterative structured pruning: every step removes the least important channels of the backbone (see
+        tools.prune_channels) and fine-tunes the smaller model with >fit<. The cost (GMACs, parameters, latency) and
+        the validation metrics are recorded before the first and after every step.
+
+        :param PretrainedClassifier model: a trained model (not modified)
+        :param pd.DataFrame train_data: data on which the model is fine-tuned
+        :param pd.DataFrame val_data: data on which the pruned models are evaluated
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_pretrained
+        :param float amount: share of the remaining channels of each prunable convolution removed per step
+        :param int n_steps: number of pruning steps
+        :param int finetune_epochs: number of epochs of fine-tuning after each step
+        :param int batch_size: number of images per batch for measuring the latency
+        :param str model_name: if given, the pruning curve is plotted to visuals/<model_name>_pruning
+        :return: a dictionary containing the pruned model after every step and the pruning curve (pd.DataFrame)
+        """
+        device = parameters["device"]
+        image_size = tools.transform_output_size(transform_pipe=parameters["transform_pipe"])
+        # fine-tuning starts from the pruned weights, checkpoints of other runs do not fit the pruned shapes
+        finetune_parameters = dict(parameters, n_epochs=finetune_epochs, freeze_epochs=[], unfreeze_epochs=[],
+                                   resolution_schedule=None, checkpoint_dir=None)
+
+        model = copy.deepcopy(model)
+        pruned_models = []
+        results = []
+        for step in range(n_steps + 1):
+            if step > 0:
+                print("=== Pruning step", step, "/", n_steps, "===")
+                n_removed = tools.prune_channels(module=model.pretrained_component, amount=amount)
+                print("Removed", n_removed, "channels")
+                model = self.fit(train_data=train_data, best_parameters=finetune_parameters, val_data=val_data,
+                                 model=model)["model"]
+            print("Metrics on validation data after pruning step", step, ":")
+            metrics = self.predict(model=model, data=val_data, parameters=parameters)
+            images_per_sec = tools.benchmark_inference(model=model, micro_batch_size=batch_size,
+                                                       image_size=image_size, parameters=parameters)
+            results.append({"step": step,
+                            "gmacs": tools.count_macs(model=model, image_size=image_size, device=device) / 1e9,
+                            "parameters": sum(param.numel() for param in model.parameters()),
+                            "ms_per_batch": batch_size / images_per_sec * 1000,
+                            "val_acc": metrics["acc"], "val_roc_auc": metrics["roc_auc"]})
+            pruned_models.append(copy.deepcopy(model))
+        curve = pd.DataFrame(results)
+        print(curve.to_string(index=False))
+        if model_name is not None:
+            tools.plot_pruning_curve(curve=curve, model_name=model_name)
+        return {"models": pruned_models, "curve": curve}
+
     def evaluate_hyperparameters(self, folds, parameters):
         """
         Evaluates the given parameters on multiple folds using k-fold cross validation.
@@ -135,16 +327,30 @@ class PretrainedWrapper:
         :param list folds: a list of pd.DataFrames. Each of the DataFrames contains one fold of the data available
         during the training time.
         :param dict parameters: a dictionary containing the parameters defined in tools.parameters_pretrained
-        :return: a dictionary containing the accuracy and roc-auc scores on both training and validation data
+        :return: a dictionary containing the accuracy and roc-auc scores on both training and validation data,
+        and the number of training images processed per second in each epoch
+        """
+        return tools.run_folds(evaluate_fold=self.evaluate_fold, folds=folds, parameters=parameters)
+
+    def evaluate_fold(self, folds, fold_id, parameters):
+        """
+        Trains an isolated model on all but one fold and evaluates it on the remaining fold after every epoch.
+
+        :param list folds: a list of pd.DataFrames. Each of the DataFrames contains one fold of the data available
+        during the training time.
+        :param int fold_id: index of the validation fold in >folds<
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_pretrained
+        :return: a dictionary containing the per-epoch accuracy and roc-auc scores of this fold on both training and
+        validation data
         """
-        device = parameters["device"]
         n_epochs = parameters["n_epochs"]
         lr = parameters["lr"]
-        pretrained_component = parameters["pretrained_component"]
-        linear_size = parameters["linear_size"]
         freeze_epochs = parameters["freeze_epochs"]
         unfreeze_epochs = parameters["unfreeze_epochs"]
         accumulation = parameters["accumulation"]
+        train_eval_every = parameters["train_eval_every"]
+        feature_cache_dir = parameters["feature_cache_dir"]
+        resolution_schedule = parameters["resolution_schedule"]
 
         acc_scores_train = np.zeros(n_epochs)
         roc_auc_scores_train = np.zeros(n_epochs)
@@ -152,59 +358,106 @@ class PretrainedWrapper:
         acc_scores = np.zeros(n_epochs)
         roc_auc_scores = np.zeros(n_epochs)
 
+        images_per_sec = np.zeros(n_epochs)
+
         loss_func = nn.BCELoss()
-        for fold_id in range(len(folds)):
-            print("=== Fold", fold_id + 1, "/", len(folds), "===")
-            sets = tools.train_val_split(data_folds=folds, val_fold_id=fold_id)
-            train = sets["train"]
-            val = sets["val"]
-            preprocessed = self.preprocess(data=train, parameters=parameters)
-            train_loader = preprocessed["loader"]
-            model = PretrainedClassifier(pretrained_component=pretrained_component, linear_size=linear_size).to(device)
-            optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
-
-            for epoch in range(1, n_epochs + 1):
-                print("=== Epoch", epoch, "/", n_epochs, "===")
-
-                if epoch in freeze_epochs:
-                    print("Freeze")
-                    model.freeze_pretrained()
-                elif epoch in unfreeze_epochs:
-                    print("Unfreeze")
-                    model.unfreeze_pretrained()
-
-                model.train()
-                for i, batch in enumerate(train_loader):
-                    x_batch, y_batch = batch
-                    probas = torch.flatten(model(x=x_batch))  # forward
-                    batch_loss = loss_func(probas, y_batch)  # calculate loss
-                    batch_loss /= accumulation
-                    batch_loss.backward()  # calculate gradients
-
-                    if ((i + 1) % accumulation == 0) or ((i + 1) == len(train_loader)):
-                        optimizer.step()  # update parameters
-                        optimizer.zero_grad()
-
-                print("Metrics on training data after epoch", epoch, ":")
-                metrics = self.predict(model=model, data=train, parameters=parameters)
-                acc_scores_train[epoch - 1] += metrics["acc"]
-                roc_auc_scores_train[epoch - 1] += metrics["roc_auc"]
+        print("=== Fold", fold_id + 1, "/", len(folds), "===")
+        sets = tools.train_val_split(data_folds=folds, val_fold_id=fold_id)
+        train = sets["train"]
+        val = sets["val"]
+        preprocessed = self.preprocess(data=train, parameters=parameters)
+        train_loader = preprocessed["loader"]
+        cached_loader = None
+        current_resolution = None  # full resolution
+        epoch_parameters = parameters
+        model = self.build_model(parameters=parameters)  # isolated model per fold
+        optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
 
-                print("Metrics on validation data after epoch", epoch, ":")
-                metrics = self.predict(model=model, data=val, parameters=parameters)
-                acc_scores[epoch - 1] += metrics["acc"]
-                roc_auc_scores[epoch - 1] += metrics["roc_auc"]
-                print("\n")
+        checkpointer = tools.Checkpointer(parameters=parameters)
+        checkpoint = checkpointer.restore(name="fold" + str(fold_id), model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=parameters, keep_weights=False)
+        start_epoch = 1
+        if checkpoint is not None:  # continue the interrupted fold
+            start_epoch = checkpoint["epoch"] + 1
+            acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores, images_per_sec = checkpoint["scores"]
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+            if checkpoint["frozen"]:
+                model.freeze_pretrained()
+
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:  # also when resuming a stopped fold
+                break
+            print("=== Epoch", epoch, "/", n_epochs, "===")
 
-        for i in range(n_epochs):
-            acc_scores_train[i] /= len(folds)
-            roc_auc_scores_train[i] /= len(folds)
+            if epoch in freeze_epochs:
+                print("Freeze")
+                model.freeze_pretrained()
+            elif epoch in unfreeze_epochs:
+                print("Unfreeze")
+                model.unfreeze_pretrained()
+                cached_loader = None
+
+            resolution = tools.scheduled_resolution(resolution_schedule=resolution_schedule, epoch=epoch)
+            if resolution != current_resolution:  # progressive resizing, the training images change
+                current_resolution = resolution
+                epoch_parameters = tools.resolution_parameters(parameters=parameters, resolution=resolution)
+                train_loader = self.preprocess(data=train, parameters=epoch_parameters)["loader"]
+                accumulation = epoch_parameters["accumulation"]
+                cached_loader = None  # cached outputs belong to the previous resolution
+                print("Resolution:", "full" if resolution is None else resolution,
+                      "- batch size:", epoch_parameters["batch_size"], "- accumulation:", accumulation)
+
+            loader = train_loader
+            forward = model
+            if model.frozen and feature_cache_dir is not None:
+                if cached_loader is None:
+                    cached_loader = self.cached_feature_loader(model=model, data=train,
+                                                               parameters=epoch_parameters)
+                loader = cached_loader
+                forward = model.head
 
-            acc_scores[i] /= len(folds)
-            roc_auc_scores[i] /= len(folds)
+            model.train()
+            running_metrics = tools.RunningMetrics()
+            start = time.perf_counter()
+            for i, batch in enumerate(loader):
+                x_batch, y_batch = batch
+                with tools.autocast(parameters=parameters):  # bfloat16 forward if enabled
+                    probas = torch.flatten(forward(x=x_batch)).float()  # forward
+                batch_loss = loss_func(probas, y_batch)  # calculate loss
+                running_metrics.update(y_true=y_batch, y_probas=probas)
+                batch_loss /= accumulation
+                batch_loss.backward()  # calculate gradients
+
+                if ((i + 1) % accumulation == 0) or ((i + 1) == len(loader)):
+                    optimizer.step()  # update parameters
+                    optimizer.zero_grad()
+            images_per_sec[epoch - 1] = len(train) / (time.perf_counter() - start)
+
+            print("Metrics on training data after epoch", epoch, ":")
+            if train_eval_every is not None and epoch % train_eval_every == 0:
+                metrics = self.predict(model=model, data=train, parameters=parameters)
+            else:
+                metrics = running_metrics.compute()  # collected during the training pass
+            acc_scores_train[epoch - 1] = metrics["acc"]
+            roc_auc_scores_train[epoch - 1] = metrics["roc_auc"]
+
+            print("Metrics on validation data after epoch", epoch, ":")
+            metrics = self.predict(model=model, data=val, parameters=parameters)
+            acc_scores[epoch - 1] = metrics["acc"]
+            roc_auc_scores[epoch - 1] = metrics["roc_auc"]
+            print("\n")
+            early_stopping.step(epoch=epoch, metrics=metrics, model=model)
+            checkpointer.save(name="fold" + str(fold_id), epoch=epoch, model=model, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs, frozen=model.frozen,
+                              scores=(acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores,
+                                      images_per_sec),
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.carry_forward(acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores)
 
         return {"acc_scores_train": acc_scores_train, "acc_scores": acc_scores,
-                "roc_auc_scores_train": roc_auc_scores_train, "roc_auc_scores": roc_auc_scores}
+                "roc_auc_scores_train": roc_auc_scores_train, "roc_auc_scores": roc_auc_scores,
+                "images_per_sec": images_per_sec}
 
     def predict(self, model, data, parameters):
         """
@@ -221,8 +474,8 @@ class PretrainedWrapper:
         loader = self.preprocess(data=data, parameters=parameters)["loader"]
         for batch in loader:
             x_batch, y_batch = batch
-            with torch.no_grad():
-                probas = torch.flatten(model(x=x_batch))
+            with torch.no_grad(), tools.autocast(parameters=parameters):
+                probas = torch.flatten(model(x=x_batch)).float()
             metrics = tools.evaluate(y_true=y_batch, y_probas=probas)
             acc += metrics["acc"]
             roc_auc += metrics["roc_auc"]
@@ -234,6 +487,19 @@ class PretrainedWrapper:
         print("ROCAUC:", roc_auc)
         return {"acc": acc, "roc_auc": roc_auc}
 
+    def export(self, model, parameters, path):
+        """
+        Exports a trained PretrainedClassifier as TorchScript and ONNX for the standalone inference_runner.py.
+
+        :param PretrainedClassifier model: a trained PretrainedClassifier
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_pretrained
+        :param str path: path of the exported files without file extension
+        :return: a dictionary containing the paths of the exported files
+        """
+        height, width = tools.transform_output_size(transform_pipe=parameters["transform_pipe"])
+        return tools.export_model(model=model, example_inputs={"x": torch.rand(1, 3, height, width)}, path=path,
+                                  metadata={"image_size": [height, width], "output": "probabilities"})
+
 
 # read the datasets
 folds = tools.read_folds(prefix="undersampled_img", read_path="../../data/folds_cv")
@@ -314,6 +580,44 @@ parameter_combinations = [parameters1]
 # use the model
 pretrained_wrapper = PretrainedWrapper()
 
+# choose batch_size and accumulation for an effective batch size of 32 on this machine (cached per model, resolution
+# and host)
+# parameters1 = tools.tune_micro_batch(wrapper=pretrained_wrapper, parameters=parameters1, effective_batch_size=32)
+
+# images per second of every backbone with the performance mode (channels-last, torch.compile, bfloat16) off and on
+# tools.performance_mode_benchmark(wrapper=pretrained_wrapper,
+#                                  parameter_combinations=[dict(parameters1, pretrained_component=name)
+#                                                          for name in ["resnet", "densenet", "vgg"]],
+#                                  names=["resnet", "densenet", "vgg"])
+
+# progressive resizing: train at 224x224 first and reach the full 512x512 in the last epochs
+# parameters1["resolution_schedule"] = {1: (224, 224), 5: (384, 384), 8: (512, 512)}
+
+# memory and throughput with and without activation checkpointing of the backbone
+# tools.activation_checkpointing_report(wrapper=pretrained_wrapper, parameters=parameters1,
+#                                       micro_batch_sizes=[4, 8, 16])
+
+'''
+# aspect ratio bucketing vs. squared images (same amount of pixels per image)
+transform_pipe_bucketed = transforms.Compose([transforms.ToTensor()])
+parameters_bucketed = tools.parameters_pretrained(n_epochs=2,
+                                                  lr=0.0001,
+                                                  batch_size=16,
+                                                  transform_pipe=transform_pipe_bucketed,
+                                                  pretrained_component="resnet",
+                                                  linear_size=16,
+                                                  freeze_epochs=[],
+                                                  unfreeze_epochs=[],
+                                                  accumulation=2,
+                                                  device=device,
+                                                  pixel_budget=512 * 512,
+                                                  n_buckets=8)
+tools.throughput_comparison(parameter_combinations=[parameters1, parameters_bucketed],
+                            names=["square", "bucketed"],
+                            wrapper=pretrained_wrapper,
+                            folds=train_folds)
+'''
+
 '''tools.performance_comparison(parameter_combinations=parameter_combinations,
                              wrapper=pretrained_wrapper,
                              folds=train_folds,
@@ -323,3 +627,17 @@ best_cnn = pretrained_wrapper.fit(train_data=train_data, best_parameters=paramet
 print("\nPERFORMANCE ON TEST")
 
 pretrained_wrapper.predict(model=best_cnn, data=test_fold, parameters=parameters1)
+
+# iterative structured pruning of the backbone, fine-tuning one epoch after each step
+# pruned = pretrained_wrapper.prune(model=best_cnn, train_data=train_data, val_data=train_folds[-1],
+#                                   parameters=parameters1, amount=0.2, n_steps=5, model_name="resnet")
+
+# int8 model for cpu-only inference hosts: calibrate on training images, compare with the float model on test
+# quantized_cnn = tools.quantize_static(model=best_cnn, data=train_data, parameters=parameters1,
+#                                       export_path="best_pretrained_int8.pt")
+# tools.quantization_report(wrapper=pretrained_wrapper, float_model=best_cnn, quantized_model=quantized_cnn,
+#                           data=test_fold, parameters=parameters1)
+
+# TorchScript/ONNX files for inference_runner.py, which does not need this training script
+# exported = pretrained_wrapper.export(model=best_cnn, parameters=parameters1, path="best_pretrained")
+# tools.export_report(model=best_cnn, example_inputs={"x": torch.rand(1, 3, 512, 512)}, path="best_pretrained")
@@ -1,3 +1,12 @@
+import contextlib
+import hashlib
+import io
+import json
+import os
+import socket
+import sys
+import time
+
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -5,7 +14,13 @@ import torch
 from PIL import Image
 from sklearn.metrics import accuracy_score
 from sklearn.metrics import roc_auc_score
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler
+from torchvision import transforms
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # shared_tools.py lives in the root
+from shared_tools import (  # noqa: E402
+    Checkpointer, EarlyStopping, autocast, cpu_float_copy, cpu_supports_bf16, enable_activation_checkpointing,
+    export_model, export_report, prepare_model, run_folds, transform_output_size)
 
 
 def select_device():
@@ -87,13 +102,138 @@ def train_val_split(data_folds, val_fold_id):
     return {"train": train_data, "val": val_data}
 
 
+def resize_transform(transform_pipe, size):
+    """
+    Replaces the output size of all Resize steps of a transformation pipeline.
+
+    :param transform_pipe: a transforms.Compose of the transformations that are applied to the images
+    :param tuple size: the new (height, width) of the resized images
+    :return: a new transforms.Compose resizing the images to >size<
+    """
+    if not any(isinstance(transform, transforms.Resize) for transform in transform_pipe.transforms):
+        raise ValueError("the transformation pipeline does not contain a Resize step")
+    return transforms.Compose([transforms.Resize(size=[size[0], size[1]]) if isinstance(transform, transforms.Resize)
+                               else transform for transform in transform_pipe.transforms])
+
+
+def scheduled_resolution(resolution_schedule, epoch):
+    """
+    Looks up the training resolution of an epoch in a resolution schedule.
+
+    :param dict resolution_schedule: a dictionary mapping epochs to the (height, width) (or side length) used from
+    this epoch on. None or epochs before the first entry train at the full resolution
+    :param int epoch: the current epoch (starting at 1)
+    :return: a tuple containing the height and width of the epoch, None for the full resolution
+    """
+    if resolution_schedule is None:
+        return None
+    started = [start for start in resolution_schedule if start <= epoch]
+    if len(started) == 0:
+        return None
+    resolution = resolution_schedule[max(started)]
+    if isinstance(resolution, int):
+        return resolution, resolution
+    return int(resolution[0]), int(resolution[1])
+
+
+def full_resolution_pixels(parameters):
+    """
+    :param dict parameters: a dictionary containing the parameters defined in tools.parameters_pretrained
+    :return: the number of pixels per image at the full (target) resolution
+    """
+    if parameters["pixel_budget"] is not None:
+        return parameters["pixel_budget"]
+    height, width = transform_output_size(transform_pipe=parameters["transform_pipe"])
+    return height * width
+
+
+def resolution_parameters(parameters, resolution):
+    """
+    Adapts the parameters to train at a lower resolution. The images are resized to >resolution<, the micro-batch
+    size grows with the saved pixels, keeping the memory footprint of a batch roughly constant, and the accumulation
+    shrinks accordingly, keeping the effective batch size (batch_size * accumulation).
+
+    :param dict parameters: a dictionary containing the parameters defined in tools.parameters_pretrained
+    :param tuple resolution: (height, width) of the training images, None for the full resolution
+    :return: a copy of >parameters< for training at >resolution<
+    """
+    if resolution is None:
+        return parameters
+    pixels = resolution[0] * resolution[1]
+    effective_batch_size = parameters["batch_size"] * parameters["accumulation"]
+    batch_size = parameters["batch_size"] * full_resolution_pixels(parameters=parameters) // pixels
+    batch_size = max(1, min(batch_size, effective_batch_size))
+    scaled_parameters = dict(parameters, batch_size=batch_size,
+                             accumulation=max(1, round(effective_batch_size / batch_size)))
+    if parameters["pixel_budget"] is not None:  # the buckets are scaled to the lower pixel budget
+        scaled_parameters["pixel_budget"] = pixels
+    else:
+        scaled_parameters["transform_pipe"] = resize_transform(transform_pipe=parameters["transform_pipe"],
+                                                               size=resolution)
+    return scaled_parameters
+
+
+def resolution_schedule_cost(parameters):
+    """
+    Estimates the training cost of a resolution schedule relative to training every epoch at the full resolution.
+    The cost of a convolutional network grows linearly with the number of pixels.
+
+    :param dict parameters: a dictionary containing the parameters defined in tools.parameters_pretrained
+    :return: the relative cost (1.0 without a schedule)
+    """
+    full_pixels = full_resolution_pixels(parameters=parameters)
+    cost = 0
+    for epoch in range(1, parameters["n_epochs"] + 1):
+        resolution = scheduled_resolution(resolution_schedule=parameters["resolution_schedule"], epoch=epoch)
+        cost += 1 if resolution is None else resolution[0] * resolution[1] / full_pixels
+    return cost / parameters["n_epochs"]
+
+
+class RunningMetrics:
+    """
+    Collects the predictions and labels of the training pass, so that the metrics on the training data can be
+    reported without predicting the whole training set again.
+    The predictions are made while the model is in training mode (e.g. dropout is active) and while its parameters
+    are still being updated, so the metrics differ slightly from those of a separate prediction after the epoch.
+    """
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self.y_true = []
+        self.y_probas = []
+
+    def update(self, y_true, y_probas):
+        """
+        Stores the labels and the predicted class probabilities of one batch.
+
+        :param torch.Tensor y_true: true labels
+        :param torch.Tensor y_probas: predicted class probabilities
+        """
+        self.y_true.append(y_true.detach().cpu())
+        self.y_probas.append(y_probas.detach().cpu())
+
+    def compute(self):
+        """
+        Evaluates all stored predictions.
+
+        :return: a dictionary containing the accuracy and roc-auc score
+        """
+        metrics = evaluate(y_true=torch.cat(self.y_true), y_probas=torch.cat(self.y_probas).float())
+        print("Accuracy:", metrics["acc"])
+        print("ROCAUC:", metrics["roc_auc"])
+        return metrics
+
+
 class CustomDataset(Dataset):
     """
     A custom Image Dataset that performs transformations on the images contained in it and shifts them to
     a given device.
     """
 
-    def __init__(self, data, transform_pipe, x_name="img", y_name="label", device="cuda"):
+    def __init__(self, data, transform_pipe, x_name="img", y_name="label", device="cuda", target_sizes=None,
+                 return_index=False):
         """
         Constructor.
 
@@ -102,12 +242,17 @@ class CustomDataset(Dataset):
         :param str x_name: name of the image column
         :param str y_name: name of the label column
         :param str device: name of the device that has to be used
+        :param np.ndarray target_sizes: optional array of shape (len(data), 2) containing the height and width
+        each image is resized to before >transform_pipe< is applied (e.g. AspectRatioBatchSampler.target_sizes)
+        :param bool return_index: whether each observation also contains its index, e.g. to look up cached targets
         """
         self.data = data
         self.transform_pipe = transform_pipe
         self.x_name = x_name
         self.y_name = y_name
         self.device = device
+        self.target_sizes = target_sizes
+        self.return_index = return_index
 
     def __len__(self):
         """
@@ -122,19 +267,341 @@ class CustomDataset(Dataset):
         Is used by DataLoaders to draw the observation at index i in the dataset.
 
         :param int i: index of an observation
-        :return: a list containing the image-data and the label of one observation
+        :return: a list containing the image-data and the label (and the index) of one observation
         """
         img_path = "../../data/hateful_memes_data/" + self.data[self.x_name].iloc[i]
-        x = self.transform_pipe(Image.open(img_path, formats=["PNG"])).to(self.device)
+        image = Image.open(img_path, formats=["PNG"])
+        if self.target_sizes is not None:
+            image = transforms.Resize(size=[int(side) for side in self.target_sizes[i]])(image)
+        x = self.transform_pipe(image).to(self.device)
         if x.size(0) == 4:  # very few images have one more channel, change to RGB format
-            image = Image.open(img_path, formats=["PNG"]).convert("RGB")
+            image = image.convert("RGB")
             x = self.transform_pipe(image).to(self.device)
         y = torch.tensor(self.data[self.y_name][i], dtype=torch.float).to(self.device)
+        if self.return_index:
+            return [x, y, i]
         return [x, y]
 
 
+def cache_outputs(module, data, parameters, cache_dir, batch_size=64, target_sizes=None, logits=False):
+    """
+    Computes the outputs of a module for each image in >data< once and stores them in a memory-mapped .npy file.
+    The file name is derived from the images, their target sizes, the transformation pipeline and the weights of the
+    module, so the cached outputs are reused as long as none of them changes.
+
+    :param nn.Module module: a module mapping batches of images to batches of representations
+    :param pd.DataFrame data: a DataFrame containing the paths to image files and the labels of the respective image.
+    :param dict parameters: a dictionary containing at least "transform_pipe" and "device"
+    :param str cache_dir: the directory in which the outputs are stored
+    :param int batch_size: number of images per forward pass
+    :param np.ndarray target_sizes: optional array of shape (len(data), 2) containing the height and width each image
+    is resized to before >transform_pipe< is applied (see bucket_target_sizes). Each forward pass only contains images
+    of the same target size then
+    :param bool logits: whether the logits of a classifier are cached instead of its probabilities (see
+    logits_output)
+    :return: a read-only np.memmap of shape (len(data), output size). Row i holds the output for the image in row i
+    """
+    transform_pipe = parameters["transform_pipe"]
+    if any(type(transform).__name__.startswith(("Random", "Color")) for transform in transform_pipe.transforms):
+        raise ValueError("cached outputs require a deterministic transformation pipeline")
+
+    fingerprint = hashlib.sha1()
+    fingerprint.update("|".join(data["img"].astype(str)).encode())
+    fingerprint.update(repr(transform_pipe).encode())
+    fingerprint.update(b"logits" if logits else b"forward")
+    if target_sizes is not None:
+        fingerprint.update(np.ascontiguousarray(target_sizes, dtype=np.int64).tobytes())
+    for tensor in module.state_dict().values():
+        fingerprint.update(tensor.detach().cpu().numpy().tobytes())
+    path = os.path.join(cache_dir, fingerprint.hexdigest() + ".npy")
+    if os.path.exists(path):
+        return np.load(path, mmap_mode="r")
+
+    print("Caching outputs of", len(data), "images in", path)
+    os.makedirs(cache_dir, exist_ok=True)
+    custom_dataset = CustomDataset(data=data.reset_index(drop=True), transform_pipe=transform_pipe,
+                                   device=parameters["device"], target_sizes=target_sizes)
+    if target_sizes is None:
+        batches = [list(range(start, min(start + batch_size, len(data)))) for start in range(0, len(data), batch_size)]
+    else:  # the images of one batch have to share their size
+        batches = []
+        for size in np.unique(target_sizes, axis=0):
+            rows = np.flatnonzero((target_sizes == size).all(axis=1))
+            batches += [rows[start:start + batch_size].tolist() for start in range(0, len(rows), batch_size)]
+    loader = DataLoader(dataset=custom_dataset, batch_sampler=batches)  # fixed order, batches[i] <-> i-th batch
+    was_training = module.training
+    module.eval()
+    outputs = None
+    tmp_path = path + ".tmp.npy"
+    with torch.no_grad(), logits_output(model=module) if logits else contextlib.nullcontext():
+        for rows, (x_batch, _) in zip(batches, loader):
+            output = module(x_batch).float().cpu().numpy()
+            if outputs is None:
+                outputs = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                                    shape=(len(data), output.shape[1]))
+            outputs[rows] = output
+    module.train(was_training)
+    outputs.flush()
+    del outputs
+    os.replace(tmp_path, path)  # atomic, an interrupted run never leaves an incomplete cache behind
+    return np.load(path, mmap_mode="r")
+
+
+@contextlib.contextmanager
+def logits_output(model):
+    """
+    Makes a classifier having a >return_logits< switch (CNNClassifier, PretrainedClassifier) return the logits instead
+    of probabilities within the context. The logits are computed by the regular forward pass, including the hooks and
+    the compiled forward installed by prepare_model.
+
+    :param torch.nn.Module model: the classifier
+    :return: a context manager yielding the classifier
+    """
+    model.return_logits = True
+    try:
+        yield model
+    finally:
+        model.return_logits = False
+
+
+class AspectRatioBatchSampler(Sampler):
+    """
+    A batch sampler that groups images of similar aspect ratio into the same batches.
+    Every group (bucket) of images is resized to one shared shape that approximately contains >pixel_budget< pixels
+    and preserves the median aspect ratio of the bucket, so the images are neither padded nor heavily distorted.
+    """
+
+    def __init__(self, data, batch_size, pixel_budget, n_buckets=8, x_name="img", multiple=32):
+        """
+        Constructor.
+
+        :param pd.DataFrame data: A DataFrame containing one column of image paths
+        :param int batch_size: maximum number of observations per batch
+        :param int pixel_budget: number of pixels (height * width) each resized image should approximately have
+        :param int n_buckets: number of aspect ratio buckets. Each bucket contains roughly the same amount of images
+        :param str x_name: name of the image column
+        :param int multiple: height and width of each bucket are rounded to a multiple of this value
+        """
+        self.batch_size = batch_size
+
+        # only the image headers are read to obtain the sizes
+        ratios = np.zeros(len(data))
+        for i, img_path in enumerate(data[x_name]):
+            width, height = Image.open("../../data/hateful_memes_data/" + img_path).size
+            ratios[i] = width / height
+
+        order = np.argsort(ratios)
+        self.buckets = [bucket for bucket in np.array_split(order, min(n_buckets, len(data))) if len(bucket) > 0]
+        self.target_sizes = np.zeros((len(data), 2), dtype=int)
+        for bucket in self.buckets:
+            ratio = np.median(ratios[bucket])
+            height = max(multiple, int(round(np.sqrt(pixel_budget / ratio) / multiple)) * multiple)
+            width = max(multiple, int(round(height * ratio / multiple)) * multiple)
+            self.target_sizes[bucket] = [height, width]
+
+    def __iter__(self):
+        """
+        Shuffles the images within each bucket, splits the buckets into batches and shuffles the order of the batches.
+
+        :return: an iterator over lists of indices. Each list forms one batch
+        """
+        batches = []
+        for bucket in self.buckets:
+            shuffled = np.random.permutation(bucket)
+            for start in range(0, len(shuffled), self.batch_size):
+                batches.append(shuffled[start:start + self.batch_size].tolist())
+        for batch_id in np.random.permutation(len(batches)):
+            yield batches[batch_id]
+
+    def __len__(self):
+        """
+        Returns the number of batches per epoch.
+
+        :return: the number of batches
+        """
+        return int(sum(np.ceil(len(bucket) / self.batch_size) for bucket in self.buckets))
+
+
+def bucket_target_sizes(data, parameters):
+    """
+    Returns the size each image is resized to by aspect ratio bucketing, e.g. to cache outputs at the bucketed
+    training resolution.
+
+    :param pd.DataFrame data: A DataFrame containing one column of image paths
+    :param dict parameters: a dictionary containing the parameters defined in tools.parameters_pretrained or
+    tools.parameters_cnn
+    :return: the target_sizes of an AspectRatioBatchSampler over >data<, None if no "pixel_budget" is given
+    """
+    if parameters.get("pixel_budget") is None:
+        return None
+    return AspectRatioBatchSampler(data=data, batch_size=parameters["batch_size"],
+                                   pixel_budget=parameters["pixel_budget"],
+                                   n_buckets=parameters["n_buckets"]).target_sizes
+
+
+def prunable_conv_pairs(module):
+    """
+    Finds pairs of convolutions whose output channels can be removed without changing the output shape of the
+    surrounding block: the first convolution feeds the second one directly (or through a batch norm, activation or
+    pooling). These are the internal convolutions of ResNet and DenseNet blocks and consecutive convolutions of VGG.
+
+    :param torch.nn.Module module: a torchvision backbone
+    :return: a list of tuples (parent module, name of the first convolution, name of the batch norm in between or
+    None, name of the second convolution)
+    """
+    pairs = []
+    for submodule in module.modules():
+        name = type(submodule).__name__
+        if name in ("BasicBlock", "Bottleneck"):
+            pairs.append((submodule, "conv1", "bn1", "conv2"))
+            if name == "Bottleneck":
+                pairs.append((submodule, "conv2", "bn2", "conv3"))
+        elif name == "_DenseLayer":
+            pairs.append((submodule, "conv1", "norm2", "conv2"))
+        elif isinstance(submodule, torch.nn.Sequential):
+            children = list(submodule.named_children())
+            for i, (conv_name, conv) in enumerate(children):
+                if not isinstance(conv, torch.nn.Conv2d):
+                    continue
+                bn_name = None
+                for next_name, next_module in children[i + 1:]:
+                    if isinstance(next_module, torch.nn.BatchNorm2d):
+                        bn_name = next_name
+                    elif isinstance(next_module, torch.nn.Conv2d):
+                        pairs.append((submodule, conv_name, bn_name, next_name))
+                        break
+                    elif not isinstance(next_module, (torch.nn.ReLU, torch.nn.MaxPool2d)):
+                        break
+    return [pair for pair in pairs if getattr(pair[0], pair[1]).groups == 1 and getattr(pair[0], pair[3]).groups == 1]
+
+
+def prune_conv(conv, keep, dim):
+    """
+    Creates a smaller copy of a convolution that only contains the kept output (dim=0) or input (dim=1) channels.
+
+    :param torch.nn.Conv2d conv: the convolution
+    :param torch.Tensor keep: indices of the kept channels
+    :param int dim: 0 to prune output channels, 1 to prune input channels
+    :return: the pruned torch.nn.Conv2d
+    """
+    pruned = torch.nn.Conv2d(in_channels=len(keep) if dim == 1 else conv.in_channels,
+                             out_channels=len(keep) if dim == 0 else conv.out_channels,
+                             kernel_size=conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                             dilation=conv.dilation, bias=conv.bias is not None,
+                             padding_mode=conv.padding_mode).to(conv.weight.device)
+    with torch.no_grad():
+        pruned.weight.copy_(conv.weight.index_select(dim, keep))
+        if conv.bias is not None:
+            pruned.bias.copy_(conv.bias[keep] if dim == 0 else conv.bias)
+    pruned.weight.requires_grad = conv.weight.requires_grad
+    if conv.bias is not None:
+        pruned.bias.requires_grad = conv.bias.requires_grad
+    return pruned
+
+
+def prune_batch_norm(batch_norm, keep):
+    """
+    Creates a smaller copy of a batch norm that only contains the kept channels.
+
+    :param torch.nn.BatchNorm2d batch_norm: the batch norm
+    :param torch.Tensor keep: indices of the kept channels
+    :return: the pruned torch.nn.BatchNorm2d
+    """
+    pruned = torch.nn.BatchNorm2d(num_features=len(keep), eps=batch_norm.eps,
+                                  momentum=batch_norm.momentum).to(batch_norm.weight.device)
+    with torch.no_grad():
+        pruned.weight.copy_(batch_norm.weight[keep])
+        pruned.bias.copy_(batch_norm.bias[keep])
+        pruned.running_mean.copy_(batch_norm.running_mean[keep])
+        pruned.running_var.copy_(batch_norm.running_var[keep])
+    pruned.weight.requires_grad = batch_norm.weight.requires_grad
+    pruned.bias.requires_grad = batch_norm.bias.requires_grad
+    return pruned
+
+
+def prune_channels(module, amount):
+    """
+    Structured pruning: removes the least important output channels of every prunable convolution (see
+    >prunable_conv_pairs<) together with the matching channels of the following batch norm and convolution.
+    The importance of a channel is the L1 norm of its filter, scaled by the absolute batch norm weight.
+    The channels are physically removed, so the result is a smaller dense model.
+
+    :param torch.nn.Module module: a torchvision backbone (modified in place)
+    :param float amount: share of the channels of each convolution that is removed
+    :return: the number of removed channels
+    """
+    n_removed = 0
+    for parent, conv_name, bn_name, next_name in prunable_conv_pairs(module=module):
+        conv = getattr(parent, conv_name)
+        importance = conv.weight.detach().abs().sum(dim=(1, 2, 3))
+        if bn_name is not None:
+            importance = importance * getattr(parent, bn_name).weight.detach().abs()
+        n_keep = max(1, int(round(conv.out_channels * (1 - amount))))
+        keep = torch.argsort(importance, descending=True)[:n_keep].sort().values
+        setattr(parent, conv_name, prune_conv(conv=conv, keep=keep, dim=0))
+        if bn_name is not None:
+            setattr(parent, bn_name, prune_batch_norm(batch_norm=getattr(parent, bn_name), keep=keep))
+        setattr(parent, next_name, prune_conv(conv=getattr(parent, next_name), keep=keep, dim=1))
+        n_removed += conv.out_channels - n_keep
+    return n_removed
+
+
+def count_macs(model, image_size, device):
+    """
+    Counts the multiply-accumulate operations of the convolutions and linear layers of a model for one image.
+
+    :param torch.nn.Module model: the model
+    :param tuple image_size: (height, width) of the image
+    :param str device: name of the utilized device (either cpu or cuda)
+    :return: the number of multiply-accumulate operations
+    """
+    macs = []
+
+    def count(module, inputs, output):
+        if isinstance(module, torch.nn.Conv2d):
+            kernel_height, kernel_width = module.kernel_size
+            macs.append(output.numel() * module.in_channels // module.groups * kernel_height * kernel_width)
+        else:
+            macs.append(module.in_features * module.out_features)
+
+    hooks = [module.register_forward_hook(count) for module in model.modules()
+             if isinstance(module, (torch.nn.Conv2d, torch.nn.Linear))]
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(x=torch.rand(1, 3, image_size[0], image_size[1], device=device))
+    model.train(was_training)
+    for hook in hooks:
+        hook.remove()
+    return sum(macs)
+
+
+def plot_pruning_curve(curve, model_name):
+    """
+    Plots the validation ROC-AUC against the GMACs and the latency of every pruning step and saves the plot in
+    visuals/.
+
+    :param pd.DataFrame curve: the pruning curve created by PretrainedWrapper.prune
+    :param str model_name: name of the model
+    """
+    fig, axs = plt.subplots(2, figsize=(5, 10))
+    fig.suptitle(f"{model_name} pruning")
+    for ax, column, label in [(axs[0], "gmacs", "GMACs per image"), (axs[1], "ms_per_batch", "ms per batch")]:
+        ax.plot(curve[column], curve["val_roc_auc"], c="blue", marker="o")
+        for step, x, y in zip(curve["step"], curve[column], curve["val_roc_auc"]):
+            ax.annotate(str(step), (x, y))
+        ax.set_xlabel(label)
+        ax.set_ylabel("Validation ROC-AUC")
+    plt.tight_layout(pad=3)
+    plt.savefig("visuals/" + model_name + "_pruning")
+
+
 def parameters_cnn(n_epochs, lr, batch_size, transform_pipe, conv_ch1, conv_ch2, linear_size, kernel_size,
-                   pooling_size, accumulation, device):
+                   pooling_size, accumulation, device, train_eval_every=None, n_fold_workers=1,
+                   threads_per_worker=None, checkpoint_dir=None, checkpoint_every=1, resume=False, patience=None,
+                   min_delta=0.0, stopping_metric="roc_auc", best_weights_path=None, channels_last=False,
+                   compile_model=False, bf16=False, distill_alpha=0.5, distill_temperature=2.0,
+                   teacher_cache_dir="teacher_cache"):
     """
     Creates a dictionary containing the necessary preprocessing, model and training parameters for the CNNWrapper.
 
@@ -150,15 +617,46 @@ def parameters_cnn(n_epochs, lr, batch_size, transform_pipe, conv_ch1, conv_ch2,
     :param int kernel_size: width and height of the convolutional kernels / filters / windows.
     :param int pooling_size: width and height of the maximum pooling window
     :param str device: name of the utilized device (either cpu or cuda)
+    :param int train_eval_every: the metrics on the training data are collected during the training pass. If given,
+    the whole training data is predicted again every >train_eval_every< epochs instead
+    :param int n_fold_workers: number of folds evaluated in parallel by separate processes (cpu only)
+    :param int threads_per_worker: number of torch threads per fold worker. Defaults to cores / n_fold_workers
+    :param str checkpoint_dir: directory in which training checkpoints are written. None disables checkpoints
+    :param int checkpoint_every: number of epochs between two checkpoints
+    :param bool resume: whether training runs continue from their checkpoints in >checkpoint_dir<
+    :param int patience: number of epochs without improvement of the validation metric after which training stops.
+    None disables early stopping
+    :param float min_delta: minimal increase of the validation metric that counts as an improvement
+    :param str stopping_metric: name of the validation metric that drives early stopping
+    :param str best_weights_path: file in which the weights of the best epoch are kept. None keeps them in memory
+    :param bool channels_last: whether the model and its inputs use the channels-last memory format
+    :param bool compile_model: whether the forward pass of the model is compiled with torch.compile
+    :param bool bf16: whether forward passes use bfloat16 autocast (only on devices supporting bfloat16 natively)
+    :param float distill_alpha: weight of the loss on the true labels in CNNWrapper.distill. The loss on the soft
+    targets of the teacher is weighted by 1 - distill_alpha
+    :param float distill_temperature: temperature softening the probabilities in CNNWrapper.distill
+    :param str teacher_cache_dir: directory in which the outputs of the teacher are cached by CNNWrapper.distill
     :return: a dictionary containing all parameters having their names as keys.
     """
     return {"n_epochs": n_epochs, "lr": lr, "batch_size": batch_size, "transform_pipe": transform_pipe,
             "conv_ch1": conv_ch1, "conv_ch2": conv_ch2, "linear_size": linear_size, "kernel_size": kernel_size,
-            "pooling_size": pooling_size, "accumulation": accumulation, "device": device}
+            "pooling_size": pooling_size, "accumulation": accumulation, "device": device,
+            "train_eval_every": train_eval_every,
+            "n_fold_workers": n_fold_workers, "threads_per_worker": threads_per_worker,
+            "checkpoint_dir": checkpoint_dir, "checkpoint_every": checkpoint_every, "resume": resume,
+            "patience": patience, "min_delta": min_delta, "stopping_metric": stopping_metric,
+            "best_weights_path": best_weights_path,
+            "channels_last": channels_last, "compile_model": compile_model, "bf16": bf16,
+            "distill_alpha": distill_alpha, "distill_temperature": distill_temperature,
+            "teacher_cache_dir": teacher_cache_dir}
 
 
 def parameters_pretrained(n_epochs, lr, batch_size, transform_pipe, pretrained_component, linear_size, freeze_epochs,
-                          unfreeze_epochs, accumulation, device):
+                          unfreeze_epochs, accumulation, device, pixel_budget=None, n_buckets=8,
+                          feature_cache_dir=None, train_eval_every=None, n_fold_workers=1, threads_per_worker=None,
+                          checkpoint_dir=None, checkpoint_every=1, resume=False, patience=None, min_delta=0.0,
+                          stopping_metric="roc_auc", best_weights_path=None, activation_checkpoint_segments=None,
+                          resolution_schedule=None, channels_last=False, compile_model=False, bf16=False):
     """
     Creates a dictionary containing the necessary preprocessing,
     model and training parameters for the PretrainedWrapper.
@@ -176,11 +674,47 @@ def parameters_pretrained(n_epochs, lr, batch_size, transform_pipe, pretrained_c
     has to be unfrozen
     :param int accumulation: number of batches accumulated to form a single gradient per parameter
     :param str device: name of the utilized device (either cpu or cuda)
+    :param int pixel_budget: if given, images are batched by aspect ratio (AspectRatioBatchSampler) and each batch
+    is resized to a shared shape having roughly this many pixels. >transform_pipe< must not resize the images then
+    :param int n_buckets: number of aspect ratio buckets, only used if >pixel_budget< is given
+    :param str feature_cache_dir: if given, the outputs of the frozen pretrained component are computed once per
+    image, stored in this directory and used to train the head during frozen epochs.
+    >transform_pipe< has to be deterministic then. The outputs are computed in evaluation mode (batch norm running
+    statistics, no dropout), while frozen epochs without the cache run the pretrained component in training mode,
+    so the cache changes the inputs of the head slightly
+    :param int train_eval_every: the metrics on the training data are collected during the training pass. If given,
+    the whole training data is predicted again every >train_eval_every< epochs instead
+    :param int n_fold_workers: number of folds evaluated in parallel by separate processes (cpu only)
+    :param int threads_per_worker: number of torch threads per fold worker. Defaults to cores / n_fold_workers
+    :param str checkpoint_dir: directory in which training checkpoints are written. None disables checkpoints
+    :param int checkpoint_every: number of epochs between two checkpoints
+    :param bool resume: whether training runs continue from their checkpoints in >checkpoint_dir<
+    :param int patience: number of epochs without improvement of the validation metric after which training stops.
+    None disables early stopping
+    :param float min_delta: minimal increase of the validation metric that counts as an improvement
+    :param str stopping_metric: name of the validation metric that drives early stopping
+    :param str best_weights_path: file in which the weights of the best epoch are kept. None keeps them in memory
+    :param int activation_checkpoint_segments: number of activation checkpointing segments per stage of the pretrained
+    component. Saves memory (allowing larger batches) at the cost of recomputation. None disables it
+    :param dict resolution_schedule: progressive resizing. A dictionary mapping epochs to the resolution (height, width)
+    used from this epoch on, e.g. {1: (224, 224), 4: (384, 384), 7: (512, 512)}. Lower resolutions train with larger
+    micro-batches and less accumulation. Validation always uses the full resolution. None disables the schedule
+    :param bool channels_last: whether the model and its inputs use the channels-last memory format
+    :param bool compile_model: whether the forward pass of the model is compiled with torch.compile
+    :param bool bf16: whether forward passes use bfloat16 autocast (only on devices supporting bfloat16 natively)
     :return: a dictionary containing all parameters having their names as keys.
     """
     return {"n_epochs": n_epochs, "lr": lr, "batch_size": batch_size, "transform_pipe": transform_pipe,
             "pretrained_component": pretrained_component, "linear_size": linear_size, "freeze_epochs": freeze_epochs,
-            "unfreeze_epochs": unfreeze_epochs, "accumulation": accumulation, "device": device}
+            "unfreeze_epochs": unfreeze_epochs, "accumulation": accumulation, "device": device,
+            "pixel_budget": pixel_budget, "n_buckets": n_buckets, "feature_cache_dir": feature_cache_dir,
+            "train_eval_every": train_eval_every,
+            "n_fold_workers": n_fold_workers, "threads_per_worker": threads_per_worker,
+            "checkpoint_dir": checkpoint_dir, "checkpoint_every": checkpoint_every, "resume": resume,
+            "patience": patience, "min_delta": min_delta, "stopping_metric": stopping_metric,
+            "best_weights_path": best_weights_path, "activation_checkpoint_segments": activation_checkpoint_segments,
+            "resolution_schedule": resolution_schedule,
+            "channels_last": channels_last, "compile_model": compile_model, "bf16": bf16}
 
 
 def performance_comparison(parameter_combinations, wrapper, folds, model_name):
@@ -232,3 +766,367 @@ def performance_comparison(parameter_combinations, wrapper, folds, model_name):
 
         plt.tight_layout(pad=3)
         plt.savefig("visuals/" + model_name + "_combi_" + str(i + 1))
+
+
+def throughput_comparison(parameter_combinations, names, wrapper, folds):
+    """
+    Compares the per-epoch training throughput and validation performance of multiple parameter combinations
+    (e.g. square resizing vs. aspect ratio bucketing) using k-fold cross validation.
+
+    :param list parameter_combinations: a list of parameter combinations used by the model.
+    :param list names: a list containing one name per parameter combination
+    :param wrapper: a model-wrapper whose evaluate_hyperparameters reports "images_per_sec"
+    :param list folds: the data folds on which the model parameters have to be evaluated
+    :return: a pd.DataFrame containing the training images per second, the validation accuracy and the validation
+    roc-auc score of each parameter combination per epoch
+    """
+    results = []
+    for name, parameters in zip(names, parameter_combinations):
+        metrics = wrapper.evaluate_hyperparameters(folds=folds, parameters=parameters)
+        results.append(pd.DataFrame({"name": name,
+                                     "epoch": np.arange(1, len(metrics["acc_scores"]) + 1),
+                                     "images_per_sec": metrics["images_per_sec"],
+                                     "val_acc": metrics["acc_scores"],
+                                     "val_roc_auc": metrics["roc_auc_scores"]}))
+    results = pd.concat(results, ignore_index=True)
+    print(results.to_string(index=False))
+    return results
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory (VmHWM) of the process, so that it can be measured for a single probe.
+    Only available on linux.
+
+    :return: True if the peak was reset, False otherwise
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss():
+    """
+    :return: the peak resident memory of the process in bytes since the last >reset_peak_rss<
+    """
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024  # kilobytes
+    return np.nan
+
+
+def benchmark_step(model, micro_batch_size, image_size, parameters, n_steps=3):
+    """
+    Measures the throughput and the peak memory of training steps (forward, backward, optimizer step) of a model on
+    random images. The first step is a warm-up step and is not timed.
+    On the cpu the peak memory is the peak resident memory of the whole process during the steps. It is NaN where the
+    peak cannot be reset (outside of linux).
+
+    :param nn.Module model: the model to benchmark
+    :param int micro_batch_size: number of images per step
+    :param tuple image_size: (height, width) of the images
+    :param dict parameters: a dictionary containing the parameters "device" and "bf16"
+    :param int n_steps: number of timed steps
+    :return: a dictionary containing the images per second and the peak memory in bytes
+    """
+    device = parameters["device"]
+    x = torch.rand(micro_batch_size, 3, image_size[0], image_size[1], device=device)
+    y = torch.randint(low=0, high=2, size=(micro_batch_size,), device=device).float()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-8, eps=1e-8)
+    loss_func = torch.nn.BCELoss()
+    cuda = str(device).startswith("cuda")
+    if cuda:
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        peak_reset = reset_peak_rss()
+
+    model.train()
+    start = None
+    for step in range(n_steps + 1):
+        if step == 1:
+            if cuda:
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        with autocast(parameters=parameters):
+            probas = torch.flatten(model(x=x)).float()
+        batch_loss = loss_func(probas, y)
+        batch_loss.backward()
+        optimizer.step()
+    if cuda:
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+
+    if cuda:
+        peak_memory = torch.cuda.max_memory_allocated(device)
+    else:
+        peak_memory = peak_rss() if peak_reset else np.nan
+    return {"images_per_sec": micro_batch_size * n_steps / elapsed, "peak_memory": peak_memory}
+
+
+def tune_micro_batch(wrapper, parameters, effective_batch_size, memory_budget=None, n_steps=3,
+                     cache_path="micro_batch_cache.json"):
+    """
+    Chooses the micro-batch size ("batch_size") and the number of accumulated micro-batches ("accumulation") for a
+    given effective batch size. All micro-batch sizes that divide the effective batch size are probed from small to
+    large until one exceeds the memory budget (or runs out of memory). Of the fitting sizes, the one with the highest
+    throughput on the current machine is chosen.
+    Results are cached in a json file per model, image resolution, host and device, so the probing happens once.
+
+    :param wrapper: a model-wrapper providing build_model(parameters)
+    :param dict parameters: a dictionary containing the parameters defined in tools.parameters_cnn or
+    tools.parameters_pretrained
+    :param int effective_batch_size: number of images per optimizer step (batch_size * accumulation)
+    :param int memory_budget: maximal peak memory in bytes. Defaults to 90% of the gpu memory when training on cuda
+    and to no limit (apart from running out of memory) on the cpu. Not checked on the cpu where the peak memory
+    cannot be measured
+    :param int n_steps: number of timed training steps per probed micro-batch size
+    :param str cache_path: path of the json file caching the results
+    :return: a copy of >parameters< with "batch_size" and "accumulation" set to the chosen values
+    """
+    device = parameters["device"]
+    cuda = str(device).startswith("cuda")
+    if parameters.get("pixel_budget") is not None:  # aspect ratio buckets, probe the equivalent square images
+        side = int(parameters["pixel_budget"] ** 0.5)
+        image_size = (side, side)
+    else:
+        image_size = transform_output_size(transform_pipe=parameters["transform_pipe"])
+    if memory_budget is None and cuda:
+        memory_budget = int(0.9 * torch.cuda.get_device_properties(device).total_memory)
+
+    model = wrapper.build_model(parameters=parameters)
+    model_name = type(model).__name__ + "-" + hashlib.sha1(repr(model).encode()).hexdigest()[:10]
+    del model
+    device_name = torch.cuda.get_device_name(device) if cuda else str(device)
+    key = "|".join([model_name, str(image_size[0]) + "x" + str(image_size[1]), socket.gethostname(), device_name,
+                    str(effective_batch_size), str(memory_budget)])
+
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as file:
+            cache = json.load(file)
+    if key not in cache:
+        results = []
+        for micro_batch_size in [size for size in range(1, effective_batch_size + 1)
+                                 if effective_batch_size % size == 0]:
+            model = wrapper.build_model(parameters=parameters)  # no optimizer or autograd state of earlier probes
+            try:
+                result = benchmark_step(model=model, micro_batch_size=micro_batch_size, image_size=image_size,
+                                        parameters=parameters, n_steps=n_steps)
+            except RuntimeError as error:  # includes torch.cuda.OutOfMemoryError
+                if "out of memory" not in str(error):
+                    raise
+                print("Micro-batch size", micro_batch_size, "runs out of memory")
+                break
+            finally:
+                del model
+                if cuda:
+                    torch.cuda.empty_cache()
+            if memory_budget is not None and result["peak_memory"] > memory_budget:
+                print("Micro-batch size", micro_batch_size, "exceeds the memory budget")
+                break
+            print("Micro-batch size", micro_batch_size, "- images per second:", result["images_per_sec"],
+                  "- peak memory (MB):", result["peak_memory"] / 2 ** 20)
+            results.append((result["images_per_sec"], micro_batch_size))
+        if len(results) == 0:
+            raise ValueError("not even a micro-batch of one image fits into the memory budget")
+
+        images_per_sec, micro_batch_size = max(results)
+        cache[key] = {"batch_size": micro_batch_size, "accumulation": effective_batch_size // micro_batch_size,
+                      "images_per_sec": images_per_sec}
+        with open(cache_path + ".tmp", "w") as file:
+            json.dump(cache, file, indent=2)
+        os.replace(cache_path + ".tmp", cache_path)
+
+    print("Micro-batch size:", cache[key]["batch_size"], "- accumulation:", cache[key]["accumulation"])
+    tuned_parameters = dict(parameters)
+    tuned_parameters.update({"batch_size": cache[key]["batch_size"], "accumulation": cache[key]["accumulation"]})
+    return tuned_parameters
+
+
+def activation_checkpointing_report(wrapper, parameters, micro_batch_sizes, segment_options=(None, 1, 2, 4),
+                                    n_steps=3):
+    """
+    Measures the training throughput and the peak memory of a model for multiple micro-batch sizes with and without
+    activation checkpointing, to choose the largest micro-batch at a known recompute cost.
+    The peak memory is exact on cuda. On the cpu it is the peak resident memory of the whole process during the
+    measured steps.
+
+    :param wrapper: a model-wrapper providing build_model(parameters)
+    :param dict parameters: a dictionary containing the parameters defined in tools.parameters_pretrained
+    :param list micro_batch_sizes: the micro-batch sizes to measure
+    :param tuple segment_options: the values of "activation_checkpoint_segments" to compare. None disables
+    activation checkpointing
+    :param int n_steps: number of timed training steps per configuration
+    :return: a pd.DataFrame containing the images per second and the peak memory (MB) of every configuration
+    """
+    image_size = transform_output_size(transform_pipe=parameters["transform_pipe"])
+    results = []
+    for n_segments in segment_options:
+        for micro_batch_size in micro_batch_sizes:
+            model = wrapper.build_model(parameters=dict(parameters, activation_checkpoint_segments=n_segments))
+            try:
+                result = benchmark_step(model=model, micro_batch_size=micro_batch_size, image_size=image_size,
+                                        parameters=parameters, n_steps=n_steps)
+            except RuntimeError as error:  # includes torch.cuda.OutOfMemoryError
+                if "out of memory" not in str(error):
+                    raise
+                result = {"images_per_sec": np.nan, "peak_memory": np.nan}
+            results.append({"segments": "off" if n_segments is None else n_segments, "batch_size": micro_batch_size,
+                            "images_per_sec": result["images_per_sec"],
+                            "peak_memory_mb": result["peak_memory"] / 2 ** 20})
+            del model
+            if str(parameters["device"]).startswith("cuda"):
+                torch.cuda.empty_cache()
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    return results
+
+
+def benchmark_inference(model, micro_batch_size, image_size, parameters, n_steps=3):
+    """
+    Measures the inference throughput of a model on random images. The first batch is a warm-up batch (e.g. for
+    compilation) and is not timed.
+
+    :param nn.Module model: the model to benchmark
+    :param int micro_batch_size: number of images per batch
+    :param tuple image_size: (height, width) of the images
+    :param dict parameters: a dictionary containing the parameters "device" and "bf16"
+    :param int n_steps: number of timed batches
+    :return: the images per second
+    """
+    device = parameters["device"]
+    cuda = str(device).startswith("cuda")
+    x = torch.rand(micro_batch_size, 3, image_size[0], image_size[1], device=device)
+    model.eval()
+    start = None
+    for step in range(n_steps + 1):
+        if step == 1:
+            if cuda:
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+        with torch.no_grad(), autocast(parameters=parameters):
+            model(x=x)
+    if cuda:
+        torch.cuda.synchronize(device)
+    return micro_batch_size * n_steps / (time.perf_counter() - start)
+
+
+def performance_mode_benchmark(wrapper, parameter_combinations, names, micro_batch_size=16, n_steps=5):
+    """
+    Compares the training and inference throughput of models with the performance mode (channels-last memory format,
+    compiled forward pass and bfloat16 autocast) turned off and on.
+
+    :param wrapper: a model-wrapper providing build_model(parameters)
+    :param list parameter_combinations: a list of parameter combinations, e.g. one per pretrained backbone
+    :param list names: a list containing one name per parameter combination
+    :param int micro_batch_size: number of images per step
+    :param int n_steps: number of timed steps per configuration
+    :return: a pd.DataFrame containing the training and inference images per second of every configuration
+    """
+    results = []
+    for name, parameters in zip(names, parameter_combinations):
+        image_size = transform_output_size(transform_pipe=parameters["transform_pipe"])
+        for mode in ["off", "on"]:
+            mode_parameters = dict(parameters, channels_last=mode == "on", compile_model=mode == "on",
+                                   bf16=mode == "on")
+            model = wrapper.build_model(parameters=mode_parameters)
+            train = benchmark_step(model=model, micro_batch_size=micro_batch_size, image_size=image_size,
+                                   parameters=mode_parameters, n_steps=n_steps)
+            inference = benchmark_inference(model=model, micro_batch_size=micro_batch_size, image_size=image_size,
+                                            parameters=mode_parameters, n_steps=n_steps)
+            results.append({"name": name, "performance_mode": mode, "train_images_per_sec": train["images_per_sec"],
+                            "inference_images_per_sec": inference})
+            del model
+    results = pd.DataFrame(results)
+    print("bfloat16 autocast supported:",
+          torch.cuda.is_bf16_supported() if torch.cuda.is_available() else cpu_supports_bf16())
+    print(results.to_string(index=False))
+    return results
+
+
+def quantize_static(model, data, parameters, n_calibration=256, batch_size=32, transform_pipe=None, backend="x86",
+                    export_path=None):
+    """
+    Quantizes a trained image classifier to int8 for cpu inference (post-training static quantization, FX graph
+    mode). Conv-bn-relu blocks are fused while the model is prepared, the ranges of the activations are calibrated
+    on a sample of images, and weights and activations are converted to int8.
+
+    :param torch.nn.Module model: a trained model (not modified)
+    :param pd.DataFrame data: images used for calibration, e.g. a training fold
+    :param dict parameters: a dictionary containing the parameters the model was trained with
+    :param int n_calibration: number of images sampled from >data< for calibration
+    :param int batch_size: number of images per calibration batch
+    :param transform_pipe: transformations of the calibration images. Defaults to parameters["transform_pipe"],
+    random augmentations should be avoided
+    :param str backend: quantized engine, "x86" (or "fbgemm") for x86 servers, "qnnpack" for arm
+    :param str export_path: if given, the quantized model is saved as TorchScript to this path
+    :return: the quantized model (on the cpu)
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    transform_pipe = parameters["transform_pipe"] if transform_pipe is None else transform_pipe
+    torch.backends.quantized.engine = backend
+    sample = data.sample(n=min(n_calibration, len(data)), random_state=0)
+    sample.index = range(len(sample))
+    loader = DataLoader(dataset=CustomDataset(data=sample, transform_pipe=transform_pipe, device="cpu"),
+                        batch_size=batch_size)
+    example_batch = next(iter(loader))[0]
+
+    prepared = prepare_fx(cpu_float_copy(model=model), get_default_qconfig_mapping(backend),
+                          example_inputs=(example_batch,))  # fuses conv-bn-relu and inserts observers
+    with torch.no_grad():
+        for x_batch, _ in loader:  # calibration
+            prepared(x_batch)
+    quantized = convert_fx(prepared)
+
+    if export_path is not None:
+        with torch.no_grad():
+            torch.jit.save(torch.jit.trace(quantized, example_batch), export_path)
+    return quantized
+
+
+def quantization_report(wrapper, float_model, quantized_model, data, parameters, batch_size=32, n_batches=5):
+    """
+    Compares a float model with its quantized version on the cpu: serialized size, latency per batch and the metrics
+    of the wrapper's predict function.
+
+    :param wrapper: the model-wrapper whose predict function computes the metrics
+    :param torch.nn.Module float_model: the trained float model
+    :param torch.nn.Module quantized_model: the quantized model, e.g. created by >quantize_static<
+    :param pd.DataFrame data: the evaluation data
+    :param dict parameters: a dictionary containing the parameters the model was trained with
+    :param int batch_size: number of images per timed batch
+    :param int n_batches: number of timed batches
+    :return: a pd.DataFrame containing the size (MB), the latency (ms per batch) and the metrics of both models
+    """
+    cpu_parameters = dict(parameters, device="cpu", bf16=False)
+    loader = DataLoader(dataset=CustomDataset(data=data, transform_pipe=parameters["transform_pipe"], device="cpu"),
+                        batch_size=batch_size)
+    example_batch = next(iter(loader))[0]
+
+    results = []
+    for name, model in [("float32", cpu_float_copy(model=float_model)), ("int8", quantized_model)]:
+        buffer = io.BytesIO()
+        torch.save(model.state_dict(), buffer)
+        with torch.no_grad():
+            model(x=example_batch)  # warm-up
+            start = time.perf_counter()
+            for i in range(n_batches):
+                model(x=example_batch)
+            latency = (time.perf_counter() - start) / n_batches * 1000
+        print("Metrics of the", name, "model:")
+        metrics = wrapper.predict(model=model, data=data, parameters=cpu_parameters)
+        results.append(dict({"model": name, "size_mb": buffer.getbuffer().nbytes / 2 ** 20,
+                             "ms_per_batch": latency}, **metrics))
+    results = pd.DataFrame(results).set_index("model")
+    print(results.to_string())
+    print("Delta int8 - float32:")
+    print((results.loc["int8"] - results.loc["float32"]).to_string())
+    return results
@@ -27,20 +27,26 @@ class ExactClassifier(nn.Module):
     mobilenet_v3_large
     """
 
-    def __init__(self, linear_size, pretrained_component):
+    def __init__(self, linear_size, pretrained_component, activation_checkpoint_segments=None):
         """
         Constructor.
 
         :param int linear_size: size of the second linear layer
         :param pretrained_component: a pretrained model for image classification. All pretrained models provided by
         PyTorch provide an output tensor of size 1_000.
+        :param int activation_checkpoint_segments: number of activation checkpointing segments of the pretrained
+        component. None disables activation checkpointing
         """
         super(ExactClassifier, self).__init__()
         if pretrained_component == "mobilenet":
             self.pretrained_component = models.mobilenet_v3_large(pretrained=True)
+        if activation_checkpoint_segments is not None:
+            tools.enable_activation_checkpointing(pretrained_component=self.pretrained_component,
+                                                  n_segments=activation_checkpoint_segments)
         self.linear1 = nn.Linear(in_features=1_000, out_features=linear_size)
         self.linear2 = nn.Linear(in_features=linear_size, out_features=1)  # binary classification -> 1 out feature
         self.sigmoid = nn.Sigmoid()
+        self.frozen = False
 
     def forward(self, x):
         x = self.pretrained_component(x)
@@ -55,6 +61,7 @@ class ExactClassifier(nn.Module):
         """
         for param in self.pretrained_component.parameters():
             param.requires_grad = False
+        self.frozen = True
 
     def unfreeze_pretrained(self):
         """
@@ -62,7 +69,8 @@ class ExactClassifier(nn.Module):
         Parameters are unfrozen by default and can be frozen by the function >freeze_pretrained<
         """
         for param in self.pretrained_component.parameters():
-            param.requires_grad = False
+            param.requires_grad = True
+        self.frozen = False
 
     def pretrained_representation(self, x):
         """
@@ -110,18 +118,35 @@ class ExactWrapper:
         linear_size = best_parameters["linear_size"]
         freeze_epochs = best_parameters["freeze_epochs"]
         unfreeze_epochs = best_parameters["unfreeze_epochs"]
+        activation_checkpoint_segments = best_parameters["activation_checkpoint_segments"]
 
-        train_data, val_data = train_test_split(train_data, test_size=0.2)
-        train_data.index = range(len(train_data))
-        val_data.index = range(len(val_data))
-
-        train_loader = self.preprocess(data=train_data, parameters=best_parameters)["loader"]
-        model = ExactClassifier(pretrained_component=pretrained_component, linear_size=linear_size).to(device)
+        model = ExactClassifier(pretrained_component=pretrained_component, linear_size=linear_size,
+                                activation_checkpoint_segments=activation_checkpoint_segments).to(device)
+        model = tools.prepare_model(model=model, parameters=best_parameters)
         optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
         loss_func = nn.BCELoss()
 
+        checkpointer = tools.Checkpointer(parameters=best_parameters)
+        checkpoint = checkpointer.restore(name="fit", model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=best_parameters)
+        start_epoch = 1
+        if checkpoint is None:
+            train_data, val_data = train_test_split(train_data, test_size=0.2)
+            train_data.index = range(len(train_data))
+            val_data.index = range(len(val_data))
+        else:  # continue on the split of the interrupted run
+            start_epoch = checkpoint["epoch"] + 1
+            train_data, val_data = checkpoint["train_data"], checkpoint["val_data"]
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+            if checkpoint["frozen"]:
+                model.freeze_pretrained()
+
+        train_loader = self.preprocess(data=train_data, parameters=best_parameters)["loader"]
+
         # train loop
-        for epoch in range(1, n_epochs + 1):
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:
+                break
             print("=== Epoch", epoch, "/", n_epochs, "===")
             if epoch in freeze_epochs:
                 print("Freeze")
@@ -134,7 +159,8 @@ class ExactWrapper:
             for i, batch in enumerate(train_loader):
                 x_batch, y_batch = batch
                 optimizer.zero_grad()
-                probas = torch.flatten(model(x=x_batch))
+                with tools.autocast(parameters=best_parameters):  # bfloat16 forward if enabled
+                    probas = torch.flatten(model(x=x_batch)).float()
                 batch_loss = loss_func(probas, y_batch)  # calculate loss
                 batch_loss.backward()  # calculate gradients
                 optimizer.step()
@@ -142,8 +168,15 @@ class ExactWrapper:
             print("Metrics on training data after epoch", epoch, ":")
             self.predict(model=model, data=train_data, parameters=best_parameters)
             print("Metrics on validation data after epoch", epoch, ":")
-            self.predict(model=model, data=val_data, parameters=best_parameters)
+            metrics = self.predict(model=model, data=val_data, parameters=best_parameters)
             print("\n")
+            early_stopping.step(epoch=epoch, metrics=metrics, model=model)
+            checkpointer.save(name="fit", epoch=epoch, model=model, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs,
+                              early_stopping=early_stopping.state_dict(),
+                              frozen=model.frozen, train_data=train_data, val_data=val_data)
+        checkpointer.wait()
+        early_stopping.restore_best(model=model)
         return {"model": model}
 
     def predict(self, model, data, parameters):
@@ -164,8 +197,8 @@ class ExactWrapper:
         loader = self.preprocess(data=data, parameters=parameters)["loader"]
         for batch in loader:
             x_batch, y_batch = batch
-            with torch.no_grad():
-                probas = torch.flatten(model(x=x_batch))
+            with torch.no_grad(), tools.autocast(parameters=parameters):
+                probas = torch.flatten(model(x=x_batch)).float()
             metrics = tools.evaluate(y_true=y_batch, y_probas=probas)
             acc += metrics["acc"]
             f1 += metrics["f1"]
@@ -182,6 +215,19 @@ class ExactWrapper:
         print("Recall:", recall)
         return {"acc": acc, "f1": f1}
 
+    def export(self, model, parameters, path):
+        """
+        Exports a trained ExactClassifier as TorchScript and ONNX for the standalone inference_runner.py.
+
+        :param ExactClassifier model: a trained ExactClassifier
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_exact_wrapper
+        :param str path: path of the exported files without file extension
+        :return: a dictionary containing the paths of the exported files
+        """
+        height, width = tools.transform_output_size(transform_pipe=parameters["transform_pipe"])
+        return tools.export_model(model=model, example_inputs={"x": torch.rand(1, 3, height, width)}, path=path,
+                                  metadata={"image_size": [height, width], "output": "probabilities"})
+
     # TODO abandoned
     def compare_representations(self, data, detected, model, parameters):
         """
@@ -281,6 +327,18 @@ torch.save(best_exact, "best_exact.pt")
 print("\nPERFORMANCE ON TEST")
 exact_wrapper.predict(model=best_exact, data=test_data, parameters=parameters)
 
+# int8 model for cpu-only inference hosts (calibrated without the random augmentations)
+# quantized_exact = tools.quantize_static(model=best_exact, data=train_data, parameters=parameters,
+#                                         transform_pipe=transforms.Compose([transforms.CenterCrop(size=[256, 256]),
+#                                                                            transforms.ToTensor()]),
+#                                         export_path="best_exact_int8.pt")
+# tools.quantization_report(wrapper=exact_wrapper, float_model=best_exact, quantized_model=quantized_exact,
+#                           data=test_data, parameters=parameters)
+
+# TorchScript/ONNX files for inference_runner.py, which does not need this training script
+# exported = exact_wrapper.export(model=best_exact, parameters=parameters, path="best_exact")
+# tools.export_report(model=best_exact, example_inputs={"x": torch.rand(1, 3, 256, 256)}, path="best_exact")
+
 
 best_exact = torch.load("best_exact.pt")
 
@@ -1,11 +1,22 @@
+import io
+import os
+import sys
+import time
+
 import numpy as np
 import pandas as pd
 import torch
 from PIL import Image
 from sklearn.metrics import accuracy_score
+from sklearn.metrics import f1_score
 from sklearn.metrics import precision_score
 from sklearn.metrics import recall_score
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # shared_tools.py lives in the root
+from shared_tools import (  # noqa: E402
+    Checkpointer, EarlyStopping, autocast, cpu_float_copy, enable_activation_checkpointing, export_model,
+    export_report, prepare_model, transform_output_size)
 
 
 def select_device():
@@ -26,18 +37,19 @@ def select_device():
 def evaluate(y_true, y_probas):
     """
     Evaluates the prediction-probabilities of a model
-    using accuracy, precision, and recall score
+    using accuracy, f1, precision, and recall score
 
     :param torch.Tensor y_true: true labels
     :param torch.Tensor y_probas: predicted class probabilities
-    :return: a dictionary containing the accuracy, precision, and recall score
+    :return: a dictionary containing the accuracy, f1, precision, and recall score
     """
     preds_batch_np = np.round(y_probas.cpu().detach().numpy())
     y_batch_np = y_true.cpu().detach().numpy()
     acc = accuracy_score(y_true=y_batch_np, y_pred=preds_batch_np)
     precision = precision_score(y_true=y_batch_np, y_pred=preds_batch_np, zero_division=1)
     recall = recall_score(y_true=y_batch_np, y_pred=preds_batch_np, zero_division=1)
-    return {"acc": acc, "precision": precision, "recall": recall}
+    f1 = f1_score(y_true=y_batch_np, y_pred=preds_batch_np, zero_division=1)
+    return {"acc": acc, "f1": f1, "precision": precision, "recall": recall}
 
 
 class CustomDataset(Dataset):
@@ -114,7 +126,9 @@ def read_data(detected_share, data_path="../../data/exact_matching/"):
 
 
 def parameters_exact_wrapper(n_epochs, lr, batch_size, transform_pipe, pretrained_component, linear_size, freeze_epochs,
-                             unfreeze_epochs, device):
+                             unfreeze_epochs, device, checkpoint_dir=None, checkpoint_every=1, resume=False,
+                             patience=None, min_delta=0.0, stopping_metric="f1", best_weights_path=None,
+                             activation_checkpoint_segments=None, channels_last=False, compile_model=False, bf16=False):
     """
     Creates a dictionary containing the necessary preprocessing,
     model and training parameters for the Pretrained exact matcher.
@@ -131,8 +145,107 @@ def parameters_exact_wrapper(n_epochs, lr, batch_size, transform_pipe, pretraine
     :param list unfreeze_epochs: a list of integers representing the epochs in which the pretrained component
     has to be unfrozen
     :param str device: name of the utilized device (either cpu or cuda)
+    :param str checkpoint_dir: directory in which training checkpoints are written. None disables checkpoints
+    :param int checkpoint_every: number of epochs between two checkpoints
+    :param bool resume: whether training runs continue from their checkpoints in >checkpoint_dir<
+    :param int patience: number of epochs without improvement of the validation metric after which training stops.
+    None disables early stopping
+    :param float min_delta: minimal increase of the validation metric that counts as an improvement
+    :param str stopping_metric: name of the validation metric that drives early stopping
+    :param str best_weights_path: file in which the weights of the best epoch are kept. None keeps them in memory
+    :param int activation_checkpoint_segments: number of activation checkpointing segments per stage of the pretrained
+    component. Saves memory (allowing larger batches) at the cost of recomputation. None disables it
+    :param bool channels_last: whether the model and its inputs use the channels-last memory format
+    :param bool compile_model: whether the forward pass of the model is compiled with torch.compile
+    :param bool bf16: whether forward passes use bfloat16 autocast (only on devices supporting bfloat16 natively)
     :return: a dictionary containing all parameters having their names as keys.
     """
     return {"n_epochs": n_epochs, "lr": lr, "batch_size": batch_size, "transform_pipe": transform_pipe,
             "pretrained_component": pretrained_component, "linear_size": linear_size, "freeze_epochs": freeze_epochs,
-            "unfreeze_epochs": unfreeze_epochs, "device": device}
+            "unfreeze_epochs": unfreeze_epochs, "device": device,
+            "checkpoint_dir": checkpoint_dir, "checkpoint_every": checkpoint_every, "resume": resume,
+            "patience": patience, "min_delta": min_delta, "stopping_metric": stopping_metric,
+            "best_weights_path": best_weights_path, "activation_checkpoint_segments": activation_checkpoint_segments,
+            "channels_last": channels_last, "compile_model": compile_model, "bf16": bf16}
+
+
+def quantize_static(model, data, parameters, n_calibration=256, batch_size=32, transform_pipe=None, backend="x86",
+                    export_path=None):
+    """
+    Quantizes a trained image classifier to int8 for cpu inference (post-training static quantization, FX graph
+    mode). Conv-bn-relu blocks are fused while the model is prepared, the ranges of the activations are calibrated
+    on a sample of images, and weights and activations are converted to int8.
+
+    :param torch.nn.Module model: a trained model (not modified)
+    :param pd.DataFrame data: images used for calibration, e.g. a training fold
+    :param dict parameters: a dictionary containing the parameters the model was trained with
+    :param int n_calibration: number of images sampled from >data< for calibration
+    :param int batch_size: number of images per calibration batch
+    :param transform_pipe: transformations of the calibration images. Defaults to parameters["transform_pipe"],
+    random augmentations should be avoided
+    :param str backend: quantized engine, "x86" (or "fbgemm") for x86 servers, "qnnpack" for arm
+    :param str export_path: if given, the quantized model is saved as TorchScript to this path
+    :return: the quantized model (on the cpu)
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    transform_pipe = parameters["transform_pipe"] if transform_pipe is None else transform_pipe
+    torch.backends.quantized.engine = backend
+    sample = data.sample(n=min(n_calibration, len(data)), random_state=0)
+    sample.index = range(len(sample))
+    loader = DataLoader(dataset=CustomDataset(data=sample, transform_pipe=transform_pipe, device="cpu"),
+                        batch_size=batch_size)
+    example_batch = next(iter(loader))[0]
+
+    prepared = prepare_fx(cpu_float_copy(model=model), get_default_qconfig_mapping(backend),
+                          example_inputs=(example_batch,))  # fuses conv-bn-relu and inserts observers
+    with torch.no_grad():
+        for x_batch, _ in loader:  # calibration
+            prepared(x_batch)
+    quantized = convert_fx(prepared)
+
+    if export_path is not None:
+        with torch.no_grad():
+            torch.jit.save(torch.jit.trace(quantized, example_batch), export_path)
+    return quantized
+
+
+def quantization_report(wrapper, float_model, quantized_model, data, parameters, batch_size=32, n_batches=5):
+    """
+    Compares a float model with its quantized version on the cpu: serialized size, latency per batch and the metrics
+    of the wrapper's predict function.
+
+    :param wrapper: the model-wrapper whose predict function computes the metrics
+    :param torch.nn.Module float_model: the trained float model
+    :param torch.nn.Module quantized_model: the quantized model, e.g. created by >quantize_static<
+    :param pd.DataFrame data: the evaluation data
+    :param dict parameters: a dictionary containing the parameters the model was trained with
+    :param int batch_size: number of images per timed batch
+    :param int n_batches: number of timed batches
+    :return: a pd.DataFrame containing the size (MB), the latency (ms per batch) and the metrics of both models
+    """
+    cpu_parameters = dict(parameters, device="cpu", bf16=False)
+    loader = DataLoader(dataset=CustomDataset(data=data, transform_pipe=parameters["transform_pipe"], device="cpu"),
+                        batch_size=batch_size)
+    example_batch = next(iter(loader))[0]
+
+    results = []
+    for name, model in [("float32", cpu_float_copy(model=float_model)), ("int8", quantized_model)]:
+        buffer = io.BytesIO()
+        torch.save(model.state_dict(), buffer)
+        with torch.no_grad():
+            model(x=example_batch)  # warm-up
+            start = time.perf_counter()
+            for i in range(n_batches):
+                model(x=example_batch)
+            latency = (time.perf_counter() - start) / n_batches * 1000
+        print("Metrics of the", name, "model:")
+        metrics = wrapper.predict(model=model, data=data, parameters=cpu_parameters)
+        results.append(dict({"model": name, "size_mb": buffer.getbuffer().nbytes / 2 ** 20,
+                             "ms_per_batch": latency}, **metrics))
+    results = pd.DataFrame(results).set_index("model")
+    print(results.to_string())
+    print("Delta int8 - float32:")
+    print((results.loc["int8"] - results.loc["float32"]).to_string())
+    return results
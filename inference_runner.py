@@ -0,0 +1,125 @@
+"""
+Standalone batched inference for the models exported by the export methods of the wrappers (tools.export_model).
+Loads either the TorchScript (.pt) or the ONNX (.onnx) file together with the json file next to it, so neither the
+training scripts nor their dependencies (transformers, torchvision, sklearn, ...) have to be installed.
+ONNX models need onnxruntime, TorchScript models need torch.
+
+Examples:
+    python inference_runner.py best_exact.onnx --images img/01235.png img/01236.png --batch-size 32
+    python inference_runner.py best_bert.pt --inputs encoded.npz --output probas.npy
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+
+def load_model(path):
+    """
+    Loads an exported model and its metadata.
+
+    :param str path: path of the .pt or .onnx file
+    :return: a dictionary containing a function that maps a dictionary of numpy arrays (one per input name) to the
+    numpy array of outputs under the key "run", and the metadata under the key "metadata"
+    """
+    with open(os.path.splitext(path)[0] + ".json") as file:
+        metadata = json.load(file)
+
+    if path.endswith(".onnx"):
+        import onnxruntime
+        session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+        def run(inputs):
+            return session.run(None, inputs)[0]
+    else:
+        import torch
+        module = torch.jit.load(path, map_location="cpu")
+        module.eval()
+
+        def run(inputs):
+            with torch.no_grad():
+                return module(*[torch.from_numpy(inputs[name]) for name in metadata["inputs"]]).numpy()
+
+    return {"run": run, "metadata": metadata}
+
+
+def image_batches(paths, image_size, batch_size):
+    """
+    Reads images batch-wise and converts them into the format of transforms.ToTensor. The images are resized to the
+    exported image size instead of applying the (random) crops of the training pipelines.
+
+    :param list paths: paths of the images
+    :param list image_size: height and width of the exported model's input
+    :param int batch_size: number of images per batch
+    :return: a generator of float32 numpy arrays of shape (batch, 3, height, width)
+    """
+    from PIL import Image
+    height, width = image_size
+    for start in range(0, len(paths), batch_size):
+        images = []
+        for path in paths[start:start + batch_size]:
+            image = Image.open(path).convert("RGB").resize((width, height), Image.BILINEAR)
+            images.append(np.asarray(image, dtype=np.float32).transpose(2, 0, 1) / 255)
+        yield np.stack(images)
+
+
+def predict(model, batches):
+    """
+    Performs the inference batch by batch.
+
+    :param dict model: the loaded model returned by >load_model<
+    :param batches: an iterable of dictionaries mapping the input names to numpy arrays
+    :return: a dictionary containing the concatenated outputs and the latency (ms) of every batch
+    """
+    outputs = []
+    latencies = []
+    for batch in batches:
+        start = time.perf_counter()
+        outputs.append(model["run"](batch))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {"outputs": np.concatenate(outputs), "latencies": latencies}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="batched inference with an exported TorchScript or ONNX model")
+    parser.add_argument("model", help="path of the exported .pt or .onnx file")
+    data = parser.add_mutually_exclusive_group(required=True)
+    data.add_argument("--images", nargs="+", help="image files, for the image classifiers")
+    data.add_argument("--inputs", help=".npz file containing one array per model input, e.g. token ids")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--output", help="optional .npy file to store the outputs in")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    model = load_model(path=args.model)
+    print("startup (ms):", round((time.perf_counter() - start) * 1000, 1))
+    metadata = model["metadata"]
+
+    if args.images is not None:
+        name = metadata["inputs"][0]
+        batches = ({name: images} for images in image_batches(paths=args.images,
+                                                                image_size=metadata["image_size"],
+                                                                batch_size=args.batch_size))
+    else:
+        arrays = np.load(args.inputs)
+        arrays = {name: arrays[name].astype(dtype) for name, dtype in zip(metadata["inputs"], metadata["dtypes"])}
+        n = len(arrays[metadata["inputs"][0]])
+        batches = ({name: array[start:start + args.batch_size] for name, array in arrays.items()}
+                   for start in range(0, n, args.batch_size))
+
+    predicted = predict(model=model, batches=batches)
+    latencies = predicted["latencies"]
+    print("batches:", len(latencies))
+    print("first batch (ms):", round(latencies[0], 1))
+    if len(latencies) > 1:
+        print("mean latency per batch after the first (ms):", round(float(np.mean(latencies[1:])), 1))
+    print(metadata.get("output", "output") + ":")
+    print(predicted["outputs"])
+    if args.output is not None:
+        np.save(args.output, predicted["outputs"])
+
+
+if __name__ == "__main__":
+    main()
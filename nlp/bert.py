@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 import pandas as pd
 import torch
@@ -6,7 +8,6 @@ from sklearn.model_selection import train_test_split
 from torch.utils.data import DataLoader, RandomSampler, TensorDataset
 from transformers import AdamW
 from transformers import BertModel
-from transformers import BertTokenizer
 
 import tools
 
@@ -33,8 +34,54 @@ class BertClassifier(nn.Module):
         :param torch.Tensor x: the input/observation per batch
         :return: the prediction of the whole batch
         """
+        return self.sigmoid(self.logits(x=x, attention_mask=attention_mask))
+
+    def logits(self, x, attention_mask):
+        """
+        performs the forward pass without the final sigmoid, e.g. to distill the classifier.
+
+        :param torch.Tensor x: the input/observation per batch
+        :param torch.Tensor attention_mask: the attention mask of the batch
+        :return: the logits of the whole batch
+        """
         bert_output = self.bert(input_ids=x, attention_mask=attention_mask)
         x = self.dropout(bert_output[1])
+        return self.linear(x)
+
+    def load_head(self, head):
+        """
+        Replaces the classification layer by the one of a head trained on cached pooled outputs
+        (BertWrapper.fit_head). The pretrained BERT weights are left untouched.
+
+        :param BertHead head: a trained head
+        :return: the classifier itself
+        """
+        self.linear.load_state_dict(head.linear.state_dict())
+        return self
+
+
+class BertHead(nn.Module):
+    """
+    Classification head of a BertClassifier operating on precomputed pooled BERT outputs.
+    """
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        super(BertHead, self).__init__()
+        self.dropout = nn.Dropout(p=0.3)
+        self.linear = nn.Linear(768, 1)  # has to match the linear layer of BertClassifier
+        self.sigmoid = nn.Sigmoid()
+
+    def forward(self, x):
+        """
+        performs the forward pass.
+
+        :param torch.Tensor x: the pooled BERT outputs of the batch
+        :return: the prediction of the whole batch
+        """
+        x = self.dropout(x)
         x = self.linear(x)
         return self.sigmoid(x)
 
@@ -52,35 +99,33 @@ class BertWrapper:
         :return: a dictionary having the key "loader" and the constructed DataLoader as value.
         """
         max_seq_len = parameters["max_seq_len"]
-        batch_size = parameters["batch_size"]
         x_name = parameters["x_name"]
         y_name = parameters["y_name"]
+        device = parameters["device"]
         text_col = data[x_name]
         target_col = data[y_name]
 
-        # tokenization:
-        tokens = []
-        attention_masks = []
-        tokenizer = BertTokenizer.from_pretrained("bert-base-uncased", do_lower_case=True)
-        for text in text_col.values:
-            encoded = tokenizer.encode_plus(text,
-                                            add_special_tokens=True,  # special tokens for BERT
-                                            max_length=max_seq_len,
-                                            padding="max_length",
-                                            truncation=True,
-                                            return_tensors="pt",  # return pytorch tensors
-                                            return_attention_mask=True)
-            tokens.append(encoded["input_ids"])
-            attention_masks.append(encoded["attention_mask"])
-        x = torch.cat(tokens, dim=0)  # concat into one big tensor
-        x = x.long().to(device)
-        attention_masks = torch.cat(attention_masks, dim=0).to(device)
-        y = torch.tensor(target_col, dtype=torch.float32).to(device)
+        def encode():
+            """
+            Tokenizes the texts using the fast BERT tokenizer.
+
+            :return: a dictionary containing the token ids "x", the labels "y" and the "attention_masks"
+            """
+            encoded = tools.bert_encode(texts=text_col.values, max_seq_len=max_seq_len)
+            return {"x": encoded["input_ids"],
+                    "y": torch.tensor(target_col, dtype=torch.float32),
+                    "attention_masks": encoded["attention_mask"]}
+
+        # tokenization, once per dataset:
+        encoded = tools.cached_encoding(data=data, parameters=parameters, tokenizer="bert-base-uncased", encode=encode)
+        x = encoded["x"].to(device)
+        attention_masks = encoded["attention_masks"].to(device)
+        y = encoded["y"].to(device)
 
         # create loader:
         dataset = TensorDataset(x, y, attention_masks)
-        sampler = RandomSampler(dataset)
-        return {"loader": DataLoader(dataset=dataset, batch_size=batch_size, sampler=sampler)}
+        lengths = encoded["attention_masks"].sum(dim=1)
+        return {"loader": tools.text_loader(dataset=dataset, lengths=lengths, parameters=parameters)}
 
     def evaluate_hyperparameters(self, folds, parameters):
         """
@@ -91,6 +136,19 @@ class BertWrapper:
         :param dict parameters: a dictionary containing the parameters defined in tools.parameters_bert_based
         :return: a dictionary containing the accuracy and roc-auc scores on both training and validation data
         """
+        return tools.run_folds(evaluate_fold=self.evaluate_fold, folds=folds, parameters=parameters)
+
+    def evaluate_fold(self, folds, fold_id, parameters):
+        """
+        Trains an isolated model on all but one fold and evaluates it on the remaining fold after every epoch.
+
+        :param list folds: a list of pd.DataFrames. Each of the DataFrames contains one fold of the data available
+        during the training time.
+        :param int fold_id: index of the validation fold in >folds<
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_bert_based
+        :return: a dictionary containing the per-epoch accuracy and roc-auc scores of this fold on both training and
+        validation data
+        """
         n_epochs = parameters["n_epochs"]
         lr = parameters["lr"]
         device = parameters["device"]
@@ -102,43 +160,53 @@ class BertWrapper:
         roc_auc_scores = np.zeros(n_epochs)
 
         loss_func = nn.BCELoss()
-        for fold_id in range(len(folds)):
-            print("=== Fold", fold_id + 1, "/", len(folds), "===")
-            sets = tools.train_val_split(data_folds=folds, val_fold_id=fold_id)
-            train = sets["train"]
-            val = sets["val"]
-            train_loader = self.preprocess(data=train, parameters=parameters)["loader"]
-            model = BertClassifier().to(device)  # create one model per fold split (isolated training)
-            optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)  # depends on model
-
-            for epoch in range(1, n_epochs + 1):
-                print("=== Epoch", epoch, "/", n_epochs, "===")
-                model.train()
-                for batch in train_loader:
-                    x_batch, y_batch, attention_mask = batch
-                    probas = torch.flatten(model(x=x_batch, attention_mask=attention_mask))  # forward
-                    model.zero_grad()
-                    batch_loss = loss_func(probas, y_batch)  # calculate loss
-                    batch_loss.backward()  # calculate gradients
-                    optimizer.step()  # update parameters
-
-                print("Metrics on training data after epoch", epoch, ":")
-                metrics = self.predict(model=model, data=train, parameters=parameters)
-                acc_scores_train[epoch - 1] += metrics["acc"]
-                roc_auc_scores_train[epoch - 1] += metrics["roc_auc"]
-
-                print("Metrics on validation data after epoch", epoch, ":")
-                metrics = self.predict(model=model, data=val, parameters=parameters)
-                acc_scores[epoch - 1] += metrics["acc"]
-                roc_auc_scores[epoch - 1] += metrics["roc_auc"]
-                print("\n")
-
-        for i in range(n_epochs):
-            acc_scores_train[i] /= len(folds)
-            roc_auc_scores_train[i] /= len(folds)
-
-            acc_scores[i] /= len(folds)
-            roc_auc_scores[i] /= len(folds)
+        print("=== Fold", fold_id + 1, "/", len(folds), "===")
+        sets = tools.train_val_split(data_folds=folds, val_fold_id=fold_id)
+        train = sets["train"]
+        val = sets["val"]
+        train_loader = self.preprocess(data=train, parameters=parameters)["loader"]
+        model = BertClassifier().to(device)  # create one model per fold split (isolated training)
+        optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)  # depends on model
+
+        checkpointer = tools.Checkpointer(parameters=parameters)
+        checkpoint = checkpointer.restore(name="fold" + str(fold_id), model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=parameters, keep_weights=False)
+        start_epoch = 1
+        if checkpoint is not None:  # continue the interrupted fold
+            start_epoch = checkpoint["epoch"] + 1
+            acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores = checkpoint["scores"]
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:  # also when resuming a stopped fold
+                break
+            print("=== Epoch", epoch, "/", n_epochs, "===")
+            model.train()
+            for batch in train_loader:
+                x_batch, y_batch, attention_mask = batch
+                probas = torch.flatten(model(x=x_batch, attention_mask=attention_mask))  # forward
+                model.zero_grad()
+                batch_loss = loss_func(probas, y_batch)  # calculate loss
+                batch_loss.backward()  # calculate gradients
+                optimizer.step()  # update parameters
+
+            print("Metrics on training data after epoch", epoch, ":")
+            metrics = self.predict(model=model, data=train, parameters=parameters)
+            acc_scores_train[epoch - 1] = metrics["acc"]
+            roc_auc_scores_train[epoch - 1] = metrics["roc_auc"]
+
+            print("Metrics on validation data after epoch", epoch, ":")
+            metrics = self.predict(model=model, data=val, parameters=parameters)
+            acc_scores[epoch - 1] = metrics["acc"]
+            roc_auc_scores[epoch - 1] = metrics["roc_auc"]
+            print("\n")
+            early_stopping.step(epoch=epoch, metrics=metrics, model=model)
+            checkpointer.save(name="fold" + str(fold_id), epoch=epoch, model=model, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs,
+                              scores=(acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores),
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.carry_forward(acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores)
 
         return {"acc_scores_train": acc_scores_train, "acc_scores": acc_scores,
                 "roc_auc_scores_train": roc_auc_scores_train, "roc_auc_scores": roc_auc_scores}
@@ -156,13 +224,13 @@ class BertWrapper:
         acc = 0
         roc_auc = 0
         loader = self.preprocess(data=data, parameters=parameters)["loader"]
-        for batch in loader:
-            x_batch, y_batch, attention_mask = batch
-            with torch.no_grad():
+        with tools.num_threads(n_threads=parameters["inference_threads"]), torch.inference_mode():
+            for batch in loader:
+                x_batch, y_batch, attention_mask = batch
                 probas = torch.flatten(model(x=x_batch, attention_mask=attention_mask))
-            metrics = tools.evaluate(y_true=y_batch, y_probas=probas)
-            acc += metrics["acc"]
-            roc_auc += metrics["roc_auc"]
+                metrics = tools.evaluate(y_true=y_batch, y_probas=probas)
+                acc += metrics["acc"]
+                roc_auc += metrics["roc_auc"]
 
         acc /= len(loader)
         roc_auc /= len(loader)
@@ -171,6 +239,32 @@ class BertWrapper:
         print("ROCAUC:", roc_auc)
         return {"acc": acc, "roc_auc": roc_auc}
 
+    def export(self, model, parameters, path):
+        """
+        Exports a trained BertClassifier as TorchScript and ONNX for the standalone inference_runner.py.
+        The runner expects the token ids and attention masks of the bert-base-uncased tokenizer.
+
+        :param BertClassifier model: a trained BertClassifier
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_bert_based
+        :param str path: path of the exported files without file extension
+        :return: a dictionary containing the paths of the exported files
+        """
+        return tools.export_model(model=model, example_inputs=self.example_inputs(parameters=parameters), path=path,
+                                  metadata={"max_seq_len": parameters["max_seq_len"], "tokenizer": "bert-base-uncased",
+                                            "output": "probabilities"})
+
+    @staticmethod
+    def example_inputs(parameters):
+        """
+        Creates inputs of a BertClassifier for one text of full length, e.g. for export or benchmarks.
+
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_bert_based
+        :return: a dictionary mapping the names of the forward arguments to tensors of batch size 1
+        """
+        max_seq_len = parameters["max_seq_len"]
+        return {"x": torch.zeros(1, max_seq_len, dtype=torch.long),
+                "attention_mask": torch.ones(1, max_seq_len, dtype=torch.long)}
+
     def fit(self, train_data, best_parameters):
         """
         Trains a BertClassifier on train_data using a set of parameters.
@@ -184,17 +278,29 @@ class BertWrapper:
         lr = best_parameters["lr"]
         device = best_parameters["device"]
 
-        train_data, val_data = train_test_split(train_data, test_size=0.2)
-        train_data.index = range(len(train_data))
-        val_data.index = range(len(val_data))
-
-        train_loader = self.preprocess(data=train_data, parameters=best_parameters)["loader"]
         model = BertClassifier().to(device)
         optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
         loss_func = nn.BCELoss()
 
+        checkpointer = tools.Checkpointer(parameters=best_parameters)
+        checkpoint = checkpointer.restore(name="fit", model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=best_parameters)
+        start_epoch = 1
+        if checkpoint is None:
+            train_data, val_data = train_test_split(train_data, test_size=0.2)
+            train_data.index = range(len(train_data))
+            val_data.index = range(len(val_data))
+        else:  # continue on the split of the interrupted run
+            start_epoch = checkpoint["epoch"] + 1
+            train_data, val_data = checkpoint["train_data"], checkpoint["val_data"]
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
+        train_loader = self.preprocess(data=train_data, parameters=best_parameters)["loader"]
+
         # train loop
-        for epoch in range(1, n_epochs + 1):
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:
+                break
             print("=== Epoch", epoch, "/", n_epochs, "===")
             model.train()
             for batch in train_loader:
@@ -209,10 +315,140 @@ class BertWrapper:
             print("Metrics on training data after epoch", epoch, ":")
             self.predict(model=model, data=train_data, parameters=best_parameters)
             print("Metrics on validation data after epoch", epoch, ":")
-            self.predict(model=model, data=val_data, parameters=best_parameters)
+            metrics = self.predict(model=model, data=val_data, parameters=best_parameters)
             print("\n")
+            early_stopping.step(epoch=epoch, metrics=metrics, model=model)
+            checkpointer.save(name="fit", epoch=epoch, model=model, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs,
+                              early_stopping=early_stopping.state_dict(),
+                              train_data=train_data, val_data=val_data)
+        checkpointer.wait()
+        early_stopping.restore_best(model=model)
         return {"model": model}
 
+    @staticmethod
+    def pooled_embeddings(data, parameters):
+        """
+        Returns the pooled outputs of the frozen pretrained BertModel for the texts of data. Every text is embedded
+        once under torch.inference_mode and stored in a memory-mapped file keyed by its hash (tools.TextOutputStore),
+        so BERT is only loaded and run for texts that are not stored yet.
+
+        :param pd.DataFrame data: a dataset containing a column <x_name>
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_bert_based
+        :return: a float32 torch.Tensor of shape (len(data), 768)
+        """
+        device = parameters["device"]
+        max_seq_len = parameters["max_seq_len"]
+
+        def embed(texts):
+            bert = BertModel.from_pretrained("bert-base-uncased").to(device).eval()
+
+            def pooled(x, attention_mask):
+                return bert(input_ids=x, attention_mask=attention_mask)[1]
+
+            return tools.bert_outputs(module=pooled, texts=texts, max_seq_len=max_seq_len, device=device)
+
+        store = tools.TextOutputStore(path=os.path.join(parameters["embedding_cache_dir"],
+                                                        "bert-base-uncased_pooled_" + str(max_seq_len)))
+        return torch.from_numpy(store.lookup(texts=data[parameters["x_name"]].tolist(), compute=embed))
+
+    def predict_head(self, head, data, parameters):
+        """
+        Predicts the labels of a dataset with a head trained by >fit_head< and evaluates the results against the
+        ground truth.
+
+        :param BertHead head: a trained head
+        :param pd.DataFrame data: a dataset on which the prediction has to be performed
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_bert_based
+        :return: a dictionary containing the accuracy and roc-auc score of the models predictions on the data
+        """
+        head.eval()
+        acc = 0
+        roc_auc = 0
+        x = self.pooled_embeddings(data=data, parameters=parameters).to(parameters["device"])
+        y = torch.tensor(data[parameters["y_name"]].values).to(parameters["device"])
+        dataset = TensorDataset(x, y)
+        loader = DataLoader(dataset=dataset, batch_size=parameters["batch_size"], sampler=RandomSampler(dataset))
+        with torch.inference_mode():
+            for batch in loader:
+                x_batch, y_batch = batch
+                probas = torch.flatten(head(x=x_batch))
+                metrics = tools.evaluate(y_true=y_batch, y_probas=probas)
+                acc += metrics["acc"]
+                roc_auc += metrics["roc_auc"]
+
+        acc /= len(loader)
+        roc_auc /= len(loader)
+
+        print("Accuracy:", acc)
+        print("ROCAUC:", roc_auc)
+        return {"acc": acc, "roc_auc": roc_auc}
+
+    def fit_head(self, train_data, best_parameters):
+        """
+        Trains only the classification head of a BertClassifier on train_data, using the pooled outputs of the frozen
+        pretrained BertModel (see >pooled_embeddings<). BERT runs once per text instead of once per batch and epoch.
+
+        :param pd.DataFrame train_data: data on which the head has to be trained
+        :param dict best_parameters: a dictionary containing the parameters defined in tools.parameters_bert_based
+        :return: a dictionary containing the trained head and a BertClassifier using it for serving
+        """
+        n_epochs = best_parameters["n_epochs"]
+        lr = best_parameters["lr"]
+        device = best_parameters["device"]
+
+        head = BertHead().to(device)
+        optimizer = AdamW(head.parameters(), lr=lr, eps=1e-8)
+        loss_func = nn.BCELoss()
+
+        checkpointer = tools.Checkpointer(parameters=best_parameters)
+        checkpoint = checkpointer.restore(name="fit_head", model=head, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=best_parameters)
+        start_epoch = 1
+        if checkpoint is None:
+            train_data, val_data = train_test_split(train_data, test_size=0.2)
+            train_data.index = range(len(train_data))
+            val_data.index = range(len(val_data))
+        else:  # continue on the split of the interrupted run
+            start_epoch = checkpoint["epoch"] + 1
+            train_data, val_data = checkpoint["train_data"], checkpoint["val_data"]
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
+        x = self.pooled_embeddings(data=train_data, parameters=best_parameters).to(device)
+        y = torch.tensor(train_data[best_parameters["y_name"]].values, dtype=torch.float32).to(device)
+        dataset = TensorDataset(x, y)
+        train_loader = DataLoader(dataset=dataset, batch_size=best_parameters["batch_size"],
+                                  sampler=RandomSampler(dataset))
+
+        # train loop
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:
+                break
+            print("=== Epoch", epoch, "/", n_epochs, "===")
+            head.train()
+            for batch in train_loader:
+                x_batch, y_batch = batch
+                probas = torch.flatten(head(x=x_batch))
+                head.zero_grad()
+                batch_loss = loss_func(probas, y_batch)
+                batch_loss.backward()
+                optimizer.step()
+
+            print("Metrics on training data after epoch", epoch, ":")
+            self.predict_head(head=head, data=train_data, parameters=best_parameters)
+            print("Metrics on validation data after epoch", epoch, ":")
+            metrics = self.predict_head(head=head, data=val_data, parameters=best_parameters)
+            print("\n")
+            early_stopping.step(epoch=epoch, metrics=metrics, model=head)
+            checkpointer.save(name="fit_head", epoch=epoch, model=head, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs,
+                              early_stopping=early_stopping.state_dict(),
+                              train_data=train_data, val_data=val_data)
+        checkpointer.wait()
+        early_stopping.restore_best(model=head)
+        model = BertClassifier().load_head(head=head).to(device)
+        return {"head": head, "model": model}
+
 
 # read the datasets
 folds = tools.read_folds(prefix="undersampled_stopped_text", read_path="../../data/folds_nlp", test_fold_id=0)
@@ -244,3 +480,16 @@ bert_wrapper = BertWrapper()
 best_bert_clf = bert_wrapper.fit(train_data=train_data, best_parameters=parameters1)["model"]
 print("\nPERFORMANCE ON TEST:")
 bert_wrapper.predict(model=best_bert_clf, data=test_fold, parameters=parameters1)
+
+# int8 model for cpu-only inference hosts: latency at several batch sizes and the metric delta on test
+# quantized_bert = tools.quantize_dynamic(model=best_bert_clf)
+# tools.quantization_report(wrapper=bert_wrapper, float_model=best_bert_clf, quantized_model=quantized_bert,
+#                           data=test_fold, parameters=dict(parameters1, inference_threads=4),
+#                           example_inputs=bert_wrapper.example_inputs(parameters=parameters1))
+
+# head-only training on the pooled outputs of the frozen BERT, which are computed once and cached in
+# parameters["embedding_cache_dir"]. The head is served inside a full BertClassifier
+# parameters_head = tools.parameters_bert_based(n_epochs=20, lr=1e-3, max_seq_len=16, batch_size=32, x_name="text",
+#                                               y_name="label", device=device, patience=3)
+# fitted_head = bert_wrapper.fit_head(train_data=train_data, best_parameters=parameters_head)
+# bert_wrapper.predict(model=fitted_head["model"], data=test_fold, parameters=parameters_head)
@@ -1,9 +1,11 @@
+import os
+
 import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
 from nltk import TweetTokenizer
-from torch.utils.data import DataLoader, RandomSampler, TensorDataset
+from torch.utils.data import TensorDataset
 from transformers import AdamW
 
 import tools
@@ -14,7 +16,7 @@ class RNNEClassifier(nn.Module):
     An RNN-based classifier that trains word embeddings itself.
     """
 
-    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, vocab_size):
+    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, vocab_size, packed=True):
         """
         Constructor.
 
@@ -24,10 +26,12 @@ class RNNEClassifier(nn.Module):
         :param int n_layers: number of lstm layers
         :param int n_classes: determines how many classes have to be handled. 2 in binary case.
         :param int vocab_size: number of tokens identified during training.
+        :param bool packed: whether the padding of the sequences is skipped (packed sequences)
         """
         super(RNNEClassifier, self).__init__()
         self.n_layers = n_layers
         self.hidden_size = hidden_size
+        self.packed = packed
         # vocab size + padding_token + out_of_vocab_token, i.e. vocab_size+2
         self.emb = nn.Embedding(num_embeddings=vocab_size + 2, embedding_dim=feats_per_time_step, padding_idx=0)
         self.rnn = nn.RNN(feats_per_time_step, hidden_size, n_layers, batch_first=True)
@@ -40,10 +44,11 @@ class RNNEClassifier(nn.Module):
         :param torch.Tensor x: the input/observation per batch
         :return: the prediction of the whole batch
         """
+        lengths = tools.sequence_lengths(x=x)
         x = self.emb(x)
-        h0 = torch.zeros(self.n_layers, x.size(0), self.hidden_size).to(device)
-        out, _ = self.rnn(x, h0)  # size: batch_size x seq_len x hidden_size
-        out = out[:, -1, :]
+        h0 = x.new_zeros(self.n_layers, x.size(0), self.hidden_size)
+        out = tools.recurrent_features(recurrent=self.rnn, x=x, lengths=lengths, initial_state=h0,
+                                       packed=self.packed)
         out = self.linear(out)
         return out
 
@@ -53,7 +58,7 @@ class BiRNNEClassifier(nn.Module):
     A bidirectional RNN-based classifier that trains word embeddings itself.
     """
 
-    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, vocab_size):
+    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, vocab_size, packed=True):
         """
         Constructor.
 
@@ -63,10 +68,12 @@ class BiRNNEClassifier(nn.Module):
         :param int n_layers: number of lstm layers
         :param int n_classes: determines how many classes have to be handled. 2 in binary case.
         :param int vocab_size: number of tokens identified during training.
+        :param bool packed: whether the padding of the sequences is skipped (packed sequences)
         """
         super(BiRNNEClassifier, self).__init__()
         self.n_layers = n_layers
         self.hidden_size = hidden_size
+        self.packed = packed
         # vocab size + padding_token + out_of_vocab_token, i.e. vocab_size+2
         self.emb = nn.Embedding(num_embeddings=vocab_size + 2, embedding_dim=feats_per_time_step, padding_idx=0)
         self.rnn = nn.RNN(feats_per_time_step, hidden_size, n_layers, batch_first=True, bidirectional=True)
@@ -79,12 +86,11 @@ class BiRNNEClassifier(nn.Module):
         :param torch.Tensor x: the input/observation per batch
         :return: the prediction of the whole batch
         """
+        lengths = tools.sequence_lengths(x=x)
         x = self.emb(x)
-        h0 = torch.zeros(self.n_layers*2, x.size(0), self.hidden_size).to(device)
-        out, _ = self.rnn(x, h0)  # size: batch_size x seq_len x hidden_size
-        out_direction1 = out[:, -1, :self.hidden_size]  # regular
-        out_direction2 = out[:, 0, self.hidden_size:]  # reverse
-        out = torch.cat((out_direction1, out_direction2), 1)
+        h0 = x.new_zeros(self.n_layers*2, x.size(0), self.hidden_size)
+        out = tools.recurrent_features(recurrent=self.rnn, x=x, lengths=lengths, initial_state=h0,
+                                       packed=self.packed)
         out = self.linear(out)
         return out
 
@@ -94,7 +100,7 @@ class GRUEClassifier(nn.Module):
     A GRU-based classifier that trains word embeddings itself.
     """
 
-    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, vocab_size):
+    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, vocab_size, packed=True):
         """
         Constructor.
 
@@ -104,10 +110,12 @@ class GRUEClassifier(nn.Module):
         :param int n_layers: number of lstm layers
         :param int n_classes: determines how many classes have to be handled. 2 in binary case.
         :param int vocab_size: number of tokens identified during training.
+        :param bool packed: whether the padding of the sequences is skipped (packed sequences)
         """
         super(GRUEClassifier, self).__init__()
         self.n_layers = n_layers
         self.hidden_size = hidden_size
+        self.packed = packed
         # vocab size + padding_token + out_of_vocab_token, i.e. vocab_size+2
         self.emb = nn.Embedding(num_embeddings=vocab_size + 2, embedding_dim=feats_per_time_step, padding_idx=0)
         self.gru = nn.GRU(feats_per_time_step, hidden_size, n_layers, batch_first=True)
@@ -120,10 +128,11 @@ class GRUEClassifier(nn.Module):
         :param torch.Tensor x: the input/observation per batch
         :return: the prediction of the whole batch
         """
+        lengths = tools.sequence_lengths(x=x)
         x = self.emb(x)
-        h0 = torch.zeros(self.n_layers, x.size(0), self.hidden_size).to(device)
-        out, _ = self.gru(x, h0)
-        out = out[:, -1, :]
+        h0 = x.new_zeros(self.n_layers, x.size(0), self.hidden_size)
+        out = tools.recurrent_features(recurrent=self.gru, x=x, lengths=lengths, initial_state=h0,
+                                       packed=self.packed)
         out = self.linear(out)
         return out
 
@@ -133,7 +142,7 @@ class BiGRUEClassifier(nn.Module):
     A bidirectional GRU-based classifier that trains word embeddings itself.
     """
 
-    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, vocab_size):
+    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, vocab_size, packed=True):
         """
         Constructor.
 
@@ -143,10 +152,12 @@ class BiGRUEClassifier(nn.Module):
         :param int n_layers: number of lstm layers
         :param int n_classes: determines how many classes have to be handled. 2 in binary case.
         :param int vocab_size: number of tokens identified during training.
+        :param bool packed: whether the padding of the sequences is skipped (packed sequences)
         """
         super(BiGRUEClassifier, self).__init__()
         self.n_layers = n_layers
         self.hidden_size = hidden_size
+        self.packed = packed
         # vocab size + padding_token + out_of_vocab_token, i.e. vocab_size+2
         self.emb = nn.Embedding(num_embeddings=vocab_size + 2, embedding_dim=feats_per_time_step, padding_idx=0)
         self.gru = nn.GRU(feats_per_time_step, hidden_size, n_layers, batch_first=True, bidirectional=True)
@@ -159,12 +170,11 @@ class BiGRUEClassifier(nn.Module):
         :param torch.Tensor x: the input/observation per batch
         :return: the prediction of the whole batch
         """
+        lengths = tools.sequence_lengths(x=x)
         x = self.emb(x)
-        h0 = torch.zeros(self.n_layers*2, x.size(0), self.hidden_size).to(device)
-        out, _ = self.gru(x, h0)
-        out_direction1 = out[:, -1, :self.hidden_size]  # regular
-        out_direction2 = out[:, 0, self.hidden_size:]  # reverse
-        out = torch.cat((out_direction1, out_direction2), 1)
+        h0 = x.new_zeros(self.n_layers*2, x.size(0), self.hidden_size)
+        out = tools.recurrent_features(recurrent=self.gru, x=x, lengths=lengths, initial_state=h0,
+                                       packed=self.packed)
         out = self.linear(out)
         return out
 
@@ -174,7 +184,7 @@ class LSTMEClassifier(nn.Module):
     An LSTM-based classifier that trains word embeddings itself.
     """
 
-    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, vocab_size):
+    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, vocab_size, packed=True):
         """
         Constructor.
 
@@ -184,10 +194,12 @@ class LSTMEClassifier(nn.Module):
         :param int n_layers: number of lstm layers
         :param int n_classes: determines how many classes have to be handled. 2 in binary case.
         :param int vocab_size: number of tokens identified during training.
+        :param bool packed: whether the padding of the sequences is skipped (packed sequences)
         """
         super(LSTMEClassifier, self).__init__()
         self.n_layers = n_layers
         self.hidden_size = hidden_size
+        self.packed = packed
         # vocab size + padding_token + out_of_vocab_token, i.e. vocab_size+2
         self.emb = nn.Embedding(num_embeddings=vocab_size + 2, embedding_dim=feats_per_time_step, padding_idx=0)
         self.lstm = nn.LSTM(feats_per_time_step, hidden_size, n_layers, batch_first=True)
@@ -200,11 +212,12 @@ class LSTMEClassifier(nn.Module):
         :param torch.Tensor x: the input/observation per batch
         :return: the prediction of the whole batch
         """
+        lengths = tools.sequence_lengths(x=x)
         x = self.emb(x)
-        h0 = torch.zeros(self.n_layers, x.size(0), self.hidden_size).to(device)
-        c0 = torch.zeros(self.n_layers, x.size(0), self.hidden_size).to(device)
-        out, _ = self.lstm(x, (h0, c0))
-        out = out[:, -1, :]
+        h0 = x.new_zeros(self.n_layers, x.size(0), self.hidden_size)
+        c0 = x.new_zeros(self.n_layers, x.size(0), self.hidden_size)
+        out = tools.recurrent_features(recurrent=self.lstm, x=x, lengths=lengths, initial_state=(h0, c0),
+                                       packed=self.packed)
         out = self.linear(out)
         return out
 
@@ -214,7 +227,7 @@ class BiLSTMEClassifier(nn.Module):
     A bidirectional LSTM-based classifier that trains word embeddings itself.
     """
 
-    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, vocab_size):
+    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, vocab_size, packed=True):
         """
         Constructor.
 
@@ -224,10 +237,12 @@ class BiLSTMEClassifier(nn.Module):
         :param int n_layers: number of lstm layers
         :param int n_classes: determines how many classes have to be handled. 2 in binary case.
         :param int vocab_size: number of tokens identified during training.
+        :param bool packed: whether the padding of the sequences is skipped (packed sequences)
         """
         super(BiLSTMEClassifier, self).__init__()
         self.n_layers = n_layers
         self.hidden_size = hidden_size
+        self.packed = packed
         # vocab size + padding_token + out_of_vocab_token, i.e. vocab_size+2
         self.emb = nn.Embedding(num_embeddings=vocab_size + 2, embedding_dim=feats_per_time_step, padding_idx=0)
         self.lstm = nn.LSTM(feats_per_time_step, hidden_size, n_layers, batch_first=True, bidirectional=True)
@@ -240,13 +255,12 @@ class BiLSTMEClassifier(nn.Module):
         :param torch.Tensor x: the input/observation per batch
         :return: the prediction of the whole batch
         """
+        lengths = tools.sequence_lengths(x=x)
         x = self.emb(x)
-        h0 = torch.zeros(self.n_layers*2, x.size(0), self.hidden_size).to(device)
-        c0 = torch.zeros(self.n_layers*2, x.size(0), self.hidden_size).to(device)
-        out, _ = self.lstm(x, (h0, c0))
-        out_direction1 = out[:, -1, :self.hidden_size]  # regular
-        out_direction2 = out[:, 0, self.hidden_size:]  # reverse
-        out = torch.cat((out_direction1, out_direction2), 1)
+        h0 = x.new_zeros(self.n_layers*2, x.size(0), self.hidden_size)
+        c0 = x.new_zeros(self.n_layers*2, x.size(0), self.hidden_size)
+        out = tools.recurrent_features(recurrent=self.lstm, x=x, lengths=lengths, initial_state=(h0, c0),
+                                       packed=self.packed)
         out = self.linear(out)
         return out
 
@@ -269,14 +283,13 @@ class EmbeddingWrapper:
         :param pd.DataFrame data: one fold of data to be processed. Contains a column <x_name> containing text
         sequences and another column <y_name> containing the class labels of the sequence
         :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
-        :param pd.Series vocab: the vocabulary handled for the preprocessing, if None, a new vocabulary for the whole
+        :param tools.Vocab vocab: the vocabulary handled for the preprocessing, if None, a new vocabulary for the whole
         textual information in data is created (create new one on train, use existing one for test/val)
         :return: a dictionary having the key "loader" and the constructed DataLoader as value;
         If vocab=None, the key "vocab" is added to the dictionary. The value of that key
         is the extracted vocabulary from the whole data
         """
         max_seq_len = parameters["max_seq_len"]
-        batch_size = parameters["batch_size"]
         x_name = parameters["x_name"]
         y_name = parameters["y_name"]
         device = parameters["device"]
@@ -294,88 +307,41 @@ class EmbeddingWrapper:
             """
             return tweet_tokenizer.tokenize(sequence)
 
-        def generate_vocab(tokenized_train):
-            """
-            Generates the vocabulary on the whole tokenized textual data.
-
-            :param pd.Series tokenized_train: a pd.Series having lists of separated tokens of the respective
-            sequences/observations as values.
-            :return: a pd.Series representing the vocabulary-mapping. The indices (1...N) are the token
-            ids, and the values are the corresponding strings of the tokens.
-            """
-            all_tokens = []
-
-            def collapse_sequences(row, all_tokens):
-                """
-                Combines lists of tokens to one large list of tokens.
-
-                :param list row: a list of tokens stored in one row of the column having the textual data.
-                :param list all_tokens: a list having all already concatenated tokens
-                """
-                all_tokens += row
-
-            tokenized_train.apply(func=collapse_sequences, all_tokens=all_tokens)
-            vocab = pd.Series(all_tokens, name="token").drop_duplicates()
-            vocab.index = np.arange(start=1, stop=len(vocab) + 1)  # start with index 1, 0 will be used for padding
-            return vocab
-
-        def encode_tokens(tokenized_data, vocab):
+        def encode():
             """
-            Encodes token ids.
+            Tokenizes and encodes the texts, building the vocabulary first if none is given.
 
-            :param pd.Series tokenized_data: a pd.Series containing the tokenized sequences. Each tokenized sequence is
-            a list of strings
-            :param pd.Series vocab: a pd.Series having token ids as indices and token strings as values.
-            :return: a pd.Series of lists of encoded tokens. Each token is encoded by its own id
+            :return: a dictionary containing the encoded texts "x", the labels "y" and the used "vocab"
             """
-
-            def encode_row(row):
-                """
-                Encodes one row/observation/sequence of tokenized textual data.
-                Might truncate or pad the sequence.
-
-                :param list row: a list of strings containing tokens from a sequence
-                :return: the encoded row stored in a list
-                """
-                encoded_row = []
-                for i, token in enumerate(row):
-                    if token in list(vocab.values):
-                        encoded_row.append(vocab.loc[vocab == token].index[0])
-                    else:
-                        encoded_row.append(len(vocab) + 1)  # out of vocabulary token
-                    if i == max_seq_len - 1:
-                        break  # truncate long sequences if necessary
-                padding = [0] * (max_seq_len - len(encoded_row))
-                return encoded_row + padding
-
-            return tokenized_data.apply(func=encode_row)
-
-        if vocab is None:
-            x_tokens = text_col.apply(func=tokenize_sequence)
-            vocab = generate_vocab(tokenized_train=x_tokens)
-            x_encoded = encode_tokens(tokenized_data=x_tokens, vocab=vocab)
-            x_encoded = torch.tensor(x_encoded, dtype=torch.long).to(device)
-            y = torch.tensor(target_col, dtype=torch.long).to(device)  # long for CrossEntropyLoss
-            dataset = TensorDataset(x_encoded, y)
-            sampler = RandomSampler(dataset)
-            loader = DataLoader(dataset=dataset, batch_size=batch_size, sampler=sampler)
-            return {"loader": loader, "vocab": vocab}
-        else:
             x_tokens = text_col.apply(func=tokenize_sequence)
-            x_encoded = encode_tokens(tokenized_data=x_tokens, vocab=vocab)
-            x_encoded = torch.tensor(x_encoded, dtype=torch.long).to(device)
-            y = torch.tensor(target_col, dtype=torch.long).to(device)
-            dataset = TensorDataset(x_encoded, y)
-            sampler = RandomSampler(dataset)
-            loader = DataLoader(dataset=dataset, batch_size=batch_size, sampler=sampler)
-            return {"loader": loader}  # to preserve the pattern
+            used_vocab = vocab
+            if used_vocab is None:
+                used_vocab = tools.Vocab.build(tokenized_texts=x_tokens, min_freq=parameters["min_vocab_freq"],
+                                               max_size=parameters["max_vocab_size"])
+            x_encoded = used_vocab.encode_batch(tokenized_texts=x_tokens, max_seq_len=max_seq_len)
+            return {"x": torch.from_numpy(x_encoded).to(dtype=torch.long),
+                    "y": torch.tensor(target_col, dtype=torch.long),  # long for CrossEntropyLoss
+                    "vocab": used_vocab}
+
+        tokenizer = "TweetTokenizer"
+        if vocab is None:
+            tokenizer += "|vocab " + str(parameters["min_vocab_freq"]) + " " + str(parameters["max_vocab_size"])
+        encoded = tools.cached_encoding(data=data, parameters=parameters, tokenizer=tokenizer, encode=encode,
+                                        vocab=vocab)
+        dataset = TensorDataset(encoded["x"].to(device), encoded["y"].to(device))
+        loader = tools.text_loader(dataset=dataset, lengths=tools.sequence_lengths(x=encoded["x"]),
+                                   parameters=parameters)
+        if vocab is None:
+            return {"loader": loader, "vocab": encoded["vocab"]}
+        return {"loader": loader}  # to preserve the pattern
 
-    def fit(self, train_data, best_parameters):
+    def fit(self, train_data, best_parameters, val_data=None):
         """
         Trains a textual classifier on train_data using a set of parameters.
 
         :param pd.DataFrame train_data: data on which the model has to be trained
         :param dict best_parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
+        :param pd.DataFrame val_data: validation data evaluated after every epoch. Required for early stopping
         :return: The trained model
         """
         n_epochs = best_parameters["n_epochs"]
@@ -393,12 +359,25 @@ class EmbeddingWrapper:
                                  hidden_size=hidden_size,
                                  n_layers=n_layers,
                                  n_classes=n_classes,
-                                 vocab_size=len(vocab)).to(device)
+                                 vocab_size=len(vocab),
+                                 packed=best_parameters["packed_sequences"]).to(device)
         optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
         loss_func = nn.CrossEntropyLoss()
 
+        checkpointer = tools.Checkpointer(parameters=best_parameters)
+        checkpoint = checkpointer.restore(name="fit", model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=best_parameters)
+        if early_stopping.enabled and val_data is None:
+            raise ValueError("early stopping (patience) requires val_data")
+        start_epoch = 1
+        if checkpoint is not None:
+            start_epoch = checkpoint["epoch"] + 1
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
         # train loop
-        for epoch in range(1, n_epochs + 1):
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:
+                break
             print("=== Epoch", epoch, "/", n_epochs, "===")
             model.train()
             for i, batch in enumerate(train_loader):
@@ -411,6 +390,111 @@ class EmbeddingWrapper:
 
             print("Metrics on training data after epoch", epoch, ":")
             self.predict(model=model, data=train_data, parameters=best_parameters, vocab=vocab)
+            if val_data is not None:
+                print("Metrics on validation data after epoch", epoch, ":")
+                metrics = self.predict(model=model, data=val_data, parameters=best_parameters, vocab=vocab)
+                early_stopping.step(epoch=epoch, metrics=metrics, model=model)
+            checkpointer.save(name="fit", epoch=epoch, model=model, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs,
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.restore_best(model=model)
+        return {"model": model, "vocab": vocab}
+
+    def distill(self, train_data, best_parameters, teacher, teacher_parameters, val_data=None):
+        """
+        Trains a textual classifier on train_data to mimic a trained BertClassifier (knowledge distillation).
+        The teacher scores every training text once, its logits are cached on disk per text
+        (see tools.TextOutputStore), so later runs with the same teacher skip BERT entirely.
+        The loss blends the cross entropy on the labels with the cross entropy on the teacher's temperature-softened
+        probabilities: alpha * hard + (1 - alpha) * T^2 * soft.
+
+        :param pd.DataFrame train_data: data on which the model has to be trained
+        :param dict best_parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
+        :param nn.Module teacher: a trained BertClassifier
+        :param dict teacher_parameters: a dictionary containing the parameters defined in tools.parameters_bert_based
+        the teacher was trained with
+        :param pd.DataFrame val_data: validation data evaluated after every epoch. Required for early stopping
+        :return: a dictionary containing the trained student model and its vocab
+        """
+        n_epochs = best_parameters["n_epochs"]
+        lr = best_parameters["lr"]
+        n_layers = best_parameters["n_layers"]
+        feats_per_time_step = best_parameters["feats_per_time_step"]
+        hidden_size = best_parameters["hidden_size"]
+        n_classes = best_parameters["n_classes"]
+        device = best_parameters["device"]
+        alpha = best_parameters["distill_alpha"]
+        temperature = best_parameters["distill_temperature"]
+        if n_classes != 2:
+            raise ValueError("the BertClassifier teacher is binary, but n_classes is " + str(n_classes))
+
+        def teacher_logits(texts):
+            return tools.bert_outputs(module=teacher.logits, texts=texts, max_seq_len=teacher_parameters["max_seq_len"],
+                                      device=teacher_parameters["device"])
+
+        teacher.eval()
+        store = tools.TextOutputStore(path=os.path.join(best_parameters["teacher_cache_dir"],
+                                                        "bert_raw_logits_" + tools.model_fingerprint(model=teacher)
+                                                        + "_" + str(teacher_parameters["max_seq_len"])))
+        logits = torch.from_numpy(store.lookup(texts=train_data[best_parameters["x_name"]].tolist(),
+                                               compute=teacher_logits))
+        soft_targets = torch.sigmoid(logits.flatten() / temperature).to(device)  # softened probability of class 1
+
+        preprocessed = self.preprocess(data=train_data, parameters=best_parameters)
+        vocab = preprocessed["vocab"]
+        x, y = preprocessed["loader"].dataset.tensors  # rows are in the order of train_data
+        train_loader = tools.text_loader(dataset=TensorDataset(x, y, soft_targets),
+                                         lengths=tools.sequence_lengths(x=x),
+                                         parameters=best_parameters)
+        model = self.model_class(feats_per_time_step=feats_per_time_step,
+                                 hidden_size=hidden_size,
+                                 n_layers=n_layers,
+                                 n_classes=n_classes,
+                                 vocab_size=len(vocab),
+                                 packed=best_parameters["packed_sequences"]).to(device)
+        optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
+        loss_func = nn.CrossEntropyLoss()
+
+        checkpointer = tools.Checkpointer(parameters=best_parameters)
+        checkpoint = checkpointer.restore(name="distill", model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=best_parameters)
+        if early_stopping.enabled and val_data is None:
+            raise ValueError("early stopping (patience) requires val_data")
+        start_epoch = 1
+        if checkpoint is not None:
+            start_epoch = checkpoint["epoch"] + 1
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
+        # train loop
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:
+                break
+            print("=== Epoch", epoch, "/", n_epochs, "===")
+            model.train()
+            for i, batch in enumerate(train_loader):
+                x_batch, y_batch, soft_batch = batch
+                probas = model(x=x_batch)
+                model.zero_grad()
+                hard_loss = loss_func(probas, y_batch)
+                targets = torch.stack((1 - soft_batch, soft_batch), dim=1)
+                soft_loss = -(targets * torch.log_softmax(probas / temperature, dim=1)).sum(dim=1).mean()
+                # T^2 keeps the gradients of the soft loss on the scale of the hard loss
+                batch_loss = alpha * hard_loss + (1 - alpha) * temperature ** 2 * soft_loss
+                batch_loss.backward()
+                optimizer.step()
+
+            print("Metrics on training data after epoch", epoch, ":")
+            self.predict(model=model, data=train_data, parameters=best_parameters, vocab=vocab)
+            if val_data is not None:
+                print("Metrics on validation data after epoch", epoch, ":")
+                metrics = self.predict(model=model, data=val_data, parameters=best_parameters, vocab=vocab)
+                early_stopping.step(epoch=epoch, metrics=metrics, model=model)
+            checkpointer.save(name="distill", epoch=epoch, model=model, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs,
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.restore_best(model=model)
         return {"model": model, "vocab": vocab}
 
     def evaluate_hyperparameters(self, folds, parameters):
@@ -422,6 +506,19 @@ class EmbeddingWrapper:
         :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
         :return: a dictionary containing the accuracy and roc-auc scores on both training and validation data
         """
+        return tools.run_folds(evaluate_fold=self.evaluate_fold, folds=folds, parameters=parameters)
+
+    def evaluate_fold(self, folds, fold_id, parameters):
+        """
+        Trains an isolated model on all but one fold and evaluates it on the remaining fold after every epoch.
+
+        :param list folds: a list of pd.DataFrames. Each of the DataFrames contains one fold of the data available
+        during the training time.
+        :param int fold_id: index of the validation fold in >folds<
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
+        :return: a dictionary containing the per-epoch accuracy and roc-auc scores of this fold on both training and
+        validation data
+        """
         device = parameters["device"]
         n_epochs = parameters["n_epochs"]
         lr = parameters["lr"]
@@ -437,49 +534,60 @@ class EmbeddingWrapper:
         roc_auc_scores = np.zeros(n_epochs)
 
         loss_func = nn.CrossEntropyLoss()
-        for fold_id in range(len(folds)):
-            print("=== Fold", fold_id + 1, "/", len(folds), "===")
-            sets = tools.train_val_split(data_folds=folds, val_fold_id=fold_id)
-            train = sets["train"]
-            val = sets["val"]
-            preprocessed = self.preprocess(data=train, parameters=parameters)
-            train_loader = preprocessed["loader"]
-            vocab = preprocessed["vocab"]
-            model = self.model_class(feats_per_time_step=feats_per_time_step,
-                                     hidden_size=hidden_size,
-                                     n_layers=n_layers,
-                                     n_classes=n_classes,
-                                     vocab_size=len(vocab)).to(device)  # isolated model per fold
-            optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)  # depends on model
-
-            for epoch in range(1, n_epochs + 1):
-                print("=== Epoch", epoch, "/", n_epochs, "===")
-                model.train()
-                for i, batch in enumerate(train_loader):
-                    x_batch, y_batch = batch
-                    probas = model(x=x_batch)  # forward
-                    model.zero_grad()
-                    batch_loss = loss_func(probas, y_batch)  # calculate loss
-                    batch_loss.backward()  # calculate gradients
-                    optimizer.step()  # update parameters
-
-                print("Metrics on training data after epoch", epoch, ":")
-                metrics = self.predict(model=model, data=train, parameters=parameters, vocab=vocab)
-                acc_scores_train[epoch - 1] += metrics["acc"]
-                roc_auc_scores_train[epoch - 1] += metrics["roc_auc"]
-
-                print("Metrics on validation data after epoch", epoch, ":")
-                metrics = self.predict(model=model, data=val, parameters=parameters, vocab=vocab)
-                acc_scores[epoch - 1] += metrics["acc"]
-                roc_auc_scores[epoch - 1] += metrics["roc_auc"]
-                print("\n")
-
-        for i in range(n_epochs):
-            acc_scores_train[i] /= len(folds)
-            roc_auc_scores_train[i] /= len(folds)
+        print("=== Fold", fold_id + 1, "/", len(folds), "===")
+        sets = tools.train_val_split(data_folds=folds, val_fold_id=fold_id)
+        train = sets["train"]
+        val = sets["val"]
+        preprocessed = self.preprocess(data=train, parameters=parameters)
+        train_loader = preprocessed["loader"]
+        vocab = preprocessed["vocab"]
+        model = self.model_class(feats_per_time_step=feats_per_time_step,
+                                 hidden_size=hidden_size,
+                                 n_layers=n_layers,
+                                 n_classes=n_classes,
+                                 vocab_size=len(vocab),
+                                 packed=parameters["packed_sequences"]).to(device)  # isolated model per fold
+        optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)  # depends on model
+
+        checkpointer = tools.Checkpointer(parameters=parameters)
+        checkpoint = checkpointer.restore(name="fold" + str(fold_id), model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=parameters, keep_weights=False)
+        start_epoch = 1
+        if checkpoint is not None:  # continue the interrupted fold
+            start_epoch = checkpoint["epoch"] + 1
+            acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores = checkpoint["scores"]
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:  # also when resuming a stopped fold
+                break
+            print("=== Epoch", epoch, "/", n_epochs, "===")
+            model.train()
+            for i, batch in enumerate(train_loader):
+                x_batch, y_batch = batch
+                probas = model(x=x_batch)  # forward
+                model.zero_grad()
+                batch_loss = loss_func(probas, y_batch)  # calculate loss
+                batch_loss.backward()  # calculate gradients
+                optimizer.step()  # update parameters
 
-            acc_scores[i] /= len(folds)
-            roc_auc_scores[i] /= len(folds)
+            print("Metrics on training data after epoch", epoch, ":")
+            metrics = self.predict(model=model, data=train, parameters=parameters, vocab=vocab)
+            acc_scores_train[epoch - 1] = metrics["acc"]
+            roc_auc_scores_train[epoch - 1] = metrics["roc_auc"]
+
+            print("Metrics on validation data after epoch", epoch, ":")
+            metrics = self.predict(model=model, data=val, parameters=parameters, vocab=vocab)
+            acc_scores[epoch - 1] = metrics["acc"]
+            roc_auc_scores[epoch - 1] = metrics["roc_auc"]
+            print("\n")
+            early_stopping.step(epoch=epoch, metrics=metrics, model=model)
+            checkpointer.save(name="fold" + str(fold_id), epoch=epoch, model=model, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs,
+                              scores=(acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores),
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.carry_forward(acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores)
 
         return {"acc_scores_train": acc_scores_train, "acc_scores": acc_scores,
                 "roc_auc_scores_train": roc_auc_scores_train, "roc_auc_scores": roc_auc_scores}
@@ -491,7 +599,7 @@ class EmbeddingWrapper:
         :param nn.Module model: a trained text classifier
         :param pd.DataFrame data: a dataset on which the prediction has to be performed
         :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
-        :param pd.Series vocab: a trained vocab mapping that maps tokens to integers
+        :param tools.Vocab vocab: a trained vocab mapping that maps tokens to integers
         :return: a dictionary containing the accuracy and roc-auc score of the models predictions on the data
         """
         model.eval()
@@ -514,6 +622,78 @@ class EmbeddingWrapper:
         print("ROCAUC:", roc_auc)
         return {"acc": acc, "roc_auc": roc_auc}
 
+    def distillation_report(self, student, vocab, teacher, data, parameters, teacher_parameters,
+                            batch_sizes=(1, 8, 32), n_batches=5):
+        """
+        Compares a distilled student with its BertClassifier teacher side by side: accuracy and roc-auc on data, and
+        latency and throughput on the cpu at several batch sizes.
+        Like every predict function, the metrics are averaged over the batches: the student's come from >predict<,
+        the teacher's are averaged over batches of teacher_parameters["batch_size"] texts as in BertWrapper.predict.
+
+        :param nn.Module student: a classifier trained by >distill<
+        :param tools.Vocab vocab: the vocab of the student
+        :param nn.Module teacher: the trained BertClassifier
+        :param pd.DataFrame data: the evaluation data
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
+        :param dict teacher_parameters: a dictionary containing the parameters defined in tools.parameters_bert_based
+        :param tuple batch_sizes: the timed batch sizes
+        :param int n_batches: number of timed batches per model and batch size
+        :return: a pd.DataFrame containing the metrics and the latency of both models per batch size
+        """
+        batch_size = teacher_parameters["batch_size"]
+        teacher.eval()
+        teacher_probas = torch.from_numpy(tools.bert_outputs(module=teacher, texts=data[parameters["x_name"]].tolist(),
+                                                             max_seq_len=teacher_parameters["max_seq_len"],
+                                                             device=teacher_parameters["device"],
+                                                             batch_size=batch_size)).flatten()
+        y_true = torch.tensor(data[parameters["y_name"]].values)
+        acc = 0
+        roc_auc = 0
+        starts = range(0, len(data), batch_size)
+        for start in starts:
+            metrics = tools.evaluate(y_true=y_true[start:start + batch_size],
+                                     y_probas=teacher_probas[start:start + batch_size])
+            acc += metrics["acc"]
+            roc_auc += metrics["roc_auc"]
+        teacher_metrics = {"acc": acc / len(starts), "roc_auc": roc_auc / len(starts)}
+        print("Metrics of the teacher:")
+        print("Accuracy:", teacher_metrics["acc"])
+        print("ROCAUC:", teacher_metrics["roc_auc"])
+        print("Metrics of the student:")
+        student_metrics = self.predict(model=student, data=data, parameters=parameters, vocab=vocab)
+        metrics = {"teacher": teacher_metrics, "student": student_metrics}
+
+        max_seq_len = teacher_parameters["max_seq_len"]
+        teacher_latency = tools.latency_benchmark(
+            models={"teacher": tools.cpu_float_copy(model=teacher)},
+            example_inputs={"x": torch.zeros(1, max_seq_len, dtype=torch.long),
+                            "attention_mask": torch.ones(1, max_seq_len, dtype=torch.long)},
+            batch_sizes=batch_sizes, n_batches=n_batches)
+        student_latency = tools.latency_benchmark(
+            models={"student": tools.cpu_float_copy(model=student)},
+            example_inputs={"x": torch.ones(1, parameters["max_seq_len"], dtype=torch.long)},  # no padding
+            batch_sizes=batch_sizes, n_batches=n_batches)
+        results = pd.concat([teacher_latency, student_latency], ignore_index=True)
+        results = results.join(pd.DataFrame(metrics).T, on="model")
+        print(results.to_string(index=False))
+        return results
+
+    def export(self, model, parameters, path):
+        """
+        Exports a trained text classifier as TorchScript and ONNX for the standalone inference_runner.py.
+        The runner expects token ids encoded by the vocab of >preprocess<.
+
+        :param nn.Module model: a trained text classifier
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
+        :param str path: path of the exported files without file extension
+        :return: a dictionary containing the paths of the exported files
+        """
+        max_seq_len = parameters["max_seq_len"]
+        examples = tools.padded_examples(max_seq_len=max_seq_len)
+        return tools.export_model(model=model, example_inputs=examples["example_inputs"], path=path,
+                                  metadata={"max_seq_len": max_seq_len, "output": "logits"},
+                                  check_inputs=examples["check_inputs"])
+
 
 # read the datasets
 folds = tools.read_folds(prefix="undersampled_stopped_text",
@@ -552,6 +732,12 @@ vocab = fitted["vocab"]
 best_e_clf = fitted["model"]
 print("\nPERFORMANCE ON TEST:")
 e_wrapper.predict(model=best_e_clf, data=test_fold, parameters=parameters1, vocab=vocab)
+# the token ids of an exported model only make sense together with its vocab
+# vocab.save(path="best_e_clf_vocab.json")
+
+# recurrence over the padding vs. packed sequences, on one training batch
+# x_batch, _ = next(iter(e_wrapper.preprocess(data=train_data, parameters=parameters1, vocab=vocab)["loader"]))
+# tools.packing_benchmark(model=best_e_clf, x=x_batch)
 
 
 
@@ -705,3 +891,17 @@ tools.performance_comparison(parameter_combinations=parameter_combinations,
                              folds=train_folds,
                              model_name="BiLSTM")'''
 
+
+# distill a trained BertClassifier (e.g. torch.save'd by bert.py) into a BiLSTM and compare both on the test fold
+# parameters_bert = tools.parameters_bert_based(n_epochs=4, lr=2e-5, max_seq_len=16, batch_size=32, x_name="text",
+#                                               y_name="label", device=device)
+# bert_teacher = torch.load("best_bert.pt", map_location=device)
+# parameters_student = tools.parameters_rnn_based(n_epochs=5, lr=0.001, max_seq_len=16, n_layers=3,
+#                                                 feats_per_time_step=128, hidden_size=16, n_classes=2, batch_size=32,
+#                                                 x_name="text", y_name="label", device=device, distill_alpha=0.5,
+#                                                 distill_temperature=2.0)
+# e_wrapper = EmbeddingWrapper(model_class=BiLSTMEClassifier)
+# distilled = e_wrapper.distill(train_data=train_data, best_parameters=parameters_student, teacher=bert_teacher,
+#                               teacher_parameters=parameters_bert)
+# e_wrapper.distillation_report(student=distilled["model"], vocab=distilled["vocab"], teacher=bert_teacher,
+#                               data=test_fold, parameters=parameters_student, teacher_parameters=parameters_bert)
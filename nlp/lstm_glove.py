@@ -5,82 +5,80 @@ import pandas as pd
 import torch
 import torch.nn as nn
 from nltk import TweetTokenizer
-from torch.utils.data import DataLoader, RandomSampler, TensorDataset
+from torch.utils.data import TensorDataset
 from transformers import AdamW
 
 import tools
 
 
-def read_glove_embedding(glove_path):
-    """
-    Reads the glove embedding from a .txt file, and creates a glove-vocabulary from it
-
-    :param str glove_path: the relative path leading to the .txt file in which the embedding is stored
-    :return: a pd.Series object having the words as indices and teh respective embedding-vectors as values
-    """
-    glove_map = {}
-    with open(os.path.join(glove_path), encoding="utf-8") as file:
-        for line in file:
-            split = line.split()
-            token = split[0]
-            embedding = np.array(split[1:], dtype="float32")
-            glove_map[token] = embedding
-    glove_map = pd.Series(glove_map)
-    return glove_map
-
-
 class LSTMGloveClassifier(nn.Module):
     """
     An LSTM using pretrained word embeddings (glove)
     """
 
-    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes):
+    def __init__(self, embedding_table, hidden_size, n_layers, n_classes, fine_tune_embedding=False, packed=True):
         """
         Constructor.
 
-        :param int feats_per_time_step: each time step, i.e. each word is represented by a number of features.
-        In case of word embeddings, the number of features per word is the embedding size of the word-vector.
+        :param torch.Tensor embedding_table: the glove vectors of the corpus vocabulary, row i embeds the token id i.
+        Each time step, i.e. each word is represented by one row of the table.
         :param int hidden_size: size of the hidden state
         :param int n_layers: number of lstm layers
         :param int n_classes: determines how many classes have to be handled. 2 in binary case.
+        :param bool fine_tune_embedding: whether the glove vectors are trained as well. Frozen by default
+        :param bool packed: whether the padding of the sequences is skipped (packed sequences)
         """
         super(LSTMGloveClassifier, self).__init__()
         self.n_layers = n_layers
         self.hidden_size = hidden_size
-        self.lstm = nn.LSTM(feats_per_time_step, hidden_size, n_layers, batch_first=True)
+        self.packed = packed
+        self.emb = nn.Embedding.from_pretrained(embeddings=embedding_table, freeze=not fine_tune_embedding,
+                                                padding_idx=0)
+        self.lstm = nn.LSTM(embedding_table.size(1), hidden_size, n_layers, batch_first=True)
         self.linear = nn.Linear(hidden_size, n_classes)
 
     def forward(self, x):
         """
         performs the forward pass.
 
-        :param torch.Tensor x: the input/observation per batch
+        :param torch.Tensor x: the token ids of the observations per batch
         :return: the prediction of the whole batch
         """
-        h0 = torch.zeros(self.n_layers, x.size(0), self.hidden_size).to(device)  # initial hidden state
-        c0 = torch.zeros(self.n_layers, x.size(0), self.hidden_size).to(device)  # initial cell state
-        out, _ = self.lstm(x, (h0, c0))
-        out = out[:, -1, :]
+        lengths = tools.sequence_lengths(x=x)
+        x = self.emb(x)
+        h0 = x.new_zeros(self.n_layers, x.size(0), self.hidden_size)  # initial hidden state
+        c0 = x.new_zeros(self.n_layers, x.size(0), self.hidden_size)  # initial cell state
+        out = tools.recurrent_features(recurrent=self.lstm, x=x, lengths=lengths, initial_state=(h0, c0),
+                                       packed=self.packed)
         out = self.linear(out)
         return out
 
 
 class GloveWrapper:
 
-    def __init__(self, glove_map, glove_size, model_class):
+    def __init__(self, glove_store, model_class, corpus):
         """
         Constructor.
 
-        :param pd.Series glove_map: a pd.Series having words as indices and word-vectors as values.
-        Maps words to their (glove) embeddings.
-        :param int glove_size: glove embeddings come in different sizes (50, 100, 200, 300), issue the used size
-        in this parameter.
+        :param tools.GloveStore glove_store: the memory-mapped GloVe vectors that map words to their embeddings.
+        GloVe embeddings come in different sizes (50, 100, 200, 300), the size of the store is used.
         :param nn.Module model_class: one of the text-classifiers in this python module.
+        :param pd.Series corpus: the training texts, never the test data. The models embed the tokens of the corpus
+        having a GloVe vector, all other tokens (including tokens unseen in the corpus) are mapped to the
+        out-of-vocabulary id and embedded as zeros.
         """
-        self.glove_map = glove_map
-        self.glove_size = glove_size
+        self.glove_size = glove_store.size
         self.model_class = model_class
 
+        tweet_tokenizer = TweetTokenizer()
+        corpus_vocab = tools.Vocab.build(tokenized_texts=corpus.apply(func=tweet_tokenizer.tokenize))
+        known = [i for i, token in enumerate(corpus_vocab.tokens) if token in glove_store]
+        self.vocab = tools.Vocab(tokens=[corpus_vocab.tokens[i] for i in known], counts=corpus_vocab.counts[known])
+        # rows of padding (id 0) and of out-of-vocabulary tokens (id len(vocab) + 1) are zeros
+        self.embedding_table = torch.zeros(len(self.vocab) + 2, self.glove_size)
+        self.embedding_table[1:len(self.vocab) + 1] = torch.from_numpy(glove_store.lookup(tokens=self.vocab.tokens))
+        print("GloVe vectors of", len(self.vocab), "of", len(corpus_vocab), "corpus tokens")
+
     def preprocess(self, data, parameters):
         """
         Preprocesses the data of a fold and returns the DataLoaders for the wrapped neural network.
@@ -91,7 +89,6 @@ class GloveWrapper:
         :return: a dictionary having the key "loader" and the constructed DataLoader as value.
         """
         max_seq_len = parameters["max_seq_len"]
-        batch_size = parameters["batch_size"]
         x_name = parameters["x_name"]
         y_name = parameters["y_name"]
         device = parameters["device"]
@@ -108,47 +105,37 @@ class GloveWrapper:
             """
             return tweet_tokenizer.tokenize(sequence)
 
-        def tokens_to_embedding(token_list):
+        def encode():
             """
-            Embeds a list of tokens.
+            Tokenizes the texts and encodes them as token ids of the corpus vocabulary.
 
-            :param list token_list: a list of strings. Each string is one token.
-            :return: a numpy array of embedded tokens using the glove word embedding
+            :return: a dictionary containing the token ids "x" and the labels "y"
             """
-            embedding = []
-            for i, token in enumerate(token_list):
-                if i == max_seq_len:
-                    break
-                if token in glove_map.index:
-                    embedding.append(glove_map[token])
-                else:
-                    embedding.append([0] * self.glove_size)
-            padding_len = max_seq_len - len(embedding)
-            for i in range(padding_len):
-                embedding.append(np.zeros(self.glove_size))
-            return np.stack(embedding)
-
-        tokenized_texts = text_col.apply(func=tokenize_sequence)
-        embedded_texts = tokenized_texts.apply(func=tokens_to_embedding)
-        x = torch.tensor(embedded_texts, dtype=torch.float32).to(device)
-        y = torch.tensor(target_col, dtype=torch.long).to(device)  # long for CrossEntropyLoss
-        dataset = TensorDataset(x, y)
-        sampler = RandomSampler(dataset)
-        loader = DataLoader(dataset=dataset, batch_size=batch_size, sampler=sampler)
+            tokenized_texts = text_col.apply(func=tokenize_sequence)
+            token_ids = self.vocab.encode_batch(tokenized_texts=tokenized_texts, max_seq_len=max_seq_len)
+            return {"x": torch.from_numpy(token_ids),  # int32, the embedding layer of the model looks up the vectors
+                    "y": torch.tensor(target_col, dtype=torch.long)}  # long for CrossEntropyLoss
+
+        tokenizer = "TweetTokenizer|glove ids"
+        encoded = tools.cached_encoding(data=data, parameters=parameters, tokenizer=tokenizer, encode=encode,
+                                        vocab=self.vocab)
+        dataset = TensorDataset(encoded["x"].to(device), encoded["y"].to(device))
+        loader = tools.text_loader(dataset=dataset, lengths=tools.sequence_lengths(x=encoded["x"]),
+                                   parameters=parameters)
         return {"loader": loader}
 
-    def fit(self, train_data, best_parameters):
+    def fit(self, train_data, best_parameters, val_data=None):
         """
         Trains a (bi)LSTMGloveClassifier on train_data using a set of parameters.
 
         :param pd.DataFrame train_data: data on which the model has to be trained
         :param dict best_parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
+        :param pd.DataFrame val_data: validation data evaluated after every epoch. Required for early stopping
         :return: The trained model
         """
         n_epochs = best_parameters["n_epochs"]
         lr = best_parameters["lr"]
         n_layers = best_parameters["n_layers"]
-        feats_per_time_step = best_parameters["feats_per_time_step"]
         hidden_size = best_parameters["hidden_size"]
         n_classes = best_parameters["n_classes"]
         device = best_parameters["device"]
@@ -157,15 +144,29 @@ class GloveWrapper:
 
         train_loader = preprocessed["loader"]
 
-        model = self.model_class(feats_per_time_step=feats_per_time_step,
+        model = self.model_class(embedding_table=self.embedding_table.clone(),
                                  hidden_size=hidden_size,
                                  n_layers=n_layers,
-                                 n_classes=n_classes).to(device)
+                                 n_classes=n_classes,
+                                 fine_tune_embedding=best_parameters["fine_tune_embedding"],
+                                 packed=best_parameters["packed_sequences"]).to(device)
         optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
         loss_func = nn.CrossEntropyLoss()
 
+        checkpointer = tools.Checkpointer(parameters=best_parameters)
+        checkpoint = checkpointer.restore(name="fit", model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=best_parameters)
+        if early_stopping.enabled and val_data is None:
+            raise ValueError("early stopping (patience) requires val_data")
+        start_epoch = 1
+        if checkpoint is not None:
+            start_epoch = checkpoint["epoch"] + 1
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
         # train loop
-        for epoch in range(1, n_epochs + 1):
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:
+                break
             print("=== Epoch", epoch, "/", n_epochs, "===")
             model.train()
             for i, batch in enumerate(train_loader):
@@ -178,6 +179,15 @@ class GloveWrapper:
 
             print("Metrics on training data after epoch", epoch, ":")
             self.predict(model=model, data=train_data, parameters=best_parameters)
+            if val_data is not None:
+                print("Metrics on validation data after epoch", epoch, ":")
+                metrics = self.predict(model=model, data=val_data, parameters=best_parameters)
+                early_stopping.step(epoch=epoch, metrics=metrics, model=model)
+            checkpointer.save(name="fit", epoch=epoch, model=model, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs,
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.restore_best(model=model)
         return {"model": model}
 
     def predict(self, model, data, parameters):
@@ -209,6 +219,22 @@ class GloveWrapper:
         print("ROCAUC:", roc_auc)
         return {"acc": acc, "roc_auc": roc_auc}
 
+    def export(self, model, parameters, path):
+        """
+        Exports a trained LSTMGloveClassifier as TorchScript and ONNX for the standalone inference_runner.py.
+        The runner expects token ids encoded by the corpus vocabulary of the wrapper (self.vocab).
+
+        :param LSTMGloveClassifier model: a trained LSTMGloveClassifier
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
+        :param str path: path of the exported files without file extension
+        :return: a dictionary containing the paths of the exported files
+        """
+        max_seq_len = parameters["max_seq_len"]
+        examples = tools.padded_examples(max_seq_len=max_seq_len)
+        return tools.export_model(model=model, example_inputs=examples["example_inputs"], path=path,
+                                  metadata={"max_seq_len": max_seq_len, "output": "logits"},
+                                  check_inputs=examples["check_inputs"])
+
     def evaluate_hyperparameters(self, folds, parameters):
         """
         Evaluates the given parameters on multiple folds using k-fold cross validation.
@@ -218,10 +244,22 @@ class GloveWrapper:
         :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
         :return: a dictionary containing the accuracy and roc-auc scores on both training and validation data
         """
+        return tools.run_folds(evaluate_fold=self.evaluate_fold, folds=folds, parameters=parameters)
+
+    def evaluate_fold(self, folds, fold_id, parameters):
+        """
+        Trains an isolated model on all but one fold and evaluates it on the remaining fold after every epoch.
+
+        :param list folds: a list of pd.DataFrames. Each of the DataFrames contains one fold of the data available
+        during the training time.
+        :param int fold_id: index of the validation fold in >folds<
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
+        :return: a dictionary containing the per-epoch accuracy and roc-auc scores of this fold on both training and
+        validation data
+        """
         n_epochs = parameters["n_epochs"]
         lr = parameters["lr"]
         n_layers = parameters["n_layers"]
-        feats_per_time_step = parameters["feats_per_time_step"]
         hidden_size = parameters["hidden_size"]
         n_classes = parameters["n_classes"]
         device = parameters["device"]
@@ -233,53 +271,70 @@ class GloveWrapper:
         roc_auc_scores = np.zeros(n_epochs)
 
         loss_func = nn.CrossEntropyLoss()
-        for fold_id in range(len(folds)):
-            print("=== Fold", fold_id + 1, "/", len(folds), "===")
-            sets = tools.train_val_split(data_folds=folds, val_fold_id=fold_id)
-            train = sets["train"]
-            val = sets["val"]
-            train_loader = self.preprocess(data=train, parameters=parameters)["loader"]
-            model = self.model_class(feats_per_time_step=feats_per_time_step,
-                                     hidden_size=hidden_size,
-                                     n_layers=n_layers,
-                                     n_classes=n_classes).to(device)  # isolated model per fold
-            optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
-
-            for epoch in range(1, n_epochs + 1):
-                print("=== Epoch", epoch, "/", n_epochs, "===")
-                model.train()
-                for i, batch in enumerate(train_loader):
-                    x_batch, y_batch = batch
-                    probas = model(x=x_batch)  # forward
-                    model.zero_grad()
-                    batch_loss = loss_func(probas, y_batch)  # calculate loss
-                    batch_loss.backward()  # calculate gradients
-                    optimizer.step()  # update parameters
-
-                print("Metrics on training data after epoch", epoch, ":")
-                metrics = self.predict(model=model, data=train, parameters=parameters)
-                acc_scores_train[epoch - 1] += metrics["acc"]
-                roc_auc_scores_train[epoch - 1] += metrics["roc_auc"]
-
-                print("Metrics on validation data after epoch", epoch, ":")
-                metrics = self.predict(model=model, data=val, parameters=parameters)
-                acc_scores[epoch - 1] += metrics["acc"]
-                roc_auc_scores[epoch - 1] += metrics["roc_auc"]
-                print("\n")
+        print("=== Fold", fold_id + 1, "/", len(folds), "===")
+        sets = tools.train_val_split(data_folds=folds, val_fold_id=fold_id)
+        train = sets["train"]
+        val = sets["val"]
+        train_loader = self.preprocess(data=train, parameters=parameters)["loader"]
+        # isolated model per fold
+        model = self.model_class(embedding_table=self.embedding_table.clone(),
+                                 hidden_size=hidden_size,
+                                 n_layers=n_layers,
+                                 n_classes=n_classes,
+                                 fine_tune_embedding=parameters["fine_tune_embedding"],
+                                 packed=parameters["packed_sequences"]).to(device)
+        optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
 
-        for i in range(n_epochs):
-            acc_scores_train[i] /= len(folds)
-            roc_auc_scores_train[i] /= len(folds)
+        checkpointer = tools.Checkpointer(parameters=parameters)
+        checkpoint = checkpointer.restore(name="fold" + str(fold_id), model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=parameters, keep_weights=False)
+        start_epoch = 1
+        if checkpoint is not None:  # continue the interrupted fold
+            start_epoch = checkpoint["epoch"] + 1
+            acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores = checkpoint["scores"]
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:  # also when resuming a stopped fold
+                break
+            print("=== Epoch", epoch, "/", n_epochs, "===")
+            model.train()
+            for i, batch in enumerate(train_loader):
+                x_batch, y_batch = batch
+                probas = model(x=x_batch)  # forward
+                model.zero_grad()
+                batch_loss = loss_func(probas, y_batch)  # calculate loss
+                batch_loss.backward()  # calculate gradients
+                optimizer.step()  # update parameters
 
-            acc_scores[i] /= len(folds)
-            roc_auc_scores[i] /= len(folds)
+            print("Metrics on training data after epoch", epoch, ":")
+            metrics = self.predict(model=model, data=train, parameters=parameters)
+            acc_scores_train[epoch - 1] = metrics["acc"]
+            roc_auc_scores_train[epoch - 1] = metrics["roc_auc"]
+
+            print("Metrics on validation data after epoch", epoch, ":")
+            metrics = self.predict(model=model, data=val, parameters=parameters)
+            acc_scores[epoch - 1] = metrics["acc"]
+            roc_auc_scores[epoch - 1] = metrics["roc_auc"]
+            print("\n")
+            early_stopping.step(epoch=epoch, metrics=metrics, model=model)
+            checkpointer.save(name="fold" + str(fold_id), epoch=epoch, model=model, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs,
+                              scores=(acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores),
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.carry_forward(acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores)
 
         return {"acc_scores_train": acc_scores_train, "acc_scores": acc_scores,
                 "roc_auc_scores_train": roc_auc_scores_train, "roc_auc_scores": roc_auc_scores}
 
 
 # read the data
-glove_map = read_glove_embedding(glove_path="../../data/pretrained_embeddings/glove.6B.50d.txt")
+# the GloVe text file is converted once into a memory-mapped binary store
+glove_path = "../../data/pretrained_embeddings/glove.6B.50d"
+if not os.path.exists(glove_path + ".npy"):
+    tools.convert_glove(glove_path=glove_path + ".txt", store_path=glove_path)
+glove_store = tools.GloveStore(path=glove_path)
 folds = tools.read_folds(prefix="undersampled_stopped_text", read_path="../../data/folds_nlp", test_fold_id=0)
 train_folds = folds["train"]
 test_fold = folds["test"]
@@ -288,7 +343,7 @@ for i in range(1, len(train_folds) - 1):
     pd.concat([train_data, train_folds[i]], axis=0)
 
 # define the parameters
-glove_size = 50
+glove_size = glove_store.size
 device = tools.select_device()
 print("device:", device)
 parameters1 = tools.parameters_rnn_based(n_epochs=6,
@@ -354,7 +409,8 @@ parameters5 = tools.parameters_rnn_based(n_epochs=10,
 parameter_combinations = [parameters1]
 
 # use the model
-lstmg_wrapper = GloveWrapper(glove_map=glove_map, glove_size=glove_size, model_class=LSTMGloveClassifier)
+corpus = pd.concat(train_folds, axis=0)["text"]  # the test fold must not extend the vocabulary
+lstmg_wrapper = GloveWrapper(glove_store=glove_store, model_class=LSTMGloveClassifier, corpus=corpus)
 '''tools.performance_comparison(parameter_combinations=parameter_combinations,
                              wrapper=lstmg_wrapper,
                              folds=train_folds,
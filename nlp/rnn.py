@@ -48,7 +48,7 @@ class RNNClassifier(nn.Module):
     An RNN-based classifier that works on word tokens.
     """
 
-    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes):
+    def __init__(self, feats_per_time_step, hidden_size, n_layers, n_classes, packed=True):
         """
         Constructor.
 
@@ -57,10 +57,12 @@ class RNNClassifier(nn.Module):
         :param int hidden_size: size of the hidden state
         :param int n_layers: number of lstm layers
         :param int n_classes: determines how many classes have to be handled. 2 in binary case.
+        :param bool packed: whether the padding of the sequences is skipped (packed sequences)
         """
         super(RNNClassifier, self).__init__()
         self.n_layers = n_layers
         self.hidden_size = hidden_size
+        self.packed = packed
         self.rnn = nn.RNN(feats_per_time_step, hidden_size, n_layers, batch_first=True)
         self.linear = nn.Linear(hidden_size, n_classes)
 
@@ -71,9 +73,10 @@ class RNNClassifier(nn.Module):
         :param torch.Tensor x: the input/observation per batch
         :return: the prediction of the whole batch
         """
-        h0 = torch.zeros(self.n_layers, x.size(0), self.hidden_size).to(device)
-        out, _ = self.rnn(x, h0)
-        out = out[:, -1, :]
+        lengths = tools.sequence_lengths(x=x)
+        h0 = x.new_zeros(self.n_layers, x.size(0), self.hidden_size)
+        out = tools.recurrent_features(recurrent=self.rnn, x=x, lengths=lengths, initial_state=h0,
+                                       packed=self.packed)
         out = self.linear(out)
         return out
 
@@ -88,14 +91,13 @@ class RNNWrapper:
         :param pd.DataFrame data: one fold of data to be processed. Contains a column <x_name> containing text
         sequences and another column <y_name> containing the class labels of the sequence
         :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
-        :param pd.Series vocab: the vocabulary handled for the preprocessing, if None, a new vocabulary for the whole
+        :param tools.Vocab vocab: the vocabulary handled for the preprocessing, if None, a new vocabulary for the whole
         textual information in data is created (create new one on train, use existing one for test/val)
         :return: a dictionary having the key "loader" and the constructed DataLoader as value;
         If vocab=None, the key "vocab" is added to the dictionary. The value of that key
         is the extracted vocabulary from the whole data
         """
         max_seq_len = parameters["max_seq_len"]
-        batch_size = parameters["batch_size"]
         x_name = parameters["x_name"]
         y_name = parameters["y_name"]
         device = parameters["device"]
@@ -113,94 +115,47 @@ class RNNWrapper:
             """
             return tweet_tokenizer.tokenize(sequence)
 
-        def generate_vocab(tokenized_train):
+        def encode():
             """
-            Generates the vocabulary on the whole tokenized textual data.
+            Tokenizes and encodes the texts, building the vocabulary first if none is given.
 
-            :param pd.Series tokenized_train: a pd.Series having lists of separated tokens of the respective
-            sequences/observations as values.
-            :return: a pd.Series representing the vocabulary-mapping. The indices (1...N) are the token
-            ids, and the values are the corresponding strings of the tokens.
+            :return: a dictionary containing the encoded texts "x", the labels "y" and the used "vocab"
             """
-            all_tokens = []
-
-            def collapse_sequences(row, all_tokens):
-                """
-                Combines lists of tokens to one large list of tokens.
-
-                :param list row: a list of tokens stored in one row of the column having the textual data.
-                :param list all_tokens: a list having all already concatenated tokens
-                """
-                all_tokens += row
-
-            tokenized_train.apply(func=collapse_sequences, all_tokens=all_tokens)
-            vocab = pd.Series(all_tokens, name="token").drop_duplicates()
-            vocab.index = np.arange(start=1, stop=len(vocab) + 1)  # start with index 1, 0 will be used for padding
-            return vocab
-
-        def encode_tokens(tokenized_data, vocab):
-            """
-            Encodes token ids.
-
-            :param pd.Series tokenized_data: a pd.Series containing the tokenized sequences. Each tokenized sequence is
-            a list of strings
-            :param pd.Series vocab: a pd.Series having token ids as indices and token strings as values.
-            :return: a pd.Series of lists of encoded tokens. Each token is encoded by its own id
-            """
-
-            def encode_row(row):
-                """
-                Encodes one row/observation/sequence of tokenized textual data.
-                Might truncate or pad the sequence.
-
-                :param list row: a list of strings containing tokens from a sequence
-                :return: the encoded row stored in a list
-                """
-                encoded_row = []
-                for i, token in enumerate(row):
-                    if token in list(vocab.values):
-                        encoded_row.append(vocab.loc[vocab == token].index[0])
-                    else:
-                        encoded_row.append(len(vocab) + 1)  # out of vocabulary token
-                    if i == max_seq_len - 1:
-                        break  # truncate long sequences if necessary
-                padding = [0] * (max_seq_len - len(encoded_row))
-                return encoded_row + padding
-
-            return tokenized_data.apply(func=encode_row)
-
-        if vocab is None:
-            x_tokens = text_col.apply(func=tokenize_sequence)
-            vocab = generate_vocab(tokenized_train=x_tokens)
-            x_encoded = encode_tokens(tokenized_data=x_tokens, vocab=vocab)
-            x_encoded = torch.tensor(x_encoded, dtype=torch.float32).to(device)
-            y = torch.tensor(target_col, dtype=torch.long).to(device)  # long for CrossEntropyLoss
-            dataset = TensorDataset(x_encoded, y)
-            sampler = RandomSampler(dataset)
-            loader = DataLoader(dataset=dataset, batch_size=batch_size, sampler=sampler)
-            return {"loader": loader, "vocab": vocab}
-        else:
             x_tokens = text_col.apply(func=tokenize_sequence)
-            x_encoded = encode_tokens(tokenized_data=x_tokens, vocab=vocab)
-            x_encoded = torch.tensor(x_encoded, dtype=torch.float32).to(device)
-            y = torch.tensor(target_col, dtype=torch.long).to(device)
-            dataset = TensorDataset(x_encoded, y)
-            sampler = RandomSampler(dataset)
-            loader = DataLoader(dataset=dataset, batch_size=batch_size, sampler=sampler)
-            return {"loader": loader}  # to preserve the pattern
-
-    def fit(self, train_data, best_parameters, synth_loader=None):
+            used_vocab = vocab
+            if used_vocab is None:
+                used_vocab = tools.Vocab.build(tokenized_texts=x_tokens, min_freq=parameters["min_vocab_freq"],
+                                               max_size=parameters["max_vocab_size"])
+            x_encoded = used_vocab.encode_batch(tokenized_texts=x_tokens, max_seq_len=max_seq_len)
+            return {"x": torch.from_numpy(x_encoded).to(dtype=torch.float32),
+                    "y": torch.tensor(target_col, dtype=torch.long),  # long for CrossEntropyLoss
+                    "vocab": used_vocab}
+
+        tokenizer = "TweetTokenizer"
+        if vocab is None:
+            tokenizer += "|vocab " + str(parameters["min_vocab_freq"]) + " " + str(parameters["max_vocab_size"])
+        encoded = tools.cached_encoding(data=data, parameters=parameters, tokenizer=tokenizer, encode=encode,
+                                        vocab=vocab)
+        dataset = TensorDataset(encoded["x"].to(device), encoded["y"].to(device))
+        loader = tools.text_loader(dataset=dataset, lengths=tools.sequence_lengths(x=encoded["x"]),
+                                   parameters=parameters,
+                                   multiple_of=parameters["feats_per_time_step"])  # reshaped into time steps
+        if vocab is None:
+            return {"loader": loader, "vocab": encoded["vocab"]}
+        return {"loader": loader}  # to preserve the pattern
+
+    def fit(self, train_data, best_parameters, synth_loader=None, val_data=None):
         """
         Trains an RNNClassifier on train_data using a set of parameters.
 
         :param pd.DataFrame train_data: data on which the model has to be trained
         :param dict best_parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
         :param synth_loader: a DataLoader for synthetic data. used for debugging only
+        :param pd.DataFrame val_data: validation data evaluated after every epoch. Required for early stopping
         :return: The trained model
         """
         n_epochs = best_parameters["n_epochs"]
         lr = best_parameters["lr"]
-        max_seq_len = best_parameters["max_seq_len"]
         n_layers = best_parameters["n_layers"]
         feats_per_time_step = best_parameters["feats_per_time_step"]
         hidden_size = best_parameters["hidden_size"]
@@ -218,17 +173,30 @@ class RNNWrapper:
         model = RNNClassifier(feats_per_time_step=feats_per_time_step,
                               hidden_size=hidden_size,
                               n_layers=n_layers,
-                              n_classes=n_classes).to(device)
+                              n_classes=n_classes,
+                              packed=best_parameters["packed_sequences"]).to(device)
         optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)
         loss_func = nn.CrossEntropyLoss()
 
+        checkpointer = tools.Checkpointer(parameters=best_parameters)
+        checkpoint = checkpointer.restore(name="fit", model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=best_parameters)
+        if early_stopping.enabled and val_data is None:
+            raise ValueError("early stopping (patience) requires val_data")
+        start_epoch = 0
+        if checkpoint is not None:
+            start_epoch = checkpoint["epoch"]
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
         # train loop
-        for epoch in range(n_epochs):
+        for epoch in range(start_epoch, n_epochs):
+            if early_stopping.stopped:
+                break
             print("=== Epoch", epoch + 1, "/", n_epochs, "===")
             model.train()
             for batch in train_loader:
                 x_batch, y_batch = batch
-                x_batch = x_batch.reshape(-1, max_seq_len, feats_per_time_step)
+                x_batch = x_batch.reshape(x_batch.size(0), -1, feats_per_time_step)  # batches may be trimmed
                 probas = model(x=x_batch)  # model(x) = model.__call__(x) performs forward (+ more)
                 model.zero_grad()  # reset gradients from last step
                 batch_loss = loss_func(probas, y_batch)  # calculate loss
@@ -238,6 +206,16 @@ class RNNWrapper:
             print("Metrics on training data after epoch", epoch + 1, ":")
             self.predict(model=model, data=train_data, parameters=best_parameters, vocab=vocab,
                          synth_loader=synth_loader)
+            if val_data is not None:
+                print("Metrics on validation data after epoch", epoch + 1, ":")
+                metrics = self.predict(model=model, data=val_data, parameters=best_parameters, vocab=vocab,
+                                       synth_loader=None)
+                early_stopping.step(epoch=epoch + 1, metrics=metrics, model=model)
+            checkpointer.save(name="fit", epoch=epoch + 1, model=model, optimizer=optimizer,
+                              n_epochs=epoch + 1 if early_stopping.stopped else n_epochs,
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.restore_best(model=model)
         return {"model": model, "vocab": vocab}
 
     def evaluate_hyperparameters(self, folds, parameters):
@@ -249,9 +227,21 @@ class RNNWrapper:
         :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
         :return: a dictionary containing the accuracy and roc-auc scores on both training and validation data
         """
+        return tools.run_folds(evaluate_fold=self.evaluate_fold, folds=folds, parameters=parameters)
+
+    def evaluate_fold(self, folds, fold_id, parameters):
+        """
+        Trains an isolated model on all but one fold and evaluates it on the remaining fold after every epoch.
+
+        :param list folds: a list of pd.DataFrames. Each of the DataFrames contains one fold of the data available
+        during the training time.
+        :param int fold_id: index of the validation fold in >folds<
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
+        :return: a dictionary containing the per-epoch accuracy and roc-auc scores of this fold on both training and
+        validation data
+        """
         n_epochs = parameters["n_epochs"]
         lr = parameters["lr"]
-        max_seq_len = parameters["max_seq_len"]
         n_layers = parameters["n_layers"]
         feats_per_time_step = parameters["feats_per_time_step"]
         hidden_size = parameters["hidden_size"]
@@ -265,52 +255,64 @@ class RNNWrapper:
         roc_auc_scores = np.zeros(n_epochs)
 
         loss_func = nn.CrossEntropyLoss()
-        for fold_id in range(len(folds)):
-            print("=== Fold", fold_id + 1, "/", len(folds), "===")
-            sets = tools.train_val_split(data_folds=folds, val_fold_id=fold_id)
-            train = sets["train"]
-            val = sets["val"]
-            preprocessed = self.preprocess(data=train, parameters=parameters)
+        print("=== Fold", fold_id + 1, "/", len(folds), "===")
+        sets = tools.train_val_split(data_folds=folds, val_fold_id=fold_id)
+        train = sets["train"]
+        val = sets["val"]
+        preprocessed = self.preprocess(data=train, parameters=parameters)
 
-            train_loader = preprocessed["loader"]
-            vocab = preprocessed["vocab"]
+        train_loader = preprocessed["loader"]
+        vocab = preprocessed["vocab"]
+
+        # create one model per fold split (isolated training)
+        model = RNNClassifier(feats_per_time_step=feats_per_time_step,
+                              hidden_size=hidden_size,
+                              n_layers=n_layers,
+                              n_classes=n_classes,
+                              packed=parameters["packed_sequences"]).to(device)
+
+        optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)  # depends on model
+
+        checkpointer = tools.Checkpointer(parameters=parameters)
+        checkpoint = checkpointer.restore(name="fold" + str(fold_id), model=model, optimizer=optimizer)
+        early_stopping = tools.EarlyStopping(parameters=parameters, keep_weights=False)
+        start_epoch = 1
+        if checkpoint is not None:  # continue the interrupted fold
+            start_epoch = checkpoint["epoch"] + 1
+            acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores = checkpoint["scores"]
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+
+        for epoch in range(start_epoch, n_epochs + 1):
+            if early_stopping.stopped:  # also when resuming a stopped fold
+                break
+            print("=== Epoch", epoch, "/", n_epochs, "===")
+            model.train()
+            for batch in train_loader:
+                x_batch, y_batch = batch
+                x_batch = x_batch.reshape(x_batch.size(0), -1, feats_per_time_step)  # batches may be trimmed
+                probas = model(x=x_batch)  # forward
+                model.zero_grad()
+                batch_loss = loss_func(probas, y_batch)  # calculate loss
+                batch_loss.backward()  # calculate gradients
+                optimizer.step()  # update parameters
 
-            model = RNNClassifier(feats_per_time_step=feats_per_time_step,
-                                  hidden_size=hidden_size,
-                                  n_layers=n_layers,
-                                  n_classes=n_classes).to(device)  # create one model per fold split (isolated training)
-
-            optimizer = AdamW(model.parameters(), lr=lr, eps=1e-8)  # depends on model
-
-            for epoch in range(1, n_epochs + 1):
-                print("=== Epoch", epoch, "/", n_epochs, "===")
-                model.train()
-                for batch in train_loader:
-                    x_batch, y_batch = batch
-                    x_batch = x_batch.reshape(-1, max_seq_len, feats_per_time_step)
-                    probas = model(x=x_batch)  # forward
-                    model.zero_grad()
-                    batch_loss = loss_func(probas, y_batch)  # calculate loss
-                    batch_loss.backward()  # calculate gradients
-                    optimizer.step()  # update parameters
-
-                print("Metrics on training data after epoch", epoch, ":")
-                metrics = self.predict(model=model, data=train, parameters=parameters, vocab=vocab, synth_loader=None)
-                acc_scores_train[epoch - 1] += metrics["acc"]
-                roc_auc_scores_train[epoch - 1] += metrics["roc_auc"]
-
-                print("Metrics on validation data after epoch", epoch, ":")
-                metrics = self.predict(model=model, data=val, parameters=parameters, vocab=vocab, synth_loader=None)
-                acc_scores[epoch - 1] += metrics["acc"]
-                roc_auc_scores[epoch - 1] += metrics["roc_auc"]
-                print("\n")
-
-        for i in range(n_epochs):
-            acc_scores_train[i] /= len(folds)
-            roc_auc_scores_train[i] /= len(folds)
-
-            acc_scores[i] /= len(folds)
-            roc_auc_scores[i] /= len(folds)
+            print("Metrics on training data after epoch", epoch, ":")
+            metrics = self.predict(model=model, data=train, parameters=parameters, vocab=vocab, synth_loader=None)
+            acc_scores_train[epoch - 1] = metrics["acc"]
+            roc_auc_scores_train[epoch - 1] = metrics["roc_auc"]
+
+            print("Metrics on validation data after epoch", epoch, ":")
+            metrics = self.predict(model=model, data=val, parameters=parameters, vocab=vocab, synth_loader=None)
+            acc_scores[epoch - 1] = metrics["acc"]
+            roc_auc_scores[epoch - 1] = metrics["roc_auc"]
+            print("\n")
+            early_stopping.step(epoch=epoch, metrics=metrics, model=model)
+            checkpointer.save(name="fold" + str(fold_id), epoch=epoch, model=model, optimizer=optimizer,
+                              n_epochs=epoch if early_stopping.stopped else n_epochs,
+                              scores=(acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores),
+                              early_stopping=early_stopping.state_dict())
+        checkpointer.wait()
+        early_stopping.carry_forward(acc_scores_train, acc_scores, roc_auc_scores_train, roc_auc_scores)
 
         return {"acc_scores_train": acc_scores_train, "acc_scores": acc_scores,
                 "roc_auc_scores_train": roc_auc_scores_train, "roc_auc_scores": roc_auc_scores}
@@ -322,11 +324,10 @@ class RNNWrapper:
         :param RNNClassifier model: a trained RNNClassifier
         :param pd.DataFrame data: a dataset on which the prediction has to be performed
         :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
-        :param pd.Series vocab: a trained vocab mapping that maps tokens to integers
+        :param tools.Vocab vocab: a trained vocab mapping that maps tokens to integers
         :param synth_loader: a DataLoader for synthetic data, used for debugging only
         :return: a dictionary containing the accuracy and roc-auc score of the models predictions on the data
         """
-        max_seq_len = parameters["max_seq_len"]
         feats_per_time_step = parameters["feats_per_time_step"]
 
         model.eval()
@@ -341,7 +342,7 @@ class RNNWrapper:
 
         for batch in loader:
             x_batch, y_batch = batch
-            x_batch = x_batch.reshape(-1, max_seq_len, feats_per_time_step)
+            x_batch = x_batch.reshape(x_batch.size(0), -1, feats_per_time_step)  # batches may be trimmed
             with torch.no_grad():
                 probas = model(x=x_batch)
             _, preds = torch.max(probas.data, 1)
@@ -356,6 +357,23 @@ class RNNWrapper:
         print("ROCAUC:", roc_auc)
         return {"acc": acc, "roc_auc": roc_auc}
 
+    def export(self, model, parameters, path):
+        """
+        Exports a trained RNNClassifier as TorchScript and ONNX for the standalone inference_runner.py.
+        The runner expects the float encoded tokens of >preprocess< of shape
+        (batch, max_seq_len, feats_per_time_step).
+
+        :param RNNClassifier model: a trained RNNClassifier
+        :param dict parameters: a dictionary containing the parameters defined in tools.parameters_rnn_based
+        :param str path: path of the exported files without file extension
+        :return: a dictionary containing the paths of the exported files
+        """
+        max_seq_len = parameters["max_seq_len"]
+        examples = tools.padded_examples(max_seq_len=max_seq_len, n_features=parameters["feats_per_time_step"])
+        return tools.export_model(model=model, example_inputs=examples["example_inputs"], path=path,
+                                  metadata={"max_seq_len": max_seq_len, "output": "logits"},
+                                  check_inputs=examples["check_inputs"])
+
 
 # read the datasets
 folds = tools.read_folds(prefix="undersampled_stopped_text",
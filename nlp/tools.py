@@ -1,10 +1,27 @@
+import contextlib
+import copy
+import functools
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from collections import Counter, OrderedDict
+
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import torch
 from sklearn.metrics import accuracy_score
 from sklearn.metrics import roc_auc_score
+from torch.nn.utils.rnn import pack_padded_sequence
+from torch.utils.data import DataLoader, RandomSampler, Sampler, default_collate
+from transformers import BertTokenizerFast
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # shared_tools.py lives in the root
+from shared_tools import (  # noqa: E402
+    Checkpointer, EarlyStopping, cpu_float_copy, export_model, export_report, run_folds)
 
 
 def select_device():
@@ -85,8 +102,622 @@ def train_val_split(data_folds, val_fold_id):
     return {"train": train_data, "val": val_data}
 
 
+class Vocab:
+    """
+    Maps tokens to integer ids through a dictionary. Id 0 is reserved for padding, the known tokens have the ids
+    1...N and out-of-vocabulary tokens share the id N + 1, so an embedding layer needs len(vocab) + 2 rows.
+    """
+
+    def __init__(self, tokens, counts=None):
+        """
+        Constructor.
+
+        :param list tokens: the known tokens, ordered by their ids
+        :param list counts: the number of occurrences of every token in the data the vocab was built on
+        """
+        self.tokens = list(tokens)
+        self.ids = np.arange(start=1, stop=len(self.tokens) + 1, dtype=np.int32)
+        self.counts = np.zeros(len(self.tokens), dtype=np.int64) if counts is None else np.asarray(counts, np.int64)
+        self.index = dict(zip(self.tokens, self.ids.tolist()))
+        self.oov_id = len(self.tokens) + 1
+        self.fingerprint = hashlib.sha1("\x1f".join(self.tokens).encode()).hexdigest()
+
+    @classmethod
+    def build(cls, tokenized_texts, min_freq=1, max_size=None):
+        """
+        Builds the vocabulary of a tokenized corpus. Tokens are ordered by frequency, ties by first occurrence.
+
+        :param tokenized_texts: an iterable (e.g. pd.Series) of lists of tokens
+        :param int min_freq: tokens occurring less often are treated as out-of-vocabulary
+        :param int max_size: maximal number of known tokens, the most frequent ones are kept. None keeps all
+        :return: the Vocab
+        """
+        counter = Counter()
+        for tokens in tokenized_texts:
+            counter.update(tokens)
+        kept = [(token, count) for token, count in counter.most_common(max_size) if count >= min_freq]
+        return cls(tokens=[token for token, _ in kept], counts=[count for _, count in kept])
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        return token in self.index
+
+    def encode_batch(self, tokenized_texts, max_seq_len):
+        """
+        Encodes tokenized sequences as token ids, truncating long and padding short sequences.
+
+        :param tokenized_texts: a sequence (e.g. pd.Series) of lists of tokens
+        :param int max_seq_len: length of the encoded sequences
+        :return: a np.ndarray of shape (len(tokenized_texts), max_seq_len) and dtype int32
+        """
+        encoded = np.zeros((len(tokenized_texts), max_seq_len), dtype=np.int32)
+        lengths = np.fromiter((min(len(tokens), max_seq_len) for tokens in tokenized_texts), dtype=np.int64,
+                              count=len(tokenized_texts))
+        ids = np.fromiter((self.index.get(token, self.oov_id) for tokens in tokenized_texts
+                           for token in tokens[:max_seq_len]), dtype=np.int32, count=int(lengths.sum()))
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        columns = np.arange(len(ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        encoded[rows, columns] = ids
+        return encoded
+
+    def state_dict(self):
+        """
+        :return: the tokens and their counts, e.g. to be saved next to the model weights
+        """
+        return {"tokens": self.tokens, "counts": self.counts.tolist()}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        """
+        :param dict state: a dictionary returned by >state_dict<
+        :return: the restored Vocab
+        """
+        return cls(tokens=state["tokens"], counts=state["counts"])
+
+    def save(self, path):
+        """
+        :param str path: json file in which the vocab is stored
+        """
+        with open(path, "w") as file:
+            json.dump(self.state_dict(), file)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param str path: json file written by >save<
+        :return: the restored Vocab
+        """
+        with open(path) as file:
+            return cls.from_state_dict(state=json.load(file))
+
+
+def sequence_lengths(x):
+    """
+    Determines the number of real time steps of right-padded sequences, whose padding is 0.
+
+    :param torch.Tensor x: token ids of shape (batch, max_seq_len) or encoded tokens of shape
+    (batch, max_seq_len, features)
+    :return: a tensor containing the length of every sequence, at least 1
+    """
+    mask = x != 0
+    if mask.dim() == 3:
+        mask = mask.any(dim=2)
+    return mask.sum(dim=1).clamp(min=1)
+
+
+def recurrent_features(recurrent, x, lengths, initial_state, packed=True):
+    """
+    Runs a recurrent layer over right-padded sequences and returns the state of its last layer after the last real
+    time step of every sequence. For bidirectional layers, the state of the reverse direction after the first time
+    step is appended.
+    If >packed<, pack_padded_sequence skips the padding. Otherwise the layer also runs over the padding and the
+    output after the last padded time step is read, like the unpacked classifiers always did (for bidirectional
+    layers, this holds the reverse direction after only one time step).
+
+    :param nn.Module recurrent: an nn.RNN, nn.GRU or nn.LSTM having batch_first=True
+    :param torch.Tensor x: the sequences of shape (batch, max_seq_len, features)
+    :param torch.Tensor lengths: the number of real time steps of every sequence, see >sequence_lengths<
+    :param initial_state: the initial hidden state, for LSTMs a tuple of the hidden and the cell state
+    :param bool packed: whether the padding is skipped
+    :return: a tensor of shape (batch, hidden_size * number of directions)
+    """
+    if not packed:
+        out, _ = recurrent(x, initial_state)  # size: batch_size x seq_len x hidden_size * directions
+        return out[:, -1, :]
+
+    packed_x = pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+    _, state = recurrent(packed_x, initial_state)  # in the original order of the batch
+    if isinstance(state, tuple):
+        state = state[0]  # LSTMs also return the cell state
+    if not recurrent.bidirectional:
+        return state[-1]
+    return torch.cat((state[-2], state[-1]), 1)  # regular and reverse direction of the last layer
+
+
+class LengthBucketSampler(Sampler):
+    """
+    A batch sampler that groups texts of similar length into the same batches, so that short texts are not padded to
+    the length of the longest texts. Combined with >trim_padding<, each batch is only padded to its longest text.
+    """
+
+    def __init__(self, lengths, batch_size, n_buckets=8):
+        """
+        Constructor.
+
+        :param np.ndarray lengths: the number of tokens of every text
+        :param int batch_size: maximum number of observations per batch
+        :param int n_buckets: number of length buckets. Each bucket contains roughly the same amount of texts
+        """
+        self.batch_size = batch_size
+        order = np.argsort(lengths, kind="stable")
+        self.buckets = [bucket for bucket in np.array_split(order, min(n_buckets, len(lengths))) if len(bucket) > 0]
+
+    def __iter__(self):
+        """
+        Shuffles the texts within each bucket, splits the buckets into batches and shuffles the order of the batches.
+
+        :return: an iterator over lists of indices. Each list forms one batch
+        """
+        batches = []
+        for bucket in self.buckets:
+            shuffled = np.random.permutation(bucket)
+            for start in range(0, len(shuffled), self.batch_size):
+                batches.append(shuffled[start:start + self.batch_size].tolist())
+        for batch_id in np.random.permutation(len(batches)):
+            yield batches[batch_id]
+
+    def __len__(self):
+        """
+        Returns the number of batches per epoch.
+
+        :return: the number of batches
+        """
+        return int(sum(np.ceil(len(bucket) / self.batch_size) for bucket in self.buckets))
+
+
+def trim_padding(batch, multiple_of=1):
+    """
+    Collates a batch of observations, e.g. (x, y) or (x, y, attention_mask), and cuts the sequence dimension of x and
+    of all other sequence tensors (e.g. the attention mask) down to the longest sequence of the batch. Sequence
+    tensors are those whose first two dimensions equal the ones of x, other per-row tensors are left untouched.
+
+    :param list batch: the observations of one batch. The first tensor of each observation is the padded sequence
+    :param int multiple_of: the trimmed length is rounded up to a multiple of it, e.g. when x is later reshaped into
+    time steps of several tokens
+    :return: a list of the batched tensors
+    """
+    tensors = default_collate(batch)
+    max_len = int(sequence_lengths(x=tensors[0]).max())
+    max_len = -(-max_len // multiple_of) * multiple_of
+    sequence_shape = tensors[0].shape[:2]
+    return [tensor[:, :max_len] if tensor.shape[:2] == sequence_shape else tensor for tensor in tensors]
+
+
+def text_loader(dataset, lengths, parameters, multiple_of=1):
+    """
+    Creates the DataLoader of an encoded text dataset. If parameters["length_buckets"] is given, texts of similar
+    length are batched together (LengthBucketSampler) and each batch is only padded to its longest text.
+    Otherwise the batches are sampled randomly and padded to max_seq_len.
+
+    :param torch.utils.data.Dataset dataset: the encoded texts, e.g. a TensorDataset of (x, y) or (x, y, attention_mask)
+    :param torch.Tensor lengths: the number of tokens of every text
+    :param dict parameters: a dictionary containing at least "batch_size" and "length_buckets"
+    :param int multiple_of: the trimmed lengths are rounded up to a multiple of it, see >trim_padding<
+    :return: the DataLoader
+    """
+    if parameters["length_buckets"] is None:
+        return DataLoader(dataset=dataset, batch_size=parameters["batch_size"], sampler=RandomSampler(dataset))
+    batch_sampler = LengthBucketSampler(lengths=lengths.cpu().numpy(), batch_size=parameters["batch_size"],
+                                        n_buckets=parameters["length_buckets"])
+    return DataLoader(dataset=dataset, batch_sampler=batch_sampler,
+                      collate_fn=functools.partial(trim_padding, multiple_of=multiple_of))
+
+
+def padded_examples(max_seq_len, n_features=None):
+    """
+    Creates right-padded example inputs of different lengths to export and check recurrent classifiers, whose packed
+    forward depends on the sequence lengths. An all-padding example would clamp every length to 1 when traced.
+
+    :param int max_seq_len: the padded length of the example inputs
+    :param int n_features: None for token ids (id 1 at every real time step), otherwise the number of features per
+    time step (random non-zero values at every real time step)
+    :return: a dictionary containing the input "example_inputs" and a list of further inputs "check_inputs" having
+    other batch sizes and padded lengths, each as a dictionary for the argument x
+    """
+    def example(lengths, padded_len):
+        """
+        Creates one example input.
+
+        :param list lengths: the number of real time steps of every sequence
+        :param int padded_len: the padded length of the sequences
+        :return: a dictionary mapping x to the example tensor
+        """
+        mask = torch.arange(padded_len) < torch.tensor(lengths).unsqueeze(1)
+        if n_features is None:
+            return {"x": mask.long()}
+        return {"x": (torch.rand(len(lengths), padded_len, n_features) + 0.5) * mask.unsqueeze(2)}
+
+    half_len = max(1, (max_seq_len + 1) // 2)
+    return {"example_inputs": example(lengths=[max_seq_len, half_len], padded_len=max_seq_len),
+            "check_inputs": [example(lengths=[1, max_seq_len, max(1, max_seq_len // 3)], padded_len=max_seq_len),
+                             example(lengths=[half_len, 1], padded_len=half_len)]}
+
+
+def packing_benchmark(model, x, n_steps=10):
+    """
+    Compares training steps (forward and backward pass) of a recurrent classifier running over the padding with
+    steps on packed sequences.
+
+    :param nn.Module model: a classifier having a >packed< attribute, e.g. the classifiers in embedding_models_bi.py
+    :param torch.Tensor x: one batch of padded inputs on the device of the model
+    :param int n_steps: number of timed steps per path
+    :return: a pd.DataFrame containing the milliseconds per step of both paths and the share of padded time steps
+    """
+    model = copy.deepcopy(model).train()
+    lengths = sequence_lengths(x=x)
+    padding_share = 1 - lengths.sum().item() / (x.size(0) * x.size(1))
+    results = []
+    for packed in [False, True]:
+        model.packed = packed
+        for step in range(n_steps + 1):
+            if step == 1:  # the first step warms up
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+            model.zero_grad()
+            model(x=x).sum().backward()
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        results.append({"path": "packed" if packed else "padded", "padding_share": padding_share,
+                        "ms_per_step": (time.perf_counter() - start) / n_steps * 1000})
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    return results
+
+
+@functools.lru_cache(maxsize=None)
+def bert_tokenizer(name="bert-base-uncased"):
+    """
+    Loads a fast (Rust) BERT tokenizer once per process.
+
+    :param str name: name of the pretrained tokenizer
+    :return: the BertTokenizerFast
+    """
+    return BertTokenizerFast.from_pretrained(name)
+
+
+def bert_encode(texts, max_seq_len, name="bert-base-uncased", chunk_size=4096):
+    """
+    Tokenizes texts with the cached fast BERT tokenizer into preallocated arrays. The texts are encoded chunk by
+    chunk, the tokenizer encodes the texts of one chunk in parallel on all cores.
+
+    :param texts: a sequence of strings
+    :param int max_seq_len: sequence length to which all sequences are padded / truncated, including special tokens
+    :param str name: name of the pretrained tokenizer
+    :param int chunk_size: number of texts per call of the tokenizer
+    :return: a dictionary containing the token ids "input_ids" and the "attention_mask" as int64 tensors of shape
+    (len(texts), max_seq_len)
+    """
+    tokenizer = bert_tokenizer(name=name)
+    texts = [str(text) for text in texts]
+    input_ids = np.zeros((len(texts), max_seq_len), dtype=np.int64)
+    attention_mask = np.zeros((len(texts), max_seq_len), dtype=np.int64)
+    for start in range(0, len(texts), chunk_size):
+        encoded = tokenizer(texts[start:start + chunk_size],
+                            add_special_tokens=True,  # special tokens for BERT
+                            max_length=max_seq_len,
+                            padding="max_length",
+                            truncation=True,
+                            return_attention_mask=True,
+                            return_tensors="np")
+        input_ids[start:start + chunk_size] = encoded["input_ids"]
+        attention_mask[start:start + chunk_size] = encoded["attention_mask"]
+    return {"input_ids": torch.from_numpy(input_ids), "attention_mask": torch.from_numpy(attention_mask)}
+
+
+def model_fingerprint(model):
+    """
+    Hashes the weights of a model, e.g. to name files caching its outputs.
+
+    :param torch.nn.Module model: a model
+    :return: a short hexadecimal fingerprint
+    """
+    fingerprint = hashlib.sha1()
+    for tensor in model.state_dict().values():
+        fingerprint.update(tensor.detach().cpu().numpy().tobytes())
+    return fingerprint.hexdigest()[:16]
+
+
+def bert_outputs(module, texts, max_seq_len, device, batch_size=64):
+    """
+    Runs a module taking BERT inputs over texts under torch.inference_mode, e.g. a trained BertClassifier.
+
+    :param module: a module or function mapping token ids >x< and an >attention_mask< to one output row per text
+    :param texts: a sequence of strings
+    :param int max_seq_len: sequence length to which all sequences are padded / truncated
+    :param str device: the device the module is on
+    :param int batch_size: number of texts per forward pass
+    :return: a float32 np.ndarray of shape (len(texts), output size)
+    """
+    encoded = bert_encode(texts=texts, max_seq_len=max_seq_len)
+    outputs = []
+    with torch.inference_mode():
+        for start in range(0, len(texts), batch_size):
+            x_batch = encoded["input_ids"][start:start + batch_size].to(device)
+            attention_mask = encoded["attention_mask"][start:start + batch_size].to(device)
+            output = module(x=x_batch, attention_mask=attention_mask)
+            outputs.append(output.float().reshape(len(x_batch), -1).cpu().numpy())
+    return np.concatenate(outputs)
+
+
+class TextOutputStore:
+    """
+    Stores an output row per text (e.g. teacher logits or sentence embeddings) in a memory-mapped float32 matrix
+    (<path>.npy) and maps the sha1 hashes of the texts to their rows in a json index (<path>.json).
+    Texts are only computed once, outputs of new texts are appended.
+    """
+
+    def __init__(self, path):
+        """
+        Constructor.
+
+        :param str path: path of the store without file extension. It should identify the model producing the outputs
+        """
+        self.path = path
+        self.index = {}
+        self.values = None
+        if os.path.exists(path + ".npy"):
+            self.values = np.load(path + ".npy", mmap_mode="r")
+            with open(path + ".json") as file:
+                self.index = json.load(file)
+
+    @staticmethod
+    def text_hash(text):
+        """
+        :param str text: a text
+        :return: the key of the text in the index
+        """
+        return hashlib.sha1(str(text).encode("utf-8")).hexdigest()
+
+    def lookup(self, texts, compute):
+        """
+        Returns the outputs of texts, computing (and storing) the outputs of the texts that are not stored yet.
+
+        :param texts: a sequence of strings
+        :param compute: a function mapping a list of >texts< to a 2d np.ndarray of outputs, e.g. via >bert_outputs<
+        :return: a float32 np.ndarray of shape (len(texts), output size)
+        """
+        hashes = [self.text_hash(text=text) for text in texts]
+        missing = {}
+        for text, key in zip(texts, hashes):
+            if key not in self.index:
+                missing.setdefault(key, text)
+        if missing:
+            print("Computing the outputs of", len(missing), "texts for", self.path + ".npy")
+            self.append(keys=list(missing), values=compute(texts=list(missing.values())))
+        rows = np.array([self.index[key] for key in hashes], dtype=np.int64)
+        return np.asarray(self.values[rows], dtype=np.float32)
+
+    def append(self, keys, values):
+        """
+        Appends the outputs of new texts. The matrix is written before the index, so an interrupted run never
+        indexes missing rows.
+
+        :param list keys: the hashes of the texts
+        :param np.ndarray values: the outputs of the texts, one row per key
+        """
+        n_stored = 0 if self.values is None else len(self.values)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp.npy"
+        matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                           shape=(n_stored + len(values), values.shape[1]))
+        if n_stored > 0:
+            matrix[:n_stored] = self.values
+        matrix[n_stored:] = values
+        matrix.flush()
+        del matrix
+        self.values = None
+        os.replace(tmp_path, self.path + ".npy")
+        self.index.update({key: n_stored + i for i, key in enumerate(keys)})
+        with open(self.path + ".json.tmp", "w") as file:
+            json.dump(self.index, file)
+        os.replace(self.path + ".json.tmp", self.path + ".json")
+        self.values = np.load(self.path + ".npy", mmap_mode="r")
+
+
+def convert_glove(glove_path, store_path):
+    """
+    Converts a GloVe .txt file once into the binary layout read by >GloveStore<: a float32 matrix
+    (<store_path>.npy) and the tokens of its rows (<store_path>.tokens.json).
+
+    :param str glove_path: path of the GloVe .txt file
+    :param str store_path: path of the binary store without file extension
+    """
+    with open(glove_path, encoding="utf-8") as file:
+        size = len(file.readline().rstrip().split(" ")) - 1
+        n_rows = 1 + sum(1 for _ in file)
+    print("Converting", n_rows, "GloVe vectors of size", size, "to", store_path + ".npy")
+
+    tmp_path = store_path + ".tmp.npy"
+    vectors = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(n_rows, size))
+    tokens = []
+    with open(glove_path, encoding="utf-8") as file:
+        for row, line in enumerate(file):
+            split = line.rstrip().split(" ")
+            tokens.append(" ".join(split[:-size]))  # a few tokens of the larger GloVe files contain spaces
+            vectors[row] = np.array(split[-size:], dtype=np.float32)
+    vectors.flush()
+    del vectors
+    with open(store_path + ".tokens.json", "w", encoding="utf-8") as file:
+        json.dump(tokens, file)
+    os.replace(tmp_path, store_path + ".npy")  # written last, so an existing .npy marks a complete store
+
+
+class GloveStore:
+    """
+    Memory-maps the GloVe vectors written by >convert_glove<. Opening the store only reads the token index, the
+    vectors of a token are read from disk when they are looked up.
+    """
+
+    def __init__(self, path):
+        """
+        Constructor.
+
+        :param str path: path of the binary store without file extension
+        """
+        self.vectors = np.load(path + ".npy", mmap_mode="r")
+        with open(path + ".tokens.json", encoding="utf-8") as file:
+            self.index = {token: row for row, token in enumerate(json.load(file))}
+        self.size = self.vectors.shape[1]
+        self.fingerprint = os.path.basename(path) + " " + str(self.vectors.shape)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, token):
+        return token in self.index
+
+    def lookup(self, tokens):
+        """
+        Materializes the vectors of some tokens. Tokens without a GloVe vector are represented by zeros.
+
+        :param list tokens: a list of strings
+        :return: a float32 np.ndarray of shape (len(tokens), size)
+        """
+        rows = np.fromiter((self.index.get(token, -1) for token in tokens), dtype=np.int64, count=len(tokens))
+        vectors = np.zeros((len(tokens), self.size), dtype=np.float32)
+        known = rows >= 0
+        vectors[known] = self.vectors[rows[known]]
+        return vectors
+
+
+class PreprocessingCache:
+    """
+    Keeps the encoded tensors of preprocessed datasets, so that a dataset is tokenized once instead of in every epoch
+    and predict call. Entries are keyed by a fingerprint of the texts and labels, the tokenizer, the sequence length
+    and the vocab. They are evicted in least-recently-used order and optionally also stored on disk.
+    """
+
+    def __init__(self, max_entries=16, cache_dir=None):
+        """
+        Constructor.
+
+        :param int max_entries: number of encoded datasets kept in memory
+        :param str cache_dir: directory in which the encoded datasets are additionally stored. None keeps them in
+        memory only
+        """
+        self.entries = OrderedDict()
+        self._max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_entries(self):
+        """
+        :return: the number of encoded datasets kept in memory
+        """
+        return self._max_entries
+
+    @max_entries.setter
+    def max_entries(self, max_entries):
+        """
+        Changes the number of encoded datasets kept in memory. Surplus entries are evicted right away.
+
+        :param int max_entries: the new number of entries
+        """
+        self._max_entries = max_entries
+        self.evict()
+
+    def evict(self):
+        """
+        Evicts the least recently used entries until at most >max_entries< are left.
+        """
+        while len(self.entries) > self._max_entries:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def key(data, parameters, tokenizer, vocab=None):
+        """
+        :param pd.DataFrame data: the dataset to be encoded
+        :param dict parameters: a dictionary containing at least "x_name", "y_name" and "max_seq_len"
+        :param str tokenizer: description of the tokenization (and embedding) that encodes the texts
+        :param Vocab vocab: the vocab the texts are encoded with, None if the vocab is built on the texts
+        :return: the key of the encoded dataset
+        """
+        fingerprint = hashlib.sha1()
+        fingerprint.update("\x1f".join(data[parameters["x_name"]].astype(str)).encode())
+        fingerprint.update(np.asarray(data[parameters["y_name"]]).tobytes())
+        fingerprint.update((tokenizer + "|" + str(parameters["max_seq_len"])).encode())
+        if vocab is not None:
+            fingerprint.update(vocab.fingerprint.encode())
+        return fingerprint.hexdigest()
+
+    def get(self, key, encode):
+        """
+        Returns the encoded dataset of a key, calling >encode< only if it is neither in memory nor on disk.
+
+        :param str key: a key created by >key<
+        :param encode: a function without arguments returning a dictionary of the encoded (cpu) tensors
+        :return: the dictionary of encoded tensors
+        """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        path = None if self.cache_dir is None else os.path.join(self.cache_dir, key + ".pt")
+        if path is not None and os.path.exists(path):
+            self.hits += 1
+            encoded = torch.load(path, weights_only=False)
+        else:
+            self.misses += 1
+            encoded = encode()
+            if path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                torch.save(encoded, path + ".tmp")
+                os.replace(path + ".tmp", path)  # atomic, an interrupted run never leaves an incomplete file behind
+        self.entries[key] = encoded
+        self.evict()
+        return encoded
+
+
+# encoded datasets of this process, one cache per (preprocessing_cache_size, preprocessing_cache_dir), so wrappers
+# using different settings (e.g. the teacher and the student of a distillation) do not reconfigure each other
+preprocessing_caches = {}
+
+
+def cached_encoding(data, parameters, tokenizer, encode, vocab=None):
+    """
+    Encodes a dataset through the PreprocessingCache of parameters["preprocessing_cache_size"] (0 disables the
+    cache) and parameters["preprocessing_cache_dir"] in >preprocessing_caches<.
+
+    :param pd.DataFrame data: the dataset to be encoded
+    :param dict parameters: a dictionary containing the parameters of the model-wrapper
+    :param str tokenizer: description of the tokenization (and embedding) applied by >encode<
+    :param encode: a function without arguments returning a dictionary of the encoded (cpu) tensors
+    :param Vocab vocab: the vocab used by >encode<, None if >encode< builds it
+    :return: the dictionary returned by >encode<
+    """
+    if not parameters["preprocessing_cache_size"]:
+        return encode()
+    settings = (parameters["preprocessing_cache_size"], parameters["preprocessing_cache_dir"])
+    if settings not in preprocessing_caches:
+        preprocessing_caches[settings] = PreprocessingCache(max_entries=settings[0], cache_dir=settings[1])
+    key = PreprocessingCache.key(data=data, parameters=parameters, tokenizer=tokenizer, vocab=vocab)
+    return preprocessing_caches[settings].get(key=key, encode=encode)
+
+
 def parameters_rnn_based(n_epochs, lr, max_seq_len, n_layers, feats_per_time_step, hidden_size, batch_size,
-                         device, n_classes=2, x_name="text", y_name="label"):
+                         device, n_classes=2, x_name="text", y_name="label", n_fold_workers=1,
+                         threads_per_worker=None, checkpoint_dir=None, checkpoint_every=1, resume=False,
+                         patience=None, min_delta=0.0, stopping_metric="roc_auc", best_weights_path=None,
+                         min_vocab_freq=1, max_vocab_size=None, preprocessing_cache_size=16,
+                         preprocessing_cache_dir=None, fine_tune_embedding=False, packed_sequences=True,
+                         length_buckets=None, distill_alpha=0.5, distill_temperature=2.0,
+                         teacher_cache_dir="teacher_cache"):
     """
     Creates a dictionary containing the necessary preprocessing, model and training parameters for all wrappers
     based on recurrent architectures. (RNNWrapper, EmbeddingWrapper, GloveWrapper)
@@ -103,14 +734,50 @@ def parameters_rnn_based(n_epochs, lr, max_seq_len, n_layers, feats_per_time_ste
     :param int n_classes: number of classes. 2 in a binary classification task
     :param str x_name: name of the column containing the textual information
     :param str y_name: name of the column containing the labels
+    :param int n_fold_workers: number of folds evaluated in parallel by separate processes (cpu only)
+    :param int threads_per_worker: number of torch threads per fold worker. Defaults to cores / n_fold_workers
+    :param str checkpoint_dir: directory in which training checkpoints are written. None disables checkpoints
+    :param int checkpoint_every: number of epochs between two checkpoints
+    :param bool resume: whether training runs continue from their checkpoints in >checkpoint_dir<
+    :param int patience: number of epochs without improvement of the validation metric after which training stops.
+    None disables early stopping
+    :param float min_delta: minimal increase of the validation metric that counts as an improvement
+    :param str stopping_metric: name of the validation metric that drives early stopping
+    :param str best_weights_path: file in which the weights of the best epoch are kept. None keeps them in memory
+    :param int min_vocab_freq: tokens occurring less often in the training data are out-of-vocabulary
+    :param int max_vocab_size: maximal number of known tokens. None keeps all tokens of the training data
+    :param int preprocessing_cache_size: number of encoded datasets kept in memory by tools.cached_encoding, so
+    the texts are not tokenized again in every epoch. 0 disables the cache
+    :param str preprocessing_cache_dir: directory in which encoded datasets are additionally stored
+    :param bool fine_tune_embedding: whether the GloVe embeddings of the GloveWrapper models are trained as well
+    :param bool packed_sequences: whether the recurrent layers skip the padding of the sequences (packed sequences)
+    :param int length_buckets: if given, texts of similar length are batched together in this many buckets
+    (tools.LengthBucketSampler) and each batch is only padded to its longest text. None pads all texts to max_seq_len
+    :param float distill_alpha: weight of the loss on the true labels in EmbeddingWrapper.distill, the loss on the
+    teacher's softened outputs is weighted by 1 - distill_alpha
+    :param float distill_temperature: temperature softening the logits of teacher and student during distillation
+    :param str teacher_cache_dir: directory in which the outputs of the teacher are cached by EmbeddingWrapper.distill
     :return: a dictionary containing all parameters having their names as keys.
     """
     return {"n_epochs": n_epochs, "lr": lr, "max_seq_len": max_seq_len, "n_layers": n_layers,
             "feats_per_time_step": feats_per_time_step, "hidden_size": hidden_size, "batch_size": batch_size,
-            "device": device, "n_classes": n_classes, "x_name": x_name, "y_name": y_name}
+            "device": device, "n_classes": n_classes, "x_name": x_name, "y_name": y_name,
+            "n_fold_workers": n_fold_workers, "threads_per_worker": threads_per_worker,
+            "checkpoint_dir": checkpoint_dir, "checkpoint_every": checkpoint_every, "resume": resume,
+            "patience": patience, "min_delta": min_delta, "stopping_metric": stopping_metric,
+            "best_weights_path": best_weights_path, "min_vocab_freq": min_vocab_freq, "max_vocab_size": max_vocab_size,
+            "preprocessing_cache_size": preprocessing_cache_size, "preprocessing_cache_dir": preprocessing_cache_dir,
+            "fine_tune_embedding": fine_tune_embedding, "packed_sequences": packed_sequences,
+            "length_buckets": length_buckets,
+            "distill_alpha": distill_alpha, "distill_temperature": distill_temperature,
+            "teacher_cache_dir": teacher_cache_dir}
 
 
-def parameters_bert_based(n_epochs, lr, max_seq_len, batch_size, device, n_classes=2, x_name="text", y_name="label"):
+def parameters_bert_based(n_epochs, lr, max_seq_len, batch_size, device, n_classes=2, x_name="text", y_name="label",
+                          n_fold_workers=1, threads_per_worker=None, checkpoint_dir=None, checkpoint_every=1,
+                          resume=False, patience=None, min_delta=0.0, stopping_metric="roc_auc",
+                          best_weights_path=None, preprocessing_cache_size=16, preprocessing_cache_dir=None,
+                          length_buckets=None, inference_threads=None, embedding_cache_dir="embedding_cache"):
     """
     Creates a dictionary containing the necessary preprocessing, model and training parameters for the BertWrapper.
 
@@ -122,10 +789,34 @@ def parameters_bert_based(n_epochs, lr, max_seq_len, batch_size, device, n_class
     :param int n_classes: number of classes. 2 in a binary classification task
     :param str x_name: name of the column containing the textual information
     :param str y_name: name of the column containing the labels
+    :param int n_fold_workers: number of folds evaluated in parallel by separate processes (cpu only)
+    :param int threads_per_worker: number of torch threads per fold worker. Defaults to cores / n_fold_workers
+    :param str checkpoint_dir: directory in which training checkpoints are written. None disables checkpoints
+    :param int checkpoint_every: number of epochs between two checkpoints
+    :param bool resume: whether training runs continue from their checkpoints in >checkpoint_dir<
+    :param int patience: number of epochs without improvement of the validation metric after which training stops.
+    None disables early stopping
+    :param float min_delta: minimal increase of the validation metric that counts as an improvement
+    :param str stopping_metric: name of the validation metric that drives early stopping
+    :param str best_weights_path: file in which the weights of the best epoch are kept. None keeps them in memory
+    :param int preprocessing_cache_size: number of encoded datasets kept in memory by tools.cached_encoding, so
+    the texts are not tokenized again in every epoch. 0 disables the cache
+    :param str preprocessing_cache_dir: directory in which encoded datasets are additionally stored
+    :param int length_buckets: if given, texts of similar length are batched together in this many buckets
+    (tools.LengthBucketSampler) and each batch is only padded to its longest text. None pads all texts to max_seq_len
+    :param int inference_threads: number of intra-op threads of BertWrapper.predict on the cpu. None keeps the current
+    setting
+    :param str embedding_cache_dir: directory in which BertWrapper.fit_head stores the pooled BERT outputs of the texts
     :return: a dictionary containing all parameters having their names as keys.
     """
     return {"n_epochs": n_epochs, "lr": lr, "max_seq_len": max_seq_len, "batch_size": batch_size,
-            "device": device, "n_classes": n_classes, "x_name": x_name, "y_name": y_name}
+            "device": device, "n_classes": n_classes, "x_name": x_name, "y_name": y_name,
+            "n_fold_workers": n_fold_workers, "threads_per_worker": threads_per_worker,
+            "checkpoint_dir": checkpoint_dir, "checkpoint_every": checkpoint_every, "resume": resume,
+            "patience": patience, "min_delta": min_delta, "stopping_metric": stopping_metric,
+            "best_weights_path": best_weights_path, "preprocessing_cache_size": preprocessing_cache_size,
+            "preprocessing_cache_dir": preprocessing_cache_dir, "length_buckets": length_buckets,
+            "inference_threads": inference_threads, "embedding_cache_dir": embedding_cache_dir}
 
 
 def performance_comparison(parameter_combinations, wrapper, folds, model_name):
@@ -177,3 +868,100 @@ def performance_comparison(parameter_combinations, wrapper, folds, model_name):
 
         plt.tight_layout(pad=3)
         plt.savefig("visuals/" + model_name + "_combi_" + str(i + 1))
+
+
+@contextlib.contextmanager
+def num_threads(n_threads):
+    """
+    Temporarily sets the number of intra-op threads torch uses on the cpu.
+
+    :param int n_threads: number of threads. None keeps the current setting
+    """
+    previous = torch.get_num_threads()
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+
+def quantize_dynamic(model, backend="x86"):
+    """
+    Quantizes the linear layers of a trained model to int8 for cpu inference (post-training dynamic quantization).
+    Weights are stored as int8, activations are quantized on the fly, so no calibration data is needed.
+
+    :param torch.nn.Module model: a trained model (not modified)
+    :param str backend: quantized engine, "x86" (or "fbgemm") for x86 servers, "qnnpack" for arm
+    :return: the quantized model (on the cpu)
+    """
+    torch.backends.quantized.engine = backend
+    return torch.ao.quantization.quantize_dynamic(cpu_float_copy(model=model), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def latency_benchmark(models, example_inputs, batch_sizes=(1, 8, 32), n_threads=None, n_batches=5):
+    """
+    Measures the latency and throughput of models on the cpu at several batch sizes, under torch.inference_mode.
+
+    :param dict models: a dictionary mapping names to models on the cpu
+    :param dict example_inputs: a dictionary mapping the names of the forward arguments to example tensors of batch
+    size 1, which are repeated to the timed batch sizes
+    :param tuple batch_sizes: the timed batch sizes
+    :param int n_threads: number of intra-op threads. None keeps the current setting
+    :param int n_batches: number of timed batches per model and batch size
+    :return: a pd.DataFrame containing the milliseconds per batch and the observations per second
+    """
+    results = []
+    with num_threads(n_threads=n_threads), torch.inference_mode():
+        for batch_size in batch_sizes:
+            batch = {name: tensor.cpu().expand(batch_size, *tensor.shape[1:]).contiguous()
+                     for name, tensor in example_inputs.items()}
+            for name, model in models.items():
+                model.eval()
+                model(**batch)  # warm-up
+                start = time.perf_counter()
+                for i in range(n_batches):
+                    model(**batch)
+                latency = (time.perf_counter() - start) / n_batches
+                results.append({"model": name, "batch_size": batch_size, "ms_per_batch": latency * 1000,
+                                "per_second": batch_size / latency})
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    return results
+
+
+def quantization_report(wrapper, float_model, quantized_model, data, parameters, example_inputs,
+                        batch_sizes=(1, 8, 32), n_batches=5):
+    """
+    Compares a float model with its quantized version on the cpu: serialized size, latency and throughput at several
+    batch sizes, and the metrics of the wrapper's predict function.
+
+    :param wrapper: the model-wrapper whose predict function computes the metrics
+    :param torch.nn.Module float_model: the trained float model
+    :param torch.nn.Module quantized_model: the quantized model, e.g. created by >quantize_dynamic<
+    :param pd.DataFrame data: the evaluation data
+    :param dict parameters: a dictionary containing the parameters the model was trained with. The benchmark uses
+    parameters["inference_threads"] threads
+    :param dict example_inputs: a dictionary mapping the names of the forward arguments to example tensors of batch
+    size 1
+    :param tuple batch_sizes: the timed batch sizes
+    :param int n_batches: number of timed batches per model and batch size
+    :return: a dictionary containing a pd.DataFrame of the size (MB) and the metrics of both models under the key
+    "metrics", and the pd.DataFrame of >latency_benchmark< under the key "latency"
+    """
+    cpu_parameters = dict(parameters, device="cpu")
+    models = {"float32": cpu_float_copy(model=float_model), "int8": quantized_model}
+    latency = latency_benchmark(models=models, example_inputs=example_inputs, batch_sizes=batch_sizes,
+                                n_threads=parameters["inference_threads"], n_batches=n_batches)
+    results = []
+    for name, model in models.items():
+        buffer = io.BytesIO()
+        torch.save(model.state_dict(), buffer)
+        print("Metrics of the", name, "model:")
+        metrics = wrapper.predict(model=model, data=data, parameters=cpu_parameters)
+        results.append(dict({"model": name, "size_mb": buffer.getbuffer().nbytes / 2 ** 20}, **metrics))
+    results = pd.DataFrame(results).set_index("model")
+    print(results.to_string())
+    print("Delta int8 - float32:")
+    print((results.loc["int8"] - results.loc["float32"]).to_string())
+    return {"metrics": results, "latency": latency}
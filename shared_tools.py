@@ -0,0 +1,617 @@
+"""
+Training, checkpointing and export helpers shared by cv/tools.py, exact_matching/tools.py and nlp/tools.py.
+Each of those modules puts the repository root on sys.path and re-exports the helpers it needs, so the scripts keep
+using them as tools.<name>.
+"""
+import copy
+import functools
+import json
+import multiprocessing
+import os
+import queue
+import random
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.checkpoint import checkpoint_sequential
+
+
+def fold_worker(evaluate_fold, folds, parameters, fold_ids, n_threads, results):
+    """
+    Evaluates folds inside a forked fold worker process. The arguments are inherited from the parent process by
+    forking, only the metrics are sent back.
+
+    :param evaluate_fold: a function evaluating one fold, e.g. the evaluate_fold function of a model-wrapper
+    :param list folds: a list of pd.DataFrames. Each of the DataFrames contains one fold of the data available
+    during the training time.
+    :param dict parameters: a dictionary containing the parameters of the model-wrapper
+    :param list fold_ids: indices of the validation folds evaluated by this worker
+    :param int n_threads: number of intra-op threads of the worker
+    :param results: a multiprocessing queue receiving one (fold_id, metrics, error) tuple per fold
+    """
+    torch.set_num_threads(n_threads)
+    for fold_id in fold_ids:
+        try:
+            metrics = evaluate_fold(folds=folds, fold_id=fold_id, parameters=parameters)
+            error = None
+        except Exception:
+            metrics = None
+            error = traceback.format_exc()
+        results.put((fold_id, metrics, error))
+
+
+def run_folds(evaluate_fold, folds, parameters):
+    """
+    Evaluates every fold and averages the per-epoch metric arrays over all folds.
+    If parameters["n_fold_workers"] > 1, the folds are evaluated in parallel by forked worker processes,
+    each of which is limited to parameters["threads_per_worker"] torch threads (default: cores / workers).
+    Since CUDA cannot be used in forked processes, parallel folds are restricted to the cpu.
+    The workers are forked rather than spawned because the scripts run their experiments at import time, so every
+    spawned worker would run them again. Forking a process whose threads hold locks (e.g. of OpenMP or MKL) can
+    deadlock the workers. torch resets its own thread pool after a fork, but for the parallel folds to be safe,
+    nothing else should run threads in the parent at this point.
+
+    :param evaluate_fold: a function evaluating one fold, e.g. the evaluate_fold function of a model-wrapper
+    :param list folds: a list of pd.DataFrames. Each of the DataFrames contains one fold of the data available
+    during the training time.
+    :param dict parameters: a dictionary containing the parameters of the model-wrapper
+    :return: a dictionary containing the per-epoch metric arrays averaged over all folds
+    """
+    n_fold_workers = min(parameters["n_fold_workers"], len(folds))
+    if n_fold_workers > 1:
+        if torch.device(parameters["device"]).type != "cpu" or torch.cuda.is_initialized():
+            raise ValueError("folds can only be evaluated in parallel on the cpu, before CUDA is initialized")
+        n_threads = parameters["threads_per_worker"]
+        if n_threads is None:
+            n_threads = max(1, os.cpu_count() // n_fold_workers)
+        context = multiprocessing.get_context("fork")
+        results = context.SimpleQueue()
+        worker_fold_ids = [list(range(worker_id, len(folds), n_fold_workers)) for worker_id in range(n_fold_workers)]
+        workers = [context.Process(target=fold_worker,
+                                   args=(evaluate_fold, folds, parameters, fold_ids, n_threads, results))
+                   for fold_ids in worker_fold_ids]
+        for worker in workers:
+            worker.start()
+        fold_metrics = [None] * len(folds)
+        errors = []
+        for _ in range(len(folds)):
+            fold_id, metrics, error = results.get()
+            fold_metrics[fold_id] = metrics
+            if error is not None:
+                errors.append("fold " + str(fold_id + 1) + ":\n" + error)
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise RuntimeError("fold workers failed\n" + "\n".join(errors))
+    else:
+        fold_metrics = [evaluate_fold(folds=folds, fold_id=fold_id, parameters=parameters)
+                        for fold_id in range(len(folds))]
+
+    metrics = {}
+    for name in fold_metrics[0]:
+        metrics[name] = np.zeros(len(fold_metrics[0][name]))
+        for fold_id in range(len(folds)):  # same order of summation as a sequential evaluation
+            metrics[name] += fold_metrics[fold_id][name]
+        metrics[name] /= len(folds)
+    return metrics
+
+
+def transform_output_size(transform_pipe):
+    """
+    Determines the height and width of the images produced by a transformation pipeline without applying it.
+    The last transformation having a fixed output size (e.g. Resize([h, w]), RandomCrop, CenterCrop) determines
+    the output size.
+
+    :param transform_pipe: a transforms.Compose of the transformations that are applied to the images
+    :return: a tuple containing the height and width of the transformed images
+    """
+    for transform in reversed(transform_pipe.transforms):
+        size = getattr(transform, "size", None)
+        if size is None:
+            continue
+        if isinstance(size, (list, tuple)) and len(size) == 2:
+            return int(size[0]), int(size[1])
+        # a single integer only fixes the shorter side of the image, the output size depends on the image
+        raise ValueError("the output size of " + str(transform) + " depends on the input image")
+    raise ValueError("the transformation pipeline does not produce images of a fixed size")
+
+
+def rng_state():
+    """
+    Collects the states of all random number generators used during training.
+
+    :return: a dictionary containing the states of the python, numpy, torch and (if available) cuda generators
+    """
+    state = {"random": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """
+    Restores the states of all random number generators used during training.
+
+    :param dict state: a dictionary created by rng_state
+    """
+    random.setstate(state["random"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def copy_to_cpu(obj):
+    """
+    Recursively copies all tensors contained in (nested) dictionaries, lists and tuples to the cpu.
+
+    :param obj: a tensor, or a container of tensors and other objects
+    :return: a copy of >obj< whose tensors are independent of the tensors used for training
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: copy_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(value) for value in obj)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    return obj
+
+
+class Checkpointer:
+    """
+    Writes checkpoints of a training run (model, optimizer, epoch, random number generator states and any further
+    state like accumulated metrics) and restores them to resume an interrupted run.
+    The states are copied to the cpu in the training loop, while the (slow) serialization happens in a background
+    thread. Every checkpoint is first written to a temporary file and then renamed, so a crash while writing never
+    corrupts the last complete checkpoint.
+    """
+
+    def __init__(self, parameters):
+        """
+        Constructor.
+
+        :param dict parameters: a dictionary containing the parameters "checkpoint_dir" (None disables checkpoints),
+        "checkpoint_every" and "resume"
+        """
+        self.checkpoint_dir = parameters["checkpoint_dir"]
+        self.every_n_epochs = parameters["checkpoint_every"]
+        self.resume = parameters["resume"]
+        self.queue = queue.Queue()
+        self.thread = None
+        self.error = None
+
+    def path(self, name):
+        """
+        Creates the path of a checkpoint.
+
+        :param str name: name of the training run, e.g. "fit" or "fold3"
+        :return: the path of the checkpoint file
+        """
+        return os.path.join(self.checkpoint_dir, name + ".pt")
+
+    def write(self):
+        """
+        Writes the queued checkpoints. Runs in the background thread.
+        """
+        while True:
+            path, state = self.queue.get()
+            try:
+                torch.save(state, path + ".tmp")
+                os.replace(path + ".tmp", path)  # atomic
+            except Exception as error:  # reported to the training loop by the next call of save or wait
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def save(self, name, epoch, model, optimizer, n_epochs=None, **state):
+        """
+        Queues a checkpoint if >epoch< is a checkpoint epoch (or the last epoch).
+
+        :param str name: name of the training run, e.g. "fit" or "fold3"
+        :param int epoch: number of completed epochs
+        :param nn.Module model: the trained model
+        :param optimizer: the optimizer of the model
+        :param int n_epochs: total number of epochs. The last epoch is always checkpointed
+        :param state: further objects that have to be stored, e.g. accumulated metric arrays
+        """
+        if self.error is not None:
+            raise self.error
+        if self.checkpoint_dir is None or (epoch % self.every_n_epochs != 0 and epoch != n_epochs):
+            return
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        state.update({"epoch": epoch, "model": model.state_dict(), "optimizer": optimizer.state_dict(),
+                      "rng": rng_state()})
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.write, daemon=True)
+            self.thread.start()
+        self.queue.put((self.path(name=name), copy_to_cpu(state)))
+
+    def restore(self, name, model, optimizer):
+        """
+        Restores the model, the optimizer and the random number generators from the checkpoint of a training run.
+
+        :param str name: name of the training run, e.g. "fit" or "fold3"
+        :param nn.Module model: the (untrained) model
+        :param optimizer: the optimizer of the model
+        :return: the checkpoint as a dictionary, None if resuming is disabled or no checkpoint exists
+        """
+        if self.checkpoint_dir is None or not self.resume or not os.path.exists(self.path(name=name)):
+            return None
+        checkpoint = torch.load(self.path(name=name), map_location="cpu", weights_only=False)
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        set_rng_state(checkpoint["rng"])
+        print("Resuming", name, "after epoch", checkpoint["epoch"])
+        return checkpoint
+
+    def wait(self):
+        """
+        Blocks until all queued checkpoints are written.
+        """
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+
+class EarlyStopping:
+    """
+    Tracks a validation metric over the epochs of a training run, keeps the weights of the best epoch and signals
+    when the metric has not improved by more than "min_delta" for "patience" epochs.
+    The best weights are kept in memory or, if "best_weights_path" is given, in a file.
+    """
+
+    def __init__(self, parameters, keep_weights=True):
+        """
+        Constructor.
+
+        :param dict parameters: a dictionary containing the parameters "patience" (None disables early stopping),
+        "min_delta", "stopping_metric" and "best_weights_path"
+        :param bool keep_weights: whether the weights of the best epoch are stored. Not needed when only the scores
+        of a run are of interest, e.g. in cross validation
+        """
+        self.patience = parameters["patience"]
+        self.min_delta = parameters["min_delta"]
+        self.metric = parameters["stopping_metric"]
+        self.best_weights_path = parameters["best_weights_path"]
+        self.keep_weights = keep_weights
+        self.best_score = None
+        self.best_epoch = None
+        self.best_metrics = None
+        self.best_weights = None
+        self.bad_epochs = 0
+        self.stopped_epoch = None
+
+    @property
+    def enabled(self):
+        """
+        :return: True if early stopping is enabled, False otherwise
+        """
+        return self.patience is not None
+
+    @property
+    def stopped(self):
+        """
+        :return: True if the training run has been stopped, False otherwise
+        """
+        return self.stopped_epoch is not None
+
+    def step(self, epoch, metrics, model):
+        """
+        Registers the validation metrics of an epoch and stores the weights of the model if the epoch is the best one
+        so far.
+
+        :param int epoch: number of completed epochs
+        :param dict metrics: a dictionary containing the validation metrics of the epoch (higher is better)
+        :param nn.Module model: the trained model
+        :return: True if training has to stop, False otherwise
+        """
+        if not self.enabled:
+            return False
+        score = metrics[self.metric]
+        if self.best_score is None or score > self.best_score + self.min_delta:
+            self.best_score = score
+            self.best_epoch = epoch
+            self.best_metrics = dict(metrics)
+            self.bad_epochs = 0
+            if self.keep_weights:
+                self.save_weights(model=model)
+        else:
+            self.bad_epochs += 1
+        if self.bad_epochs >= self.patience:
+            print("Early stopping after epoch", epoch, "- best epoch:", self.best_epoch, self.metric + ":",
+                  self.best_score)
+            self.stopped_epoch = epoch
+        return self.stopped
+
+    def save_weights(self, model):
+        """
+        Stores the weights of the model as the best weights, in memory or in "best_weights_path".
+
+        :param nn.Module model: the trained model
+        """
+        if self.best_weights_path is None:
+            self.best_weights = copy_to_cpu(model.state_dict())
+        else:
+            torch.save(model.state_dict(), self.best_weights_path + ".tmp")
+            os.replace(self.best_weights_path + ".tmp", self.best_weights_path)  # atomic
+
+    def restore_best(self, model):
+        """
+        Loads the weights of the best epoch into the model.
+
+        :param nn.Module model: the trained model
+        """
+        if self.best_epoch is None or not self.keep_weights:
+            return
+        if self.best_weights_path is None:
+            model.load_state_dict(self.best_weights)
+        else:
+            model.load_state_dict(torch.load(self.best_weights_path, map_location="cpu"))
+
+    def carry_forward(self, *scores):
+        """
+        Fills the per-epoch scores of the epochs after an early stop with the scores of the best epoch, as a stopped
+        run returns the weights of its best epoch. Keeps the per-epoch arrays of all folds comparable.
+
+        :param scores: numpy arrays containing one score per epoch. Filled in place
+        """
+        if not self.stopped:
+            return
+        for epoch_scores in scores:
+            epoch_scores[self.stopped_epoch:] = epoch_scores[self.best_epoch - 1]
+
+    def state_dict(self):
+        """
+        :return: the state of the early stopping as a dictionary, to be stored in checkpoints
+        """
+        return {"best_score": self.best_score, "best_epoch": self.best_epoch, "best_metrics": self.best_metrics,
+                "best_weights": self.best_weights, "bad_epochs": self.bad_epochs,
+                "stopped_epoch": self.stopped_epoch}
+
+    def load_state_dict(self, state):
+        """
+        Restores the state of the early stopping from a checkpoint.
+
+        :param dict state: a dictionary created by >state_dict<
+        """
+        self.best_score = state["best_score"]
+        self.best_epoch = state["best_epoch"]
+        self.best_metrics = state["best_metrics"]
+        self.best_weights = state["best_weights"]
+        self.bad_epochs = state["bad_epochs"]
+        self.stopped_epoch = state["stopped_epoch"]
+
+
+@functools.lru_cache(maxsize=None)
+def cpu_supports_bf16():
+    """
+    Checks whether the cpu computes bfloat16 natively (AVX512-BF16 or AMX-BF16). Without native support, bfloat16
+    autocast on the cpu is slower than float32.
+
+    :return: True if the cpu supports bfloat16, False otherwise
+    """
+    try:
+        with open("/proc/cpuinfo") as file:
+            flags = file.read()
+    except OSError:  # not linux
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def autocast(parameters):
+    """
+    Creates the autocast context of the forward passes. bfloat16 autocast is enabled if "bf16" is set and the device
+    supports bfloat16 natively. Otherwise the context does nothing.
+    Losses have to be computed outside of the context on float32 probabilities (BCELoss is unsafe to autocast).
+
+    :param dict parameters: a dictionary containing the parameters "device" and "bf16"
+    :return: a torch.autocast context
+    """
+    device_type = "cuda" if str(parameters["device"]).startswith("cuda") else "cpu"
+    if device_type == "cuda":
+        enabled = parameters["bf16"] and torch.cuda.is_bf16_supported()
+    else:
+        enabled = parameters["bf16"] and cpu_supports_bf16()
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=enabled)
+
+
+def to_channels_last(module, args, kwargs):
+    """
+    Forward pre-hook converting all 4-dimensional (image batch) inputs of a module to the channels-last memory format.
+    """
+    def convert(value):
+        if torch.is_tensor(value) and value.dim() == 4:
+            return value.contiguous(memory_format=torch.channels_last)
+        return value
+
+    return tuple(convert(value) for value in args), {key: convert(value) for key, value in kwargs.items()}
+
+
+def prepare_model(model, parameters):
+    """
+    Applies the optional performance settings to a model: the channels-last memory format for weights and inputs
+    ("channels_last") and a compiled forward pass ("compile_model").
+    Only the forward function is compiled, so the names in the state dict of the model do not change.
+
+    :param torch.nn.Module model: the model
+    :param dict parameters: a dictionary containing the parameters "channels_last" and "compile_model"
+    :return: the model (modified in place)
+    """
+    if parameters["channels_last"]:
+        model.to(memory_format=torch.channels_last)
+        model.register_forward_pre_hook(to_channels_last, with_kwargs=True)
+    if parameters["compile_model"]:
+        model.forward = torch.compile(model.forward)
+    return model
+
+
+class CheckpointedSequential(torch.nn.Sequential):
+    """
+    A sequential container that applies activation checkpointing while training: its modules are split into segments
+    and only the inputs of the segments are stored during the forward pass. The activations inside a segment are
+    recomputed during the backward pass, trading compute for memory.
+    The modules keep their names, so state dicts of the original container can be loaded.
+    """
+
+    def __init__(self, sequential, n_segments):
+        """
+        Constructor.
+
+        :param torch.nn.Sequential sequential: the container whose modules are checkpointed
+        :param int n_segments: number of checkpointed segments. More segments store more inputs but recompute less
+        """
+        super(CheckpointedSequential, self).__init__(OrderedDict(sequential.named_children()))
+        self.n_segments = min(n_segments, len(sequential))
+
+    def forward(self, x):
+        if not (self.training and torch.is_grad_enabled()):  # nothing to recompute
+            return super(CheckpointedSequential, self).forward(x)
+        return checkpoint_sequential(self, self.n_segments, x, use_reentrant=False)
+
+
+def enable_activation_checkpointing(pretrained_component, n_segments):
+    """
+    Wraps the stages of a torchvision backbone in activation checkpointing.
+    VGG, DenseNet and MobileNet keep their convolutional stages in "features", which is split into >n_segments<
+    segments. ResNets are checkpointed per residual stage (layer1 to layer4), each split into >n_segments< segments.
+
+    :param torch.nn.Module pretrained_component: a torchvision model
+    :param int n_segments: number of checkpointed segments per wrapped stage
+    :return: the backbone (modified in place)
+    """
+    if isinstance(getattr(pretrained_component, "features", None), torch.nn.Sequential):
+        pretrained_component.features = CheckpointedSequential(sequential=pretrained_component.features,
+                                                               n_segments=n_segments)
+    elif hasattr(pretrained_component, "layer4"):
+        for name in ["layer1", "layer2", "layer3", "layer4"]:
+            setattr(pretrained_component, name, CheckpointedSequential(sequential=getattr(pretrained_component, name),
+                                                                       n_segments=n_segments))
+    else:
+        raise ValueError("activation checkpointing is not supported for " + type(pretrained_component).__name__)
+    return pretrained_component
+
+
+def cpu_float_copy(model):
+    """
+    Creates an uncompiled float32 copy of a model on the cpu, e.g. for quantization or export.
+
+    :param torch.nn.Module model: a trained model
+    :return: the copy in evaluation mode
+    """
+    model = copy.deepcopy(model).float().cpu().eval()
+    model.__dict__.pop("forward", None)  # a compiled forward (see prepare_model) is replaced by the original one
+    return model
+
+
+def export_model(model, example_inputs, path, metadata=None, opset_version=17, check_inputs=()):
+    """
+    Exports a trained model as TorchScript (<path>.pt) and ONNX (<path>.onnx), together with a json file
+    (<path>.json) describing its inputs. The standalone inference_runner.py loads these files without the training
+    code. The batch dimension, and the sequence dimension of 2-d and 3-d (token) inputs, stay dynamic.
+    The exported models are checked against the eager model on the example inputs and on >check_inputs< (ONNX only
+    if onnxruntime is installed), so tracing that baked in data-dependent control flow is detected.
+
+    :param torch.nn.Module model: a trained model (not modified)
+    :param dict example_inputs: a dictionary mapping the names of the forward arguments (in order) to example tensors
+    :param str path: path of the exported files without file extension
+    :param dict metadata: further information for the runner, e.g. the image size
+    :param int opset_version: ONNX operator set
+    :param check_inputs: further dictionaries like >example_inputs<, e.g. of other batch sizes and sequence lengths
+    :return: a dictionary containing the paths of the TorchScript, ONNX and json files
+    """
+    model = cpu_float_copy(model=model)
+    names = list(example_inputs)
+    inputs = tuple(example_inputs[name].cpu() for name in names)
+    dynamic_axes = {"output": {0: "batch"}}
+    for name, tensor in zip(names, inputs):
+        dynamic_axes[name] = {0: "batch"}
+        if tensor.dim() in (2, 3):  # token ids or encoded tokens of variable length
+            dynamic_axes[name][1] = "sequence"
+
+    with torch.no_grad():
+        traced = torch.jit.trace(model, inputs)
+        torch.jit.save(traced, path + ".pt")
+        torch.onnx.export(model, inputs, path + ".onnx", input_names=names, output_names=["output"],
+                          dynamic_axes=dynamic_axes, opset_version=opset_version)
+        try:
+            import onnxruntime  # optional, the ONNX file is only checked if installed
+            session = onnxruntime.InferenceSession(path + ".onnx", providers=["CPUExecutionProvider"])
+        except ImportError:
+            print("onnxruntime is not installed, the ONNX export is not checked")
+            session = None
+        for check in [example_inputs] + list(check_inputs):
+            tensors = tuple(check[name].cpu() for name in names)
+            expected = model(*tensors)
+            outputs = {"TorchScript": traced(*tensors)}
+            if session is not None:
+                outputs["ONNX"] = torch.from_numpy(session.run(None, {name: tensor.numpy()
+                                                                      for name, tensor in zip(names, tensors)})[0])
+            for export_format, output in outputs.items():
+                if output.shape != expected.shape or not torch.allclose(output, expected, atol=1e-4):
+                    raise RuntimeError("the " + export_format + " export differs from the eager model for inputs of "
+                                       "shape " + str([tuple(tensor.shape) for tensor in tensors]))
+    metadata = dict(metadata or {}, inputs=names,
+                    dtypes=[str(tensor.dtype).replace("torch.", "") for tensor in inputs])
+    with open(path + ".json", "w") as file:
+        json.dump(metadata, file, indent=2)
+    return {"torchscript": path + ".pt", "onnx": path + ".onnx", "metadata": path + ".json"}
+
+
+def export_report(model, example_inputs, path, batch_size=32, n_batches=10):
+    """
+    Compares the startup (loading) time and the latency per batch of the pickle path (torch.save of the whole
+    model) with the files exported by >export_model<. All formats run on the cpu.
+    The pickle is loaded in this process, where the training code is already imported. Loading it elsewhere
+    additionally costs importing the training script.
+
+    :param torch.nn.Module model: the trained model
+    :param dict example_inputs: the example inputs passed to >export_model<
+    :param str path: path of the exported files without file extension
+    :param int batch_size: number of observations per timed batch
+    :param int n_batches: number of timed batches
+    :return: a pd.DataFrame containing the startup time and the latency per batch (ms) of every format
+    """
+    names = list(example_inputs)
+    batch = [example_inputs[name].cpu()[torch.arange(batch_size) % len(example_inputs[name])] for name in names]
+    torch.save(cpu_float_copy(model=model), path + ".pkl")
+
+    def load_onnx():
+        import onnxruntime  # optional, only needed for the ONNX row
+        session = onnxruntime.InferenceSession(path + ".onnx", providers=["CPUExecutionProvider"])
+        arrays = {name: tensor.numpy() for name, tensor in zip(names, batch)}
+        return lambda: session.run(None, arrays)
+
+    def load_torch(load):
+        module = load()
+        module.eval()
+        return lambda: module(*batch)
+
+    formats = [("pickle", lambda: load_torch(lambda: torch.load(path + ".pkl", weights_only=False))),
+               ("torchscript", lambda: load_torch(lambda: torch.jit.load(path + ".pt"))),
+               ("onnx", load_onnx)]
+    results = []
+    for name, load in formats:
+        start = time.perf_counter()
+        try:
+            run = load()
+        except ImportError:
+            print("onnxruntime is not installed, skipping", name)
+            continue
+        startup = (time.perf_counter() - start) * 1000
+        with torch.no_grad():
+            run()  # warm-up
+            start = time.perf_counter()
+            for i in range(n_batches):
+                run()
+        results.append({"format": name, "startup_ms": startup,
+                        "ms_per_batch": (time.perf_counter() - start) / n_batches * 1000})
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    return results